@@ -45,6 +45,25 @@ typedef struct remsh_xport {
  * descriptor */
 remsh_xport *remsh_fd_xport_new(int fd);
 
+/* Constructor for a transport through a pair of ring buffers in shared memory,
+ * for two processes on the same host.  MEM_FD refers to the shared region,
+ * SIDE is 0 or 1, WAKE_FD is the read end of this side's wakeup pipe and
+ * PEER_WAKE_FD the write end of the other side's.  The new object owns both
+ * pipe descriptors, but not MEM_FD.  Returns NULL on error.  The region layout
+ * is shared with the Python implementation, remsh.xport.shm. */
+remsh_xport *remsh_shm_xport_new(int mem_fd, int side, int wake_fd,
+        int peer_wake_fd);
+
+/* Create a connected pair of shared-memory transports with rings of RING_SIZE
+ * bytes in each direction.  To connect two processes, fork and use one in each
+ * process, releasing the other (see below).  Returns -1 on error, 0 on
+ * success. */
+int remsh_shm_xport_pair(size_t ring_size, remsh_xport **a, remsh_xport **b);
+
+/* Free a shared-memory transport without closing the connection.  After a
+ * fork, call this in the process which does not use XPORT. */
+void remsh_shm_xport_release(remsh_xport *xport);
+
 /*
  * Wire Layer
  */
@@ -68,6 +87,10 @@ remsh_wire *remsh_wire_new(remsh_xport *xport);
  * object is gone and cannot be used after a successful return. */
 int remsh_wire_close(remsh_wire *wire);
 
+/* Enable or disable the compression extension (see the wireopts operation) for
+ * both directions of WIRE.  Returns -1 on error, 0 on success. */
+int remsh_wire_set_compression(remsh_wire *wire, int enabled);
+
 /* Send a box containing they keys and values in BOX; returns -1 on error, or 0
  * on success. */
 int remsh_wire_send_box(remsh_wire *wire, remsh_box *box);
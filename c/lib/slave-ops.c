@@ -46,6 +46,49 @@ struct op_meth {
     struct op_version *versions;
 };
 
+static int
+wireopts_1(remsh_box *rq_box, remsh_wire *rwire, remsh_wire *wwire)
+{
+    int compress;
+
+    remsh_box args[] = {
+        { 0, "compress", 0, NULL },
+        { 0, NULL, 0, NULL },
+    };
+    /* large values are not supported by this implementation */
+    remsh_box reply[] = {
+        { 0, "large_values", 1, "n" },
+        { 0, "compress", 1, "n" },
+        { 0, NULL, 0, NULL },
+    };
+
+    remsh_wire_box_extract(rq_box, args);
+    compress = args[0].val && args[0].val_len == 1 && args[0].val[0] == 'y';
+    if (!args[0].val)
+        reply[1].key = NULL; /* don't mention compression if not asked */
+    else if (compress)
+        reply[1].val = "y";
+
+    /* the reply is sent uncompressed; compression starts with the next box in
+     * each direction */
+    if (remsh_wire_send_box(wwire, reply) < 0)
+        return -1;
+
+    if (compress) {
+        if (remsh_wire_set_compression(rwire, 1) < 0)
+            return -1;
+        if (rwire != wwire && remsh_wire_set_compression(wwire, 1) < 0)
+            return -1;
+    }
+
+    return 0;
+}
+
+static struct op_version wireopts_versions[] = {
+    { 1, wireopts_1 },
+    { 0, NULL },
+};
+
 static int
 set_cwd_1(remsh_box *rq_box, remsh_wire *rwire, remsh_wire *wwire)
 {
@@ -88,6 +131,7 @@ static struct op_version set_cwd_versions[] = {
 };
 
 static struct op_meth op_meths[] = {
+    { "wireopts", wireopts_versions },
     { "set_cwd", set_cwd_versions },
     { NULL, NULL },
 };
@@ -6,9 +6,22 @@
 #include <stdlib.h>
 #include <string.h>
 #include <arpa/inet.h>
+#include <zlib.h>
 #include "remsh.h"
 #include "util.h"
 
+/* with the compression extension, this bit in a key length indicates that the
+ * value is compressed */
+#define COMPRESSED_FLAG 0x4000
+
+/* values shorter than this are never compressed */
+#define COMPRESS_THRESHOLD 128
+
+/* the largest size LEN bytes could be compressed to, including the sync flush
+ * at the end of each value */
+#define COMPRESS_BOUND(len) \
+    ((len) + ((len) >> 12) + ((len) >> 14) + ((len) >> 25) + 18)
+
 struct remsh_wire {
     remsh_xport *xport;
 
@@ -20,8 +33,55 @@ struct remsh_wire {
     remsh_box *box;
     int box_size, box_len;
     size_t box_bytes; /* box bytes in buf used so far */
+
+    /* compression state; box_compressed parallels box, and zvals holds the
+     * decompressed values of the current box */
+    int compress;
+    z_stream deflater, inflater;
+    unsigned char *zbuf;
+    char *box_compressed;
+    char **zvals;
+    int zvals_len;
 };
 
+static void
+free_zvals(remsh_wire *wire)
+{
+    int i;
+
+    for (i = 0; i < wire->zvals_len; i++)
+        free(wire->zvals[i]);
+    wire->zvals_len = 0;
+}
+
+/* decompress the value of BOX in place; returns -1 on error */
+static int
+inflate_value(remsh_wire *wire, remsh_box *box)
+{
+    char *val = malloc(65536 + 1);
+    z_stream *z = &wire->inflater;
+    size_t val_len;
+
+    if (!val)
+        return -1;
+    wire->zvals[wire->zvals_len++] = val;
+
+    z->next_in = (unsigned char *)box->val;
+    z->avail_in = box->val_len;
+    z->next_out = (unsigned char *)val;
+    z->avail_out = 65536;
+    if (inflate(z, Z_SYNC_FLUSH) != Z_OK || z->avail_in != 0)
+        return -1; /* corrupt or too long */
+    val_len = 65536 - z->avail_out;
+    if (val_len > 65535)
+        return -1; /* decompressed value is too long */
+
+    val[val_len] = '\0';
+    box->val = val;
+    box->val_len = val_len;
+    return 0;
+}
+
 int remsh_wire_send_box(remsh_wire *wire, remsh_box *box)
 {
     remsh_box *iter;
@@ -41,16 +101,37 @@ int remsh_wire_send_box(remsh_wire *wire, remsh_box *box)
     /* TODO: this is *horribly* inefficient - can we use writev somehow, or
      * should this code buffer smaller things into larger writes? */
     for (iter = box; iter->key; iter++) {
-        uint16 = htons(iter->key_len);
+        unsigned short int key_len = iter->key_len;
+        unsigned short int val_len = iter->val_len;
+        void *val = iter->val;
+
+        if (wire->compress && val_len >= COMPRESS_THRESHOLD
+                && COMPRESS_BOUND(val_len) <= 65535) {
+            z_stream *z = &wire->deflater;
+
+            z->next_in = (unsigned char *)iter->val;
+            z->avail_in = val_len;
+            z->next_out = wire->zbuf;
+            z->avail_out = 65535;
+            if (deflate(z, Z_SYNC_FLUSH) != Z_OK
+                    || z->avail_in != 0 || z->avail_out == 0)
+                return -1; /* compression error */
+
+            key_len |= COMPRESSED_FLAG;
+            val_len = 65535 - z->avail_out;
+            val = wire->zbuf;
+        }
+
+        uint16 = htons(key_len);
         if (remsh_xport_write(wire->xport, &uint16, 2) < 0)
             return -1; /* xport error */
         if (remsh_xport_write(wire->xport, iter->key, iter->key_len) < 0)
             return -1; /* xport error */
 
-        uint16 = htons(iter->val_len);
+        uint16 = htons(val_len);
         if (remsh_xport_write(wire->xport, &uint16, 2) < 0)
             return -1; /* xport error */
-        if (remsh_xport_write(wire->xport, iter->val, iter->val_len) < 0)
+        if (remsh_xport_write(wire->xport, val, val_len) < 0)
             return -1; /* xport error */
     }
 
@@ -69,6 +150,7 @@ int remsh_wire_read_box(remsh_wire *wire, remsh_box **box)
     wire->buf_start += wire->box_bytes;
     wire->buf_len -= wire->box_bytes;
     wire->box_bytes = 0;
+    free_zvals(wire);
 
     if (box)
         *box = NULL;
@@ -81,11 +163,14 @@ int remsh_wire_read_box(remsh_wire *wire, remsh_box **box)
         while (1) {
             unsigned short int key_len, val_len;
             size_t offset;
+            int compressed = 0;
 
             if (wire->box_bytes + 2 > wire->buf_len)
                 break;
             offset = wire->buf_start + wire->box_bytes;
-            if (wire->buf[offset] != 0)
+            if (wire->compress && wire->buf[offset] == (COMPRESSED_FLAG >> 8))
+                compressed = 1;
+            else if (wire->buf[offset] != 0)
                 return -1; /* invalid character in stream */
             key_len = wire->buf[offset + 1];
             if (key_len > 0) {
@@ -108,6 +193,10 @@ int remsh_wire_read_box(remsh_wire *wire, remsh_box **box)
 
                 wire->box_size *= 2;
                 wire->box = realloc(wire->box, wire->box_size * sizeof(remsh_box));
+                wire->box_compressed = realloc(wire->box_compressed,
+                                               wire->box_size);
+                wire->zvals = realloc(wire->zvals,
+                                      wire->box_size * sizeof(char *));
             }
 
             /* then add the key/value pair */
@@ -121,6 +210,7 @@ int remsh_wire_read_box(remsh_wire *wire, remsh_box **box)
                 offset += 2;
                 wire->box[wire->box_len].val = (char *)&wire->buf[offset];
                 offset += val_len;
+                wire->box_compressed[wire->box_len] = compressed;
 
                 wire->box_len++;
             } else {
@@ -136,6 +226,16 @@ int remsh_wire_read_box(remsh_wire *wire, remsh_box **box)
 
             /* if key_len is 0, we've got a box */
             if (key_len == 0) {
+                int i;
+
+                /* decompress values now that the box will not be re-scanned,
+                 * since the compression context cannot be rewound */
+                for (i = 0; i < wire->box_len; i++) {
+                    if (wire->box_compressed[i]
+                            && inflate_value(wire, &wire->box[i]) < 0)
+                        return -1;
+                }
+
                 /* terminate the box with NULLs */
                 wire->box[wire->box_len].key = NULL;
                 wire->box[wire->box_len].key_len = 0;
@@ -275,7 +375,33 @@ remsh_wire *remsh_wire_new(remsh_xport *xport)
     wire->buf_size = 32768;
 
     wire->box = calloc(32, sizeof(remsh_box));
+    wire->box_compressed = calloc(32, 1);
+    wire->zvals = calloc(32, sizeof(char *));
     wire->box_size = 32;
+
+    return wire;
+}
+
+int remsh_wire_set_compression(remsh_wire *wire, int enabled)
+{
+    if (enabled && !wire->compress) {
+        if (!wire->zbuf && !(wire->zbuf = malloc(65535)))
+            return -1;
+        if (deflateInit2(&wire->deflater, 6, Z_DEFLATED, -15, 8,
+                         Z_DEFAULT_STRATEGY) != Z_OK)
+            return -1;
+        if (inflateInit2(&wire->inflater, -15) != Z_OK) {
+            deflateEnd(&wire->deflater);
+            return -1;
+        }
+        wire->compress = 1;
+    } else if (!enabled && wire->compress) {
+        deflateEnd(&wire->deflater);
+        inflateEnd(&wire->inflater);
+        wire->compress = 0;
+    }
+
+    return 0;
 }
 
 int remsh_wire_close(remsh_wire *wire)
@@ -283,6 +409,12 @@ int remsh_wire_close(remsh_wire *wire)
     if (remsh_xport_close(wire->xport) < 0)
         return -1;
 
+    remsh_wire_set_compression(wire, 0);
+    free_zvals(wire);
+    free(wire->zvals);
+    free(wire->box_compressed);
+    free(wire->zbuf);
+    free(wire->box);
     free(wire->buf);
     free(wire);
 
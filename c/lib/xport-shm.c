@@ -0,0 +1,339 @@
+/* This file is part of remsh
+ * Copyright 2009, 2010, 2010 Dustin J. Mitchell
+ * See COPYING for license information
+ */
+
+#include <unistd.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <string.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <poll.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <sys/socket.h>
+#include "remsh.h"
+#include "util.h"
+
+/* The layout of the shared region is described in py/remsh/xport/shm.py, and
+ * must match it exactly. */
+
+#define SHM_MAGIC 0x52534d31
+#define REGION_HEADER 64
+#define RING_HEADER 128
+
+#define RING_HEAD 0
+#define RING_CLOSED 8
+#define RING_READER_WAITING 12
+#define RING_TAIL 64
+#define RING_WRITER_WAITING 72
+#define RING_READER_CLOSED 76
+
+/* milliseconds to wait for a wakeup before checking the ring again, in case
+ * the wakeup was missed */
+#define WAIT_TIMEOUT 100
+
+typedef struct remsh_shm_xport {
+    remsh_xport xport;
+    char *mem;
+    size_t mem_size;
+    uint32_t ring_size;
+    char *out_ring;
+    char *in_ring;
+    int wake_fd;
+    int peer_wake_fd;
+    int peer_gone;
+} remsh_shm_xport;
+
+#define U64(ring, off) (*(volatile uint64_t *)((ring) + (off)))
+#define U32(ring, off) (*(volatile uint32_t *)((ring) + (off)))
+
+static size_t
+region_size(size_t ring_size)
+{
+    return REGION_HEADER + 2 * (RING_HEADER + ring_size);
+}
+
+static void
+wake_peer(remsh_shm_xport *self)
+{
+    /* a full pipe already holds a wakeup, and a closed one needs none.  The
+     * wakeup descriptors are sockets when created by remsh_shm_xport_pair, so
+     * that a peer which has exited does not cause a SIGPIPE. */
+    while (1) {
+        ssize_t rv = send(self->peer_wake_fd, "w", 1,
+                MSG_NOSIGNAL | MSG_DONTWAIT);
+        if (rv < 0 && errno == ENOTSOCK)
+            rv = write(self->peer_wake_fd, "w", 1);
+        if (rv >= 0 || errno != EINTR)
+            return;
+    }
+}
+
+static void
+drain_wakeups(remsh_shm_xport *self)
+{
+    char buf[256];
+    ssize_t rv;
+
+    while (1) {
+        rv = read(self->wake_fd, buf, sizeof(buf));
+        if (rv == 0) {
+            /* every copy of the peer's end of the pipe is closed */
+            self->peer_gone = 1;
+            return;
+        }
+        if (rv < 0 && errno != EINTR)
+            return;
+    }
+}
+
+/* set the waiting flag at FLAG, then wait for a wakeup unless the value at
+ * WATCH has changed from OLD or the word at CLOSED is set */
+static void
+wait_for(remsh_shm_xport *self, char *ring, int flag, int watch, uint64_t old,
+        int closed)
+{
+    struct pollfd pfd;
+
+    U32(ring, flag) = 1;
+    __sync_synchronize();
+    if (U64(ring, watch) == old && !U32(ring, closed)) {
+        pfd.fd = self->wake_fd;
+        pfd.events = POLLIN;
+        poll(&pfd, 1, WAIT_TIMEOUT);
+    }
+    drain_wakeups(self);
+    U32(ring, flag) = 0;
+}
+
+static int
+write_impl(remsh_xport *xself, void *buf, ssize_t len)
+{
+    remsh_shm_xport *self = (remsh_shm_xport *)xself;
+    char *ring = self->out_ring;
+    char *data = ring + RING_HEADER;
+
+    while (len > 0) {
+        uint64_t head, tail, free;
+        size_t start, count, first;
+
+        if (U32(ring, RING_READER_CLOSED) || self->peer_gone)
+            return 0; /* nobody will read this data */
+
+        head = U64(ring, RING_HEAD);
+        tail = U64(ring, RING_TAIL);
+        __sync_synchronize();
+        free = self->ring_size - (head - tail);
+        if (!free) {
+            wait_for(self, ring, RING_WRITER_WAITING, RING_TAIL, tail,
+                    RING_READER_CLOSED);
+            continue;
+        }
+
+        count = len < free? len : free;
+        start = head % self->ring_size;
+        first = self->ring_size - start;
+        if (first > count)
+            first = count;
+        memcpy(data + start, buf, first);
+        memcpy(data, buf + first, count - first);
+
+        /* publish the data before the new head */
+        __sync_synchronize();
+        U64(ring, RING_HEAD) = head + count;
+        __sync_synchronize();
+        buf += count;
+        len -= count;
+
+        if (U32(ring, RING_READER_WAITING))
+            wake_peer(self);
+    }
+
+    return 0;
+}
+
+static ssize_t
+read_impl(remsh_xport *xself, void *buf, ssize_t len)
+{
+    remsh_shm_xport *self = (remsh_shm_xport *)xself;
+    char *ring = self->in_ring;
+    char *data = ring + RING_HEADER;
+
+    while (1) {
+        uint64_t head, tail;
+        size_t start, count, first;
+
+        head = U64(ring, RING_HEAD);
+        tail = U64(ring, RING_TAIL);
+        __sync_synchronize();
+        if (head == tail) {
+            if (U32(ring, RING_CLOSED) || self->peer_gone)
+                return 0;
+            wait_for(self, ring, RING_READER_WAITING, RING_HEAD, head,
+                    RING_CLOSED);
+            continue;
+        }
+
+        count = head - tail;
+        if (count > len)
+            count = len;
+        start = tail % self->ring_size;
+        first = self->ring_size - start;
+        if (first > count)
+            first = count;
+        memcpy(buf, data + start, first);
+        memcpy(buf + first, data, count - first);
+
+        /* finish copying before freeing the space */
+        __sync_synchronize();
+        U64(ring, RING_TAIL) = tail + count;
+        __sync_synchronize();
+
+        if (U32(ring, RING_WRITER_WAITING))
+            wake_peer(self);
+        return count;
+    }
+}
+
+static int
+close_impl(remsh_xport *xself)
+{
+    remsh_shm_xport *self = (remsh_shm_xport *)xself;
+
+    U32(self->out_ring, RING_CLOSED) = 1;
+    U32(self->in_ring, RING_READER_CLOSED) = 1;
+    __sync_synchronize();
+    wake_peer(self);
+
+    remsh_shm_xport_release(xself);
+    return 0;
+}
+
+static struct remsh_xport_vtable shm_vtable = {
+    write_impl,
+    read_impl,
+    close_impl
+};
+
+static int
+set_nonblocking(int fd)
+{
+    int flags = fcntl(fd, F_GETFL);
+    if (flags < 0)
+        return -1;
+    return fcntl(fd, F_SETFL, flags | O_NONBLOCK);
+}
+
+remsh_xport *
+remsh_shm_xport_new(int mem_fd, int side, int wake_fd, int peer_wake_fd)
+{
+    remsh_shm_xport *self;
+    struct stat st;
+    char *mem;
+    uint32_t ring_size;
+
+    if (fstat(mem_fd, &st) < 0 || st.st_size < REGION_HEADER)
+        return NULL;
+    mem = mmap(NULL, st.st_size, PROT_READ | PROT_WRITE, MAP_SHARED,
+            mem_fd, 0);
+    if (mem == MAP_FAILED)
+        return NULL;
+
+    ring_size = U32(mem, 4);
+    if (U32(mem, 0) != SHM_MAGIC || region_size(ring_size) != st.st_size)
+        goto fail;
+    if (set_nonblocking(wake_fd) < 0 || set_nonblocking(peer_wake_fd) < 0)
+        goto fail;
+
+    self = calloc(1, sizeof(remsh_shm_xport));
+    if (!self)
+        goto fail;
+
+    self->xport.v = &shm_vtable;
+    self->xport.errmsg = NULL;
+    self->mem = mem;
+    self->mem_size = st.st_size;
+    self->ring_size = ring_size;
+    if (side == 0) {
+        self->out_ring = mem + REGION_HEADER;
+        self->in_ring = mem + REGION_HEADER + RING_HEADER + ring_size;
+    } else {
+        self->out_ring = mem + REGION_HEADER + RING_HEADER + ring_size;
+        self->in_ring = mem + REGION_HEADER;
+    }
+    self->wake_fd = wake_fd;
+    self->peer_wake_fd = peer_wake_fd;
+
+    return (remsh_xport *)self;
+
+fail:
+    munmap(mem, st.st_size);
+    return NULL;
+}
+
+void
+remsh_shm_xport_release(remsh_xport *xself)
+{
+    remsh_shm_xport *self = (remsh_shm_xport *)xself;
+
+    munmap(self->mem, self->mem_size);
+    close(self->wake_fd);
+    close(self->peer_wake_fd);
+    if (xself->errmsg)
+        free(xself->errmsg);
+    free(self);
+}
+
+int
+remsh_shm_xport_pair(size_t ring_size, remsh_xport **a, remsh_xport **b)
+{
+    char template[] = "/tmp/remsh-shm-XXXXXX";
+    int mem_fd;
+    int p0[2], p1[2];
+    uint32_t header[2];
+
+    mem_fd = mkstemp(template);
+    if (mem_fd < 0)
+        return -1;
+    unlink(template);
+
+    header[0] = SHM_MAGIC;
+    header[1] = ring_size;
+    if (ftruncate(mem_fd, region_size(ring_size)) < 0
+     || pwrite(mem_fd, header, sizeof(header), 0) != sizeof(header))
+        goto fail;
+
+    if (socketpair(AF_UNIX, SOCK_STREAM, 0, p0) < 0)
+        goto fail;
+    if (socketpair(AF_UNIX, SOCK_STREAM, 0, p1) < 0) {
+        close(p0[0]);
+        close(p0[1]);
+        goto fail;
+    }
+
+    *a = remsh_shm_xport_new(mem_fd, 0, p0[0], p1[1]);
+    if (!*a) {
+        close(p0[0]);
+        close(p0[1]);
+        close(p1[0]);
+        close(p1[1]);
+        goto fail;
+    }
+    *b = remsh_shm_xport_new(mem_fd, 1, p1[0], p0[1]);
+    if (!*b) {
+        remsh_shm_xport_release(*a);
+        close(p1[0]);
+        close(p0[1]);
+        goto fail;
+    }
+
+    /* the mappings stay valid after the file is closed */
+    close(mem_fd);
+    return 0;
+
+fail:
+    close(mem_fd);
+    return -1;
+}
@@ -170,6 +170,46 @@ int main(void)
                 "binary data matches");
     }
 
+    /* test compression */
+    {
+        char val[2000];
+        remsh_box box[] = {
+            { 0, "data", sizeof(val), val, },
+            { 0, "stream", 6, "stdout", },
+            { 0, NULL, 0, NULL, },
+        };
+        remsh_box get[] = {
+            { 0, "data", 0, NULL, },
+            { 0, "stream", 0, NULL, },
+            { 0, NULL, 0, NULL, },
+        };
+        remsh_box *res;
+        int i;
+
+        for (i = 0; i < sizeof(val); i++)
+            val[i] = "compressible\n"[i % 13];
+
+        test_call_ok(remsh_wire_set_compression(wwire, 1), NULL,
+                "enable compression on write wire");
+        test_call_ok(remsh_wire_set_compression(rwire, 1), NULL,
+                "enable compression on read wire");
+
+        /* send twice, so the second box depends on the first's context */
+        for (i = 0; i < 2; i++) {
+            test_call_ok(remsh_wire_send_box(wwire, box), NULL,
+                    "send compressible box");
+            test_call_ok(remsh_wire_read_box(rwire, &res), NULL,
+                    "read compressed box");
+            remsh_wire_box_extract(res, get);
+            test_is_int(get[0].val_len, sizeof(val),
+                    "decompressed length is correct");
+            test_is_int(memcmp(get[0].val, val, sizeof(val)), 0,
+                    "decompressed data is correct");
+            test_is_str(get[1].val, "stdout",
+                    "short value is correct");
+        }
+    }
+
     testutil_cleanup();
     return 0;
 }
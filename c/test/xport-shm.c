@@ -0,0 +1,98 @@
+/* This file is part of remsh
+ * Copyright 2009, 2010, 2010 Dustin J. Mitchell
+ * See COPYING for license information
+ */
+
+#include <unistd.h>
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/wait.h>
+#include <sys/types.h>
+#include "remsh.h"
+#include "testutils.h"
+
+int main(void)
+{
+    remsh_xport *wxp, *rxp;
+    char buf[256];
+    char *big, *got;
+    int i, total;
+    ssize_t rv;
+    pid_t pid;
+
+    testutil_init();
+
+    test_call_ok(remsh_shm_xport_pair(1000, &wxp, &rxp), NULL,
+            "create a pair");
+
+    /* simple read and write */
+    test_call_ok(remsh_xport_write(wxp, "WORDS", 5), wxp->errmsg,
+            "write is OK");
+    test_is_int(remsh_xport_read(rxp, buf, 5), 5,
+            "and read returns all bytes");
+    buf[5] = '\0';
+    test_is_str(buf, "WORDS",
+            "and the correct bytes, too");
+
+    /* writes are coalesced, and reads can be shorter than the data */
+    test_call_ok(remsh_xport_write(wxp, "BOOKKEEPER", 10), wxp->errmsg,
+            "batched write 1 OK");
+    test_call_ok(remsh_xport_write(wxp, "BOOKKEEPER", 10), wxp->errmsg,
+            "batched write 2 OK");
+    test_is_int(remsh_xport_read(rxp, buf, 15), 15,
+            "first read returns as much as requested");
+    test_is_int(remsh_xport_read(rxp, buf + 15, sizeof(buf)), 5,
+            "second read returns remainder");
+    buf[20] = '\0';
+    test_is_str(buf, "BOOKKEEPERBOOKKEEPER",
+            "and correct bytes are present");
+
+    /* the other direction works too */
+    test_call_ok(remsh_xport_write(rxp, "UP", 2), rxp->errmsg,
+            "write in the other direction");
+    test_is_int(remsh_xport_read(wxp, buf, sizeof(buf)), 2,
+            "and read it");
+
+    /* send much more than the ring holds from a child process */
+    big = malloc(100000);
+    got = malloc(100000);
+    for (i = 0; i < 100000; i++)
+        big[i] = i % 251;
+
+    pid = fork();
+    if (pid < 0) {
+        perror("fork");
+        return 1;
+    }
+    if (pid == 0) {
+        remsh_shm_xport_release(rxp);
+        if (remsh_xport_write(wxp, big, 100000) < 0)
+            _exit(1);
+        remsh_xport_close(wxp);
+        _exit(0);
+    }
+    remsh_shm_xport_release(wxp);
+
+    total = 0;
+    while ((rv = remsh_xport_read(rxp, got + total, 100000 - total)) > 0) {
+        test_isnt_int(rv > 1000, 1, "reads never exceed the ring size");
+        total += rv;
+        if (total == 100000)
+            break;
+    }
+    test_is_int(total, 100000, "read all of the data");
+    test_is_int(memcmp(big, got, 100000), 0, "and the correct bytes");
+    test_is_int(remsh_xport_read(rxp, buf, sizeof(buf)), 0,
+            "returns 0 on EOF");
+    test_is_int(remsh_xport_read(rxp, buf, sizeof(buf)), 0,
+            "still returns 0 on EOF");
+    waitpid(pid, NULL, 0);
+
+    test_call_ok(remsh_xport_close(rxp), NULL, "close");
+
+    free(big);
+    free(got);
+    testutil_cleanup();
+    return 0;
+}
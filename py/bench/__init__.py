@@ -0,0 +1,60 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+Performance benchmarks for remsh.  Run them with 'python -m bench.run'.
+"""
+
+import time
+
+# (name, function) pairs, in registration order
+benchmarks = []
+
+
+def benchmark(name):
+    """
+    Decorator to register a benchmark function under NAME.  The function is
+    called with a Timer, and returns a dictionary of measurements.
+    """
+    def register(fn):
+        benchmarks.append((name, fn))
+        return fn
+    return register
+
+
+class Timer(object):
+    """
+
+    Repeats an operation until a minimum amount of time has passed, to get a
+    stable measurement of its rate.
+
+    """
+
+    def __init__(self, min_time=1.0):
+        self.min_time = min_time
+
+    def repeat(self, fn):
+        """
+        Call FN until min_time has passed, and return (count, elapsed).
+        """
+        count = 0
+        start = time.time()
+        while 1:
+            fn()
+            count += 1
+            elapsed = time.time() - start
+            if elapsed >= self.min_time:
+                return count, elapsed
+
+    def rate(self, fn, bytes=0):
+        """
+        Return a dictionary giving the operations per second, and if BYTES (the
+        number of bytes FN processes each time) is nonzero, the megabytes per
+        second.
+        """
+        count, elapsed = self.repeat(fn)
+        result = {'ops_per_sec': count / elapsed}
+        if bytes:
+            result['mb_per_sec'] = count * bytes / elapsed / 1048576.0
+        return result
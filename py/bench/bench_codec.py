@@ -0,0 +1,46 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+Box encoding and decoding rates, independent of any transport.
+"""
+
+from remsh.wire import Wire
+from bench import benchmark
+
+shapes = [
+    ('request', {'meth': 'stat', 'version': 1, 'path': '/tmp/some/file'}),
+    ('result', {'result': 'f'}),
+    ('stream', {'stream': 'stdout', 'data': 'x' * 4096}),
+    ('data', {'data': 'x' * 65535}),
+    ('empty', {}),
+]
+
+
+def make_benchmarks(shape, box):
+    wire = Wire(None)
+    bytes = wire._box_to_bytes(box)
+
+    @benchmark('codec.encode.%s' % shape)
+    def encode(timer):
+        box_to_bytes = wire._box_to_bytes
+        def fn():
+            for i in xrange(100):
+                box_to_bytes(box)
+        result = timer.rate(fn, bytes=100 * len(bytes))
+        result['boxes_per_sec'] = result.pop('ops_per_sec') * 100
+        return result
+
+    @benchmark('codec.decode.%s' % shape)
+    def decode(timer):
+        bytes_to_box = wire._bytes_to_box
+        def fn():
+            for i in xrange(100):
+                bytes_to_box(bytes)
+        result = timer.rate(fn, bytes=100 * len(bytes))
+        result['boxes_per_sec'] = result.pop('ops_per_sec') * 100
+        return result
+
+for shape, box in shapes:
+    make_benchmarks(shape, box)
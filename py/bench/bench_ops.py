@@ -0,0 +1,112 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+End-to-end operation rates against an in-process SlaveServer.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+
+from remsh.xport.local import LocalXport
+from remsh.xport.unix import UnixXport
+from remsh.wire import Wire
+from remsh.slave.server import SlaveServer
+from remsh.master.remote import RemoteSlave
+from bench import benchmark
+
+FILE_SIZE = 8 * 1048576
+
+
+class Setup(object):
+    """
+
+    A RemoteSlave connected to an in-process SlaveServer, and a temporary
+    directory containing a file of FILE_SIZE bytes named 'src'.
+
+    """
+
+    def __init__(self, xports=None):
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, 'src')
+        self.dest = os.path.join(self.dir, 'dest')
+        f = open(self.src, 'wb')
+        f.write(os.urandom(FILE_SIZE))
+        f.close()
+
+        if xports is None:
+            xports = LocalXport.create()
+        slave_xport, self.master_xport = xports
+        server = SlaveServer(Wire(slave_xport))
+        self.thd = threading.Thread(target=server.serve)
+        self.thd.setDaemon(1)
+        self.thd.start()
+        self.slave = RemoteSlave(Wire(self.master_xport))
+        self.slave.set_wire_options(large_values=True)
+
+    def remove_dest(self):
+        if os.path.exists(self.dest):
+            os.unlink(self.dest)
+
+    def close(self):
+        self.master_xport.close()
+        self.thd.join()
+        shutil.rmtree(self.dir)
+
+
+def with_setup(fn, make_xports=None):
+    def wrapper(timer):
+        if make_xports:
+            setup = Setup(make_xports())
+        else:
+            setup = Setup()
+        try:
+            return fn(timer, setup)
+        finally:
+            setup.close()
+    return wrapper
+
+
+@benchmark('ops.stat')
+@with_setup
+def stat(timer, setup):
+    return timer.rate(lambda: setup.slave.stat(setup.src))
+
+
+def send(timer, setup):
+    def fn():
+        setup.remove_dest()
+        setup.slave.send(setup.src, setup.dest)
+    return timer.rate(fn, bytes=FILE_SIZE)
+
+
+def fetch(timer, setup):
+    def fn():
+        setup.remove_dest()
+        setup.slave.fetch(setup.src, setup.dest)
+    return timer.rate(fn, bytes=FILE_SIZE)
+
+benchmark('ops.send')(with_setup(send))
+benchmark('ops.fetch')(with_setup(fetch))
+# over a Unix socket, these pass file descriptors where possible
+benchmark('ops.unix.send')(with_setup(send, UnixXport.pair))
+benchmark('ops.unix.fetch')(with_setup(fetch, UnixXport.pair))
+
+
+@benchmark('ops.execute.true')
+@with_setup
+def execute_true(timer, setup):
+    return timer.rate(lambda: setup.slave.execute(args=['true']))
+
+
+@benchmark('ops.execute.cat')
+@with_setup
+def execute_cat(timer, setup):
+    def discard(data):
+        pass
+    def fn():
+        setup.slave.execute(args=['cat', setup.src], stdout_cb=discard)
+    return timer.rate(fn, bytes=FILE_SIZE)
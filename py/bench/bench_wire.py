@@ -0,0 +1,122 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+Wire throughput over the available transports, with a writer thread sending
+boxes as fast as possible while the main thread reads them.
+"""
+
+import os
+import socket
+import threading
+
+from remsh.wire import Wire
+from remsh.xport.local import LocalXport
+from remsh.xport.fd import FDXport
+from remsh.xport.sock import SocketXport
+from remsh.xport.shm import ShmXport
+from bench import benchmark
+
+
+def local_pair():
+    a, b = LocalXport.create()
+    return Wire(a), Wire(b)
+
+
+def socketpair_pair():
+    a, b = socket.socketpair()
+    # the FDXports own duplicates of the sockets' descriptors
+    wires = (Wire(FDXport(os.dup(a.fileno()))),
+             Wire(FDXport(os.dup(b.fileno()))))
+    a.close()
+    b.close()
+    return wires
+
+
+def socketxport_pair():
+    a, b = socket.socketpair()
+    return Wire(SocketXport(a)), Wire(SocketXport(b))
+
+
+def shm_pair():
+    a, b = ShmXport.create()
+    return Wire(a), Wire(b)
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(listener.getsockname())
+    server, addr = listener.accept()
+    listener.close()
+    return Wire(SocketXport(client)), Wire(SocketXport(server))
+
+
+def transfer(timer, make_pair, box, count):
+    sender, receiver = make_pair()
+    try:
+        def send():
+            sender.cork()
+            for i in xrange(count):
+                sender.send_box(box)
+            sender.uncork()
+
+        def fn():
+            thd = threading.Thread(target=send)
+            thd.start()
+            for i in xrange(count):
+                receiver.read_box()
+            thd.join()
+
+        size = len(sender._box_to_bytes(box))
+        result = timer.rate(fn, bytes=count * size)
+        result['boxes_per_sec'] = result.pop('ops_per_sec') * count
+        return result
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def make_benchmarks(xport, make_pair):
+
+    @benchmark('wire.%s.data' % xport)
+    def data(timer):
+        return transfer(timer, make_pair, {'data': 'x' * 65535}, 64)
+
+    @benchmark('wire.%s.small' % xport)
+    def small(timer):
+        return transfer(timer, make_pair, {'result': 'f'}, 1000)
+
+make_benchmarks('local', local_pair)
+make_benchmarks('socketpair', socketpair_pair)
+make_benchmarks('socketxport', socketxport_pair)
+make_benchmarks('shm', shm_pair)
+make_benchmarks('tcp', tcp_pair)
+
+
+@benchmark('wire.tcp.round_trip')
+def round_trip(timer):
+    # small request/response exchanges, where Nagle's algorithm would hurt
+    master, slave = tcp_pair()
+    try:
+        def echo():
+            while 1:
+                box = slave.read_box()
+                if box is None:
+                    break
+                slave.send_box(box)
+        thd = threading.Thread(target=echo)
+        thd.start()
+
+        def fn():
+            master.send_box({'meth': 'stat', 'version': 1, 'path': '/'})
+            master.read_box()
+        result = timer.rate(fn)
+    finally:
+        master.close()
+    thd.join()
+    slave.close()
+    return result
@@ -0,0 +1,37 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+Compare two sets of benchmark results, as written by bench.run.
+
+usage: python -m bench.compare OLD.json NEW.json
+"""
+
+import sys
+import json
+
+
+def main():
+    if len(sys.argv) != 3:
+        sys.stderr.write(__doc__.strip() + "\n")
+        sys.exit(1)
+    old = json.load(open(sys.argv[1]))
+    new = json.load(open(sys.argv[2]))
+
+    print "%-32s %-14s %12s %12s %8s" % ('benchmark', 'measure',
+                                          old['revision'], new['revision'],
+                                          'change')
+    for name in sorted(new['results']):
+        if name not in old['results']:
+            continue
+        for measure, value in sorted(new['results'][name].items()):
+            if measure not in old['results'][name]:
+                continue
+            old_value = old['results'][name][measure]
+            change = (value - old_value) * 100.0 / old_value
+            print "%-32s %-14s %12.1f %12.1f %+7.1f%%" % (name, measure,
+                                                   old_value, value, change)
+
+if __name__ == '__main__':
+    main()
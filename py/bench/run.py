@@ -0,0 +1,78 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+"""
+Run the benchmarks and write the results as JSON.
+
+usage: python -m bench.run [-o FILE] [-t MIN_TIME] [PREFIX ..]
+
+Only benchmarks whose names start with one of the given prefixes are run.
+"""
+
+import sys
+import time
+import platform
+import subprocess
+import optparse
+import json
+
+import bench
+import bench.bench_codec
+import bench.bench_wire
+import bench.bench_ops
+
+
+def revision():
+    try:
+        proc = subprocess.Popen(['git', 'describe', '--always', '--dirty'],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out = proc.communicate()[0]
+    except OSError:
+        return None
+    if proc.returncode != 0:
+        return None
+    return out.strip()
+
+
+def main():
+    parser = optparse.OptionParser(
+        usage="%prog [-o FILE] [-t MIN_TIME] [PREFIX ..]")
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help="write results to FILE instead of stdout")
+    parser.add_option('-t', '--min-time', dest='min_time', type='float',
+                      default=1.0,
+                      help="minimum seconds to run each benchmark")
+    options, prefixes = parser.parse_args()
+
+    timer = bench.Timer(min_time=options.min_time)
+    results = {}
+    for name, fn in bench.benchmarks:
+        if prefixes and not [p for p in prefixes if name.startswith(p)]:
+            continue
+        sys.stderr.write("%s.. " % name)
+        results[name] = fn(timer)
+        sys.stderr.write("%s\n" % ", ".join("%s=%.1f" % item
+                                      for item in sorted(results[name].items())))
+
+    report = {
+        'revision': revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'min_time': options.min_time,
+        'results': results,
+    }
+
+    if options.output:
+        out = open(options.output, 'w')
+    else:
+        out = sys.stdout
+    json.dump(report, out, indent=2, sort_keys=True)
+    out.write("\n")
+    if options.output:
+        out.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_delta -*-
+
+"""
+
+Block signatures and deltas for the 'sync' operation, in the manner of rsync.
+The side holding the old version of a file describes each of its blocks with a
+weak checksum, which can be updated cheaply as a window slides along a file,
+and a strong hash.  The side holding the new version then finds those blocks
+anywhere in its file, and describes the new version as a sequence of
+references to old blocks and literal data.
+
+"""
+
+import zlib
+import struct
+import hashlib
+
+# the weak checksum is Adler-32, whose two halves are sums modulo this number
+ADLER_MOD = 65521
+
+# each signature is the weak checksum and the MD5 digest of one block
+SIGNATURE = struct.Struct("!I16s")
+
+MIN_BLOCK_SIZE = 2048
+MAX_BLOCK_SIZE = 131072
+
+# how much of the new file is read at a time
+READ_SIZE = 1024 * 1024
+
+# After this many consecutive blocks' worth of unmatched data, stop checking
+# every offset of every block.  A byte-by-byte search in Python is slow, and
+# long unmatched stretches are usually new data, in which a search rarely
+# finds anything.
+MAX_ROLLED_BLOCKS = 16
+
+# Beyond MAX_ROLLED_BLOCKS, every offset is still checked in one block of
+# this many, and only the block boundaries in the others.  A search across
+# one block finds old data at any alignment, so matching resumes within this
+# many blocks of the end of an insertion of any length.
+ROLL_INTERVAL = 8
+
+
+def block_size_for(size):
+    """
+    Return the block size to use for an old file of SIZE bytes: about the
+    square root of the size, so that the signatures and the expected literal
+    data grow together, rounded up to a multiple of 1KiB.
+    """
+    block_size = int(size ** 0.5 + 1023) & ~1023
+    return max(MIN_BLOCK_SIZE, min(block_size, MAX_BLOCK_SIZE))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_hash(data):
+    return hashlib.md5(data).digest()
+
+
+def signatures(file, block_size):
+    """
+    Generate the packed signature of each whole block of FILE, in order.  A
+    partial block at the end of the file has no signature.
+    """
+    while 1:
+        block = file.read(block_size)
+        if len(block) < block_size:
+            return
+        yield SIGNATURE.pack(weak_checksum(block), strong_hash(block))
+
+
+def unpack_signatures(data):
+    """
+    Return a list of (weak, strong) tuples from a string of packed
+    signatures.
+    """
+    size = SIGNATURE.size
+    if len(data) % size:
+        raise ValueError("truncated signature")
+    return [SIGNATURE.unpack_from(data, i) for i in xrange(0, len(data), size)]
+
+
+def delta(file, block_size, sigs):
+    """
+    Generate a description of the contents of FILE in terms of the blocks
+    of an old file, whose signatures are the (weak, strong) tuples in SIGS.
+    Each item is either a string of literal data, or a tuple (first, count)
+    referring to COUNT consecutive old blocks starting with block number
+    FIRST.  Items are generated in file order.
+    """
+    # weak: {strong: block number}, keeping the first of identical blocks
+    table = {}
+    for i, (weak, strong) in enumerate(sigs):
+        table.setdefault(weak, {}).setdefault(strong, i)
+
+    n = block_size
+    buf = ''
+    data = bytearray()
+    pos = 0         # start of the window being checked
+    lit = 0         # start of the literal data not yet generated
+    run = None      # [first, count] of matched blocks not yet generated
+    misses = 0      # unmatched blocks since the last match
+    eof = False
+
+    while 1:
+        # keep two blocks available, so that a search can cover a whole
+        # block of offsets
+        if len(buf) - pos < 2 * n and not eof:
+            more = file.read(READ_SIZE)
+            if not more:
+                eof = True
+            if lit < pos:
+                yield buf[lit:pos]
+            buf = buf[pos:] + more
+            data = bytearray(buf)
+            pos = lit = 0
+            continue
+        if len(buf) - pos < n:
+            break
+
+        # check the block at pos
+        weak = weak_checksum(buffer(buf, pos, n))
+        found = None
+        if weak in table:
+            found = table[weak].get(strong_hash(buffer(buf, pos, n)))
+
+        rolling = misses < MAX_ROLLED_BLOCKS or misses % ROLL_INTERVAL == 0
+        if found is None and table and rolling:
+            # slide the window along one byte at a time, looking for a block
+            # starting at any offset up to the next block
+            a = weak & 0xffff
+            b = weak >> 16
+            p = pos
+            limit = min(pos + n, len(buf) - n)
+            while p < limit:
+                out = data[p]
+                a = (a - out + data[p + n]) % ADLER_MOD
+                b = (b - n * out + a - 1) % ADLER_MOD
+                p += 1
+                candidates = table.get(a | (b << 16))
+                if candidates:
+                    found = candidates.get(strong_hash(buffer(buf, p, n)))
+                    if found is not None:
+                        break
+            if found is None:
+                # no block starts before p; the window at p, if any, is
+                # checked on the next pass
+                if p == pos:
+                    break
+                if run:
+                    yield tuple(run)
+                    run = None
+                misses += 1
+                pos = p
+                continue
+            pos = p
+        elif found is None:
+            if run:
+                yield tuple(run)
+                run = None
+            misses += 1
+            pos += n
+            continue
+
+        # a match: pos is the start of old block 'found'
+        misses = 0
+        if lit < pos:
+            if run:
+                yield tuple(run)
+                run = None
+            yield buf[lit:pos]
+        if run and run[0] + run[1] == found:
+            run[1] += 1
+        else:
+            if run:
+                yield tuple(run)
+            run = [found, 1]
+        pos += n
+        lit = pos
+
+    if run:
+        yield tuple(run)
+    if lit < len(buf):
+        yield buf[lit:]
@@ -0,0 +1,419 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_asyncremote -*-
+
+import os
+import time
+import socket
+import asyncore
+
+from remsh.wire import AsyncWire, Error
+from remsh.master.remote import RemoteSlaveBase, ProtocolError, \
+                               NotFoundError, FileExistsError, \
+                               OpenFailedError, FailedError, bool
+
+
+class Operation(object):
+    """
+
+    The eventual result of an operation on an AsyncRemoteSlave.  Callbacks are
+    called with the result when the operation succeeds, and errbacks with the
+    exception instance when it fails.
+
+    """
+
+    def __init__(self):
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+
+    def add_callbacks(self, callback=None, errback=None):
+        self.callbacks.append((callback, errback))
+        if self.done:
+            self._run_callbacks()
+
+    def succeed(self, result):
+        self.done = True
+        self.result = result
+        self._run_callbacks()
+
+    def fail(self, error):
+        self.done = True
+        self.error = error
+        self._run_callbacks()
+
+    def _run_callbacks(self):
+        callbacks, self.callbacks = self.callbacks, []
+        for callback, errback in callbacks:
+            if self.error is None:
+                if callback:
+                    callback(self.result)
+            elif errback:
+                errback(self.error)
+
+# operation generators yield this to wait until the wire's output has drained,
+# or None to wait for the next box
+DRAIN = object()
+
+
+class AsyncRemoteSlave(RemoteSlaveBase):
+    """
+
+    A non-blocking version of RemoteSlave.  Each operation method takes the
+    same arguments as the RemoteSlave method, but returns an Operation
+    immediately.  Operations are performed one at a time, in the order they
+    were requested.
+
+    The slave is driven by its transport, which must deliver incoming boxes to
+    box_received, call output_drained when it has written all of the wire's
+    output, and call connection_lost on EOF.  AsyncConnection does this from
+    an asyncore loop, and remsh.master.eventloop.EventLoop from its own.
+
+    """
+
+    # send() generates more data boxes only while less than this many bytes
+    # of output are waiting to be written
+    low_water = 262144
+
+    def __init__(self, wire):
+        self.wire = wire
+        self.queue = []
+        self.current = None
+        self.waiting_for = None
+        self.connected = True
+        # whether execute supports flow control: None if unknown
+        self.windowed = None
+
+    ## operations
+
+    def set_wire_options(self, large_values=False, compress=False):
+        return self._start(self._run_wireopts, large_values, compress)
+
+    def set_cwd(self, cwd=None):
+        return self._start(self._run_simple, self._op_set_cwd(cwd))
+
+    def getenv(self):
+        return self._start(self._run_simple, self._op_getenv())
+
+    def ping(self, data='', reply_size=0):
+        return self._start(self._run_ping, self._op_ping(data, reply_size))
+
+    def mkdir(self, dir):
+        return self._start(self._run_simple, self._op_mkdir(dir))
+
+    def execute(self, args=[], stdout_cb=None, stderr_cb=None):
+        return self._start(self._run_execute, args, stdout_cb, stderr_cb)
+
+    def send(self, src, dest):
+        return self._start(self._run_send, src, dest)
+
+    def fetch(self, src, dest):
+        return self._start(self._run_fetch, src, dest)
+
+    def remove(self, path):
+        return self._start(self._run_simple, self._op_remove(path))
+
+    def rename(self, src, dest):
+        return self._start(self._run_simple, self._op_rename(src, dest))
+
+    def copy(self, src, dest):
+        return self._start(self._run_simple, self._op_copy(src, dest))
+
+    def stat(self, path):
+        return self._start(self._run_simple, self._op_stat(path))
+
+    def hash(self, path, algorithm='sha256'):
+        return self._start(self._run_simple, self._op_hash(path, algorithm))
+
+    ## operation generators
+
+    # Each of these is a generator, which is resumed with each box received
+    # for the operation.  It sends boxes directly on the wire, and finishes by
+    # calling succeed on its Operation or raising an exception.
+
+    def _run_simple(self, op, request):
+        box, handle = request
+        self.wire.send_box(box)
+        box = yield None
+        op.succeed(handle(box))
+
+    def _run_ping(self, op, request):
+        # timed from when the request is sent, rather than when it was queued
+        start = time.time()
+        box, handle = request
+        self.wire.send_box(box)
+        box = yield None
+        handle(box)
+        op.succeed(time.time() - start)
+
+    def _run_wireopts(self, op, large_values, compress):
+        box, handle = self._op_wireopts(large_values, compress, False)
+        self.wire.send_box(box)
+        box = yield None
+        options = handle(box)
+        if options.get('large_values'):
+            self.wire.set_large_values(True)
+        if options.get('compress'):
+            self.wire.set_compression(True)
+        op.succeed(options)
+
+    def _run_execute(self, op, args, stdout_cb, stderr_cb):
+        window = None
+        if self.windowed is not False:
+            window = self.execute_window
+        self.wire.send_box(
+                self._execute_request(args, stdout_cb, stderr_cb, window))
+        box = yield None
+        if window and self._window_failed(box):
+            window = None
+            self.wire.send_box(
+                    self._execute_request(args, stdout_cb, stderr_cb, None))
+            box = yield None
+
+        consumed = 0
+        while 1:
+            if window and box and 'error' in box:
+                # version 2 ends a failed operation with an empty box, too
+                self.wire.send_box({})
+            self.handle_errors(box)
+            if 'stream' in box:
+                stream = box['stream']
+                if 'data' not in box:
+                    raise ProtocolError('stream box without data')
+                data = box['data']
+                if stdout_cb and stream == 'stdout':
+                    stdout_cb(data)
+                elif stderr_cb and stream == 'stderr':
+                    stderr_cb(data)
+                else:
+                    raise ProtocolError('got data for unknown stream')
+                if window:
+                    consumed += len(data)
+                    if consumed >= window / 2:
+                        self.wire.send_box({'credit': consumed})
+                        consumed = 0
+            elif 'result' in box:
+                try:
+                    result = int(box['result'])
+                except ValueError:
+                    raise ProtocolError('invalid result value')
+                if window:
+                    self.wire.send_box({})
+                op.succeed(result)
+                return
+            else:
+                raise ProtocolError('unknown response box')
+            box = yield None
+
+    def _run_send(self, op, src, dest):
+        srcfile = open(src, "rb")
+
+        error_handling = {
+            'fileexists': FileExistsError,
+            'openfailed': OpenFailedError,
+            'failed': FailedError,
+        }
+
+        self.wire.send_box({
+            'meth': 'send',
+            'version': 1,
+            'dest': dest,
+        })
+
+        box = yield None
+        self.handle_errors(box, **error_handling)
+
+        # generate data only as fast as the transport can write it
+        chunk_size = self.wire.chunk_size()
+        while 1:
+            if self.wire.pending_output() >= self.low_water:
+                yield DRAIN
+                continue
+            data = srcfile.read(chunk_size)
+            if not data:
+                break
+            self.wire.send_box({
+                'data': data,
+            })
+        srcfile.close()
+
+        self.wire.send_box({})
+        box = yield None
+        self.handle_errors(box, **error_handling)
+        op.succeed(None)
+
+    def _run_fetch(self, op, src, dest):
+        if os.path.exists(dest):
+            raise FileExistsError("Destination already exists on the master")
+
+        destfile = open(dest, "wb")
+
+        error_handling = {
+            'notfound': NotFoundError,
+            'openfailed': OpenFailedError,
+            'failed': FailedError,
+        }
+
+        self.wire.send_box({
+            'meth': 'fetch',
+            'version': 1,
+            'src': src,
+        })
+
+        error = None
+        while True:
+            box = yield None
+            if box == {}:
+                break
+            self.handle_errors(box, **error_handling)
+            if 'data' not in box:
+                raise ProtocolError('not a data box')
+            # after a write error, read and ignore the rest of the data
+            if error is None:
+                try:
+                    destfile.write(box['data'])
+                except IOError, e:
+                    error = e
+        destfile.close()
+
+        if error is not None:
+            raise error
+        op.succeed(None)
+
+    ## transport interface
+
+    def box_received(self, box):
+        if self.current is None:
+            return # nothing is expecting a box; ignore it
+        if self.waiting_for is DRAIN:
+            self._resume(ProtocolError('unexpected box during operation'),
+                         throw=True)
+        else:
+            self._resume(box)
+        self._next()
+
+    def output_drained(self):
+        if self.current is not None and self.waiting_for is DRAIN:
+            self._resume(None)
+            self._next()
+
+    def connection_lost(self):
+        self.connected = False
+        if self.current is not None:
+            self._resume(ProtocolError("unexpected EOF during operation"),
+                         throw=True)
+        queue, self.queue = self.queue, []
+        for run, args, op in queue:
+            op.fail(ProtocolError("connection lost"))
+
+    ## utilities
+
+    def _start(self, run, *args):
+        op = Operation()
+        if not self.connected:
+            op.fail(ProtocolError("connection lost"))
+            return op
+        self.queue.append((run, args, op))
+        self._next()
+        return op
+
+    def _next(self):
+        while self.current is None and self.queue:
+            run, args, op = self.queue.pop(0)
+            self.current = (run(op, *args), op)
+            self._resume(None)
+
+    def _resume(self, value, throw=False):
+        gen, op = self.current
+        try:
+            if throw:
+                self.waiting_for = gen.throw(value)
+            else:
+                self.waiting_for = gen.send(value)
+            return
+        except StopIteration:
+            error = None
+        except Exception, e:
+            error = e
+
+        self.current = None
+        self.waiting_for = None
+        if op.done:
+            # an exception raised by one of the operation's callbacks
+            if error is not None:
+                raise error
+        elif error is not None:
+            op.fail(error)
+        else:
+            op.succeed(None)
+
+
+class AsyncConnection(asyncore.dispatcher):
+    """
+
+    An asyncore dispatcher connecting an AsyncRemoteSlave, available as the
+    'slave' attribute, to a connected socket.  Use asyncore.loop to run it.
+
+    """
+
+    def __init__(self, sock, map=None):
+        asyncore.dispatcher.__init__(self, sock, map)
+        self.wire = AsyncWire()
+        self.slave = AsyncRemoteSlave(self.wire)
+        self.outbuf = ''
+        self.outpos = 0
+
+    def writable(self):
+        return self.outpos < len(self.outbuf) or self.wire.pending_output()
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return # recv has already called handle_close
+        try:
+            boxes = self.wire.data_received(data)
+        except Error:
+            self.handle_close()
+            return
+        for box in boxes:
+            self.slave.box_received(box)
+
+    def handle_write(self):
+        if self.outpos == len(self.outbuf):
+            self.outbuf = self.wire.take_output()
+            self.outpos = 0
+        self.outpos += self.send(buffer(self.outbuf, self.outpos))
+        if self.outpos == len(self.outbuf):
+            self.slave.output_drained()
+
+    def handle_close(self):
+        self.close()
+        self.slave.connection_lost()
+
+
+class AsyncListener(asyncore.dispatcher):
+    """
+
+    An asyncore dispatcher which listens for slave connections on PORT, and
+    calls NEW_SLAVE_CB with a new AsyncRemoteSlave for each.
+
+    """
+
+    def __init__(self, port, new_slave_cb, host='', map=None):
+        asyncore.dispatcher.__init__(self, map=map)
+        self.socket_map = map
+        self.new_slave_cb = new_slave_cb
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(50)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is None:
+            return
+        sock, addr = pair
+        conn = AsyncConnection(sock, map=self.socket_map)
+        self.new_slave_cb(conn.slave)
@@ -0,0 +1,287 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_eventloop -*-
+
+import errno
+import select
+import time
+import socket
+
+from remsh.wire import AsyncWire, Error as WireError
+from remsh.xport.base import Error as XportError
+from remsh.xport.sock import SocketXport
+from remsh.master.asyncremote import AsyncRemoteSlave
+
+
+class _Connection(object):
+    """
+
+    A transport, the AsyncWire carrying boxes over it, and the protocol object
+    (usually an AsyncRemoteSlave) which handles those boxes.
+
+    """
+
+    def __init__(self, loop, xport, wire, protocol):
+        self.loop = loop
+        self.xport = xport
+        self.wire = wire
+        self.protocol = protocol
+
+    def wants_write(self):
+        return self.xport.wants_write() or self.wire.pending_output()
+
+    def handle_read(self):
+        try:
+            data = self.xport.read_nonblocking()
+            if data is None:
+                return
+            if not data:
+                self.wire.eof_received()
+                self.handle_close()
+                return
+            boxes = self.wire.data_received(data)
+        except (XportError, WireError, EOFError):
+            self.handle_close()
+            return
+        for box in boxes:
+            self.protocol.box_received(box)
+        # send any responses right away, rather than waiting for another trip
+        # through the loop
+        if self.wants_write() and self.loop.handlers.get(self.fd) is self:
+            self.handle_write()
+
+    def handle_write(self):
+        xport = self.xport
+        try:
+            # output is taken from the wire only once the transport has written
+            # what it already had, so that the wire's pending output still
+            # reflects any backlog (see AsyncRemoteSlave.low_water)
+            if xport.wants_write():
+                xport.flush_nonblocking()
+            elif self.wire.pending_output():
+                xport.write_nonblocking(self.wire.take_output())
+        except XportError:
+            self.handle_close()
+            return
+        if not xport.wants_write() and not self.wire.pending_output():
+            self.protocol.output_drained()
+
+    def handle_close(self):
+        self.loop.remove(self)
+        try:
+            self.xport.close()
+        except XportError:
+            pass
+        self.protocol.connection_lost()
+
+
+class _Listener(object):
+    """
+
+    A listening socket, which calls NEW_SLAVE_CB with a new AsyncRemoteSlave
+    for each connection it accepts.
+
+    """
+
+    def __init__(self, loop, sock, new_slave_cb):
+        self.loop = loop
+        self.sock = sock
+        self.new_slave_cb = new_slave_cb
+
+    def wants_write(self):
+        return False
+
+    def handle_read(self):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error, e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR,
+                           errno.ECONNABORTED):
+                return
+            raise
+        sock.setblocking(1)
+        self.new_slave_cb(self.loop.add_slave(SocketXport(sock)))
+
+    def handle_close(self):
+        self.loop.remove(self)
+        self.sock.close()
+
+
+class EventLoop(object):
+    """
+
+    Drive any number of connections from a single thread.  Each connection's
+    transport must support the non-blocking methods of the Xport interface
+    (fileno, read_nonblocking, write_nonblocking, flush_nonblocking and
+    wants_write), as shown by its 'can_poll' attribute: SocketXport,
+    UnixXport and FDXport do, while TLSXport, LocalXport and ShmXport do
+    not.  The loop uses poll where it is available, and select
+    otherwise.
+
+    Connections are added with 'add_slave' or 'add', or accepted with
+    'listen'.  Operations may be started on a connection's AsyncRemoteSlave at
+    any time in the loop's thread, including from operation callbacks.
+
+    """
+
+    def __init__(self):
+        # fd: handler
+        self.handlers = {}
+        self.stopping = False
+        if hasattr(select, 'poll'):
+            self.poller = select.poll()
+        else:
+            self.poller = None
+        # fd: event mask currently registered with the poller
+        self.registered = {}
+
+    def add_slave(self, xport):
+        """
+        Add a connection to a slave over XPORT, and return the AsyncRemoteSlave
+        for it.
+        """
+        wire = AsyncWire()
+        slave = AsyncRemoteSlave(wire)
+        self.add(xport, wire, slave)
+        return slave
+
+    def add(self, xport, wire, protocol):
+        """
+        Add a connection over XPORT.  Boxes arriving on the AsyncWire WIRE are
+        passed to PROTOCOL's box_received method, which is also told when its
+        output has drained and when the connection is lost, as for an
+        AsyncRemoteSlave.  Raises ValueError if XPORT cannot be used without
+        blocking.
+        """
+        if not getattr(xport, 'can_poll', False):
+            raise ValueError("%s cannot be used without blocking"
+                             % (xport.__class__.__name__,))
+        conn = _Connection(self, xport, wire, protocol)
+        self._add_handler(xport.fileno(), conn)
+        return conn
+
+    def listen(self, port, new_slave_cb, host=''):
+        """
+        Listen for slave connections on PORT, calling NEW_SLAVE_CB with the
+        AsyncRemoteSlave for each.  Returns the port number, which is useful
+        when PORT is 0.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+        sock.listen(128)
+        sock.setblocking(0)
+        self._add_handler(sock.fileno(), _Listener(self, sock, new_slave_cb))
+        return sock.getsockname()[1]
+
+    def remove(self, handler):
+        if self.handlers.get(handler.fd) is not handler:
+            return
+        del self.handlers[handler.fd]
+        if handler.fd in self.registered:
+            del self.registered[handler.fd]
+            if self.poller:
+                self.poller.unregister(handler.fd)
+
+    def close(self):
+        """
+        Close all connections and listeners.
+        """
+        for handler in self.handlers.values():
+            handler.handle_close()
+
+    def stop(self):
+        """
+        Make 'run' return after the current iteration.
+        """
+        self.stopping = True
+
+    def run(self, until=None, timeout=None):
+        """
+        Run until 'stop' is called or no handlers remain, or, if UNTIL is
+        given, until it returns true (it is checked after each iteration).
+        Returns false if TIMEOUT seconds elapse first.
+        """
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.stopping = False
+        while self.handlers and not self.stopping:
+            if until and until():
+                return True
+            if timeout is None:
+                self.run_once()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.run_once(remaining)
+        return True
+
+    def run_once(self, timeout=None):
+        """
+        Wait up to TIMEOUT seconds (forever if None) for activity, and handle
+        it.
+        """
+        for fd, readable, writable in self._wait(timeout):
+            handler = self.handlers.get(fd)
+            if handler is not None and writable:
+                handler.handle_write()
+            # the write may have closed the connection
+            handler = self.handlers.get(fd)
+            if handler is not None and readable:
+                handler.handle_read()
+
+    ## utilities
+
+    def _add_handler(self, fd, handler):
+        handler.fd = fd
+        self.handlers[fd] = handler
+
+    def _wait(self, timeout):
+        # A connection's interest in writing can change whenever an operation
+        # is started, so it is checked for every connection on each
+        # iteration; this is no worse than poll itself, which also considers
+        # every descriptor.
+        if self.poller:
+            poller = self.poller
+            registered = self.registered
+            for fd, handler in self.handlers.iteritems():
+                mask = select.POLLIN
+                if handler.wants_write():
+                    mask |= select.POLLOUT
+                if registered.get(fd) != mask:
+                    if fd in registered:
+                        poller.modify(fd, mask)
+                    else:
+                        poller.register(fd, mask)
+                    registered[fd] = mask
+
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            while 1:
+                try:
+                    events = poller.poll(timeout)
+                    break
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            # errors and hangups are reported as readable, so that the read
+            # finds the EOF or error
+            return [(fd, bool(ev & ~select.POLLOUT), bool(ev & select.POLLOUT))
+                    for fd, ev in events]
+        else:
+            rfds = self.handlers.keys()
+            wfds = [fd for fd, handler in self.handlers.iteritems()
+                    if handler.wants_write()]
+            while 1:
+                try:
+                    r, w, x = select.select(rfds, wfds, [], timeout)
+                    break
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+            w = set(w)
+            events = [(fd, True, fd in w) for fd in r]
+            events.extend([(fd, False, True) for fd in w.difference(r)])
+            return events
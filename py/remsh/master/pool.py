@@ -0,0 +1,451 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_pool -*-
+
+import sys
+import time
+import socket
+import threading
+
+from remsh.xport.sock import SocketXport
+from remsh.wire import Wire
+from remsh.master.remote import RemoteSlave, NotFoundError, FileExistsError, \
+                               OpenFailedError, FailedError
+
+# exceptions which a slave reports after the whole response has been read, so
+# that the connection can still be used
+OPERATION_ERRORS = (NotFoundError, FileExistsError, OpenFailedError,
+                    FailedError, RuntimeError)
+
+
+class PoolTimeoutError(Exception):
+    "No slave became available in time"
+
+
+def default_xport_factory(sock):
+    return SocketXport(sock, keepalive=True)
+
+
+class _PoolEntry(object):
+    """
+
+    A connected slave: the RemoteSlave for its connection, the number of
+    handles lent out, and the idle handles ready for reuse.
+
+    """
+
+    def __init__(self, name, slave, capacity, channels):
+        self.name = name
+        self.slave = slave
+        self.capacity = capacity
+        self.channels = channels
+        self.in_use = 0
+        self.idle = []
+        self.alive = True
+        self.closed = False
+        self.last_ok = time.time()
+        # held while a liveness check is running
+        self.check_lock = threading.Lock()
+
+    def dead(self):
+        return not self.alive or (self.channels and self.slave.mux.eof)
+
+
+class SlavePool(object):
+    """
+
+    A set of connected slaves, from which callers check out RemoteSlave
+    objects to run their operations, and to which they return them afterward.
+    Connections are reused for many jobs, so the cost of connecting and
+    negotiating wire options is paid once per slave.
+
+    Each slave runs at most MAX_PER_SLAVE jobs at a time.  If this is more
+    than one, each job gets its own channel, and channels are kept open for
+    reuse; slaves which do not support channels run one job at a time.
+    Channels share the slave's working directory, so jobs which may run
+    together must not call set_cwd, and should give full paths instead.
+    WIRE_OPTIONS are passed to set_wire_options for each new connection.
+    XPORT_FACTORY turns an accepted socket into a transport, for example to
+    use TLS.
+
+    A background thread checks every CHECK_INTERVAL seconds that each slave
+    which has not recently completed an operation is still responding, and
+    drops it if it is not.  Slaves whose connection is lost are also dropped
+    when that is noticed.  A check can only fail once the transport notices a
+    vanished peer, which is why the default transport enables TCP keepalive.
+
+    """
+
+    check_interval = 30.0
+
+    def __init__(self, max_per_slave=1, wire_options=None,
+                 xport_factory=default_xport_factory):
+        self.max_per_slave = max_per_slave
+        if wire_options is None:
+            wire_options = {'large_values': True}
+        self.wire_options = wire_options
+        self.xport_factory = xport_factory
+
+        self.cond = threading.Condition(threading.Lock())
+        # name: _PoolEntry
+        self.entries = {}
+        # handle: _PoolEntry, for checked-out handles
+        self.lent = {}
+        self.closed = False
+        self.listener = None
+        self.acceptor = None
+        self.stopping = threading.Event()
+        self.checker = None
+
+    ## adding slaves
+
+    def listen(self, port, host=''):
+        """
+        Accept slave connections on PORT in a background thread, and start
+        checking liveness.  Returns the port number, which is useful when
+        PORT is 0.
+        """
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(128)
+        self.acceptor = self._start_thread(self._accept_loop, self.listener)
+        self.start_checking()
+        return self.listener.getsockname()[1]
+
+    def add(self, xport, name):
+        """
+        Set up a connection to a slave over XPORT, and add it to the pool
+        under NAME.  Returns false if the slave could not be set up.
+        """
+        slave = RemoteSlave(Wire(xport))
+        slave.hostname = name
+        # the pool decides whether to use channels
+        options = dict(self.wire_options)
+        options['channels'] = self.max_per_slave > 1
+        try:
+            options = slave.set_wire_options(**options)
+        except Exception, e:
+            print >>sys.stderr, "could not set up slave %s: %s" % (name, e)
+            slave.close()
+            return False
+
+        channels = bool(options.get('channels'))
+        if channels:
+            capacity = self.max_per_slave
+        else:
+            capacity = 1
+        entry = _PoolEntry(name, slave, capacity, channels)
+
+        self.cond.acquire()
+        try:
+            if self.closed:
+                slave.close()
+                return False
+            old = self.entries.get(name)
+            if old:
+                old.alive = False
+            self.entries[name] = entry
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if old:
+            self._close_entry(old)
+        return True
+
+    ## using slaves
+
+    def names(self):
+        """
+        Return the names of the connected slaves.
+        """
+        self.cond.acquire()
+        try:
+            return [name for name, entry in self.entries.iteritems()
+                    if not entry.dead()]
+        finally:
+            self.cond.release()
+
+    def wait_for_slaves(self, count, timeout=None):
+        """
+        Wait until at least COUNT slaves are connected.  Raises
+        PoolTimeoutError after TIMEOUT seconds, if given.
+        """
+        self.cond.acquire()
+        try:
+            def enough():
+                self._remove_dead()
+                return len(self.entries) >= count
+            self._wait(enough, timeout)
+        finally:
+            self.cond.release()
+
+    def checkout(self, name=None, timeout=None):
+        """
+        Return a RemoteSlave for a job on the slave NAME, or on the least busy
+        slave if NAME is None, waiting until one has capacity.  Raises
+        PoolTimeoutError after TIMEOUT seconds, if given.  The slave's name is
+        in the 'hostname' attribute of the result.  Return it with checkin
+        when the job is finished.
+        """
+        self.cond.acquire()
+        try:
+            found = []
+
+            def available():
+                self._remove_dead()
+                if name is None:
+                    entries = self.entries.values()
+                else:
+                    entries = [self.entries[name]] if name in self.entries \
+                              else []
+                entries = [e for e in entries if e.in_use < e.capacity]
+                if entries:
+                    entries.sort(key=lambda e: e.in_use)
+                    found.append(entries[0])
+                    return True
+                return False
+            self._wait(available, timeout)
+
+            entry = found[0]
+            entry.in_use += 1
+            if entry.idle:
+                handle = entry.idle.pop()
+            elif not entry.channels:
+                handle = entry.slave
+            else:
+                handle = entry.slave.open_channel()
+                handle.hostname = entry.name
+            self.lent[handle] = entry
+            return handle
+        finally:
+            self.cond.release()
+
+    def checkin(self, handle, broken=False):
+        """
+        Return a RemoteSlave from checkout to the pool.  If BROKEN is true,
+        the state of its connection is unknown (for example, an operation was
+        interrupted), so it is not reused.
+        """
+        to_close = None
+        self.cond.acquire()
+        try:
+            entry = self.lent.pop(handle)
+            entry.in_use -= 1
+            if entry.dead():
+                # if it is still listed, _remove_dead closes it below
+                if (not entry.in_use
+                        and self.entries.get(entry.name) is not entry):
+                    self._start_thread(self._close_entry, entry)
+            elif not broken:
+                entry.last_ok = time.time()
+                entry.idle.append(handle)
+            elif entry.channels:
+                # only this channel is in doubt
+                to_close = handle
+            else:
+                entry.alive = False
+            self._remove_dead()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if to_close:
+            to_close.close()
+
+    def run(self, fn, name=None, timeout=None):
+        """
+        Check out a slave as for checkout, call FN with it, and check it back
+        in, returning FN's result.  If FN raises an exception other than an
+        error reported by the slave, the slave is checked in as broken.
+        """
+        handle = self.checkout(name, timeout)
+        broken = True
+        try:
+            try:
+                rv = fn(handle)
+            except OPERATION_ERRORS:
+                broken = False
+                raise
+            broken = False
+            return rv
+        finally:
+            self.checkin(handle, broken)
+
+    ## liveness
+
+    def start_checking(self):
+        """
+        Start the background liveness checks.
+        """
+        if not self.checker:
+            self.checker = self._start_thread(self._check_loop)
+
+    def check(self):
+        """
+        Check each slave which has not completed an operation within
+        check_interval, and drop those which do not respond.
+        """
+        self.cond.acquire()
+        try:
+            self._remove_dead()
+            now = time.time()
+            entries = [e for e in self.entries.values()
+                       if now - e.last_ok >= self.check_interval]
+        finally:
+            self.cond.release()
+
+        for entry in entries:
+            if not entry.check_lock.acquire(False):
+                continue # already being checked
+            try:
+                self._check_entry(entry)
+            finally:
+                entry.check_lock.release()
+
+    def close(self):
+        """
+        Stop accepting slaves, and close all connections.
+        """
+        self.stopping.set()
+        self.cond.acquire()
+        try:
+            self.closed = True
+            entries = self.entries.values()
+            for entry in entries:
+                entry.alive = False
+            self.entries = {}
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+        if self.listener:
+            # shutting the socket down wakes the accepting thread
+            try:
+                self.listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.listener.close()
+        for thd in self.acceptor, self.checker:
+            if thd and thd is not threading.currentThread():
+                thd.join()
+        for entry in entries:
+            self._close_entry(entry)
+
+    ## utilities
+
+    def _start_thread(self, target, *args):
+        thd = threading.Thread(target=target, args=args)
+        thd.setDaemon(1)
+        thd.start()
+        return thd
+
+    def _accept_loop(self, listener):
+        while not self.closed:
+            try:
+                sock, addr = listener.accept()
+            except socket.error:
+                if self.closed:
+                    return
+                continue
+            # set up each slave in its own thread, so that a slow handshake
+            # does not hold up the others
+            self._start_thread(self._setup_slave, sock, addr)
+
+    def _setup_slave(self, sock, addr):
+        try:
+            xport = self.xport_factory(sock)
+        except Exception, e:
+            print >>sys.stderr, "could not set up slave %s: %s" % (addr, e)
+            sock.close()
+            return
+        self.add(xport, "%s:%d" % addr[:2])
+
+    def _check_loop(self):
+        while 1:
+            self.stopping.wait(self.check_interval)
+            if self.stopping.isSet():
+                return
+            self.check()
+
+    def _check_entry(self, entry):
+        if entry.channels:
+            # channel 0 is not lent out, so it can be used at any time
+            handle = entry.slave
+        else:
+            try:
+                handle = self.checkout(entry.name, timeout=0)
+            except PoolTimeoutError:
+                return # busy, so evidently working
+            if self.lent.get(handle) is not entry:
+                # the slave was replaced by a new connection
+                self.checkin(handle)
+                return
+
+        ok = True
+        try:
+            handle.ping()
+        except Exception:
+            ok = False
+
+        if entry.channels:
+            self.cond.acquire()
+            try:
+                if ok:
+                    entry.last_ok = time.time()
+                else:
+                    entry.alive = False
+                self._remove_dead()
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+        else:
+            self.checkin(handle, broken=not ok)
+
+    def _remove_dead(self):
+        # called with the lock held; a connection is closed in another thread
+        # once none of its handles are in use (see checkin)
+        for name, entry in self.entries.items():
+            if entry.dead():
+                entry.alive = False
+                del self.entries[name]
+                if not entry.in_use:
+                    self._start_thread(self._close_entry, entry)
+
+    def _close_entry(self, entry):
+        self.cond.acquire()
+        try:
+            if entry.closed:
+                return
+            entry.closed = True
+        finally:
+            self.cond.release()
+        for handle in entry.idle:
+            try:
+                handle.close()
+            except Exception:
+                pass
+        entry.idle = []
+        try:
+            if entry.channels:
+                # closes the connection, not just channel 0
+                entry.slave.mux.close()
+            else:
+                entry.slave.close()
+        except Exception:
+            pass
+
+    def _wait(self, predicate, timeout):
+        # called with the lock held
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while not predicate():
+            if self.closed:
+                raise PoolTimeoutError("pool is closed")
+            if timeout is None:
+                self.cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise PoolTimeoutError("no slave available")
+                self.cond.wait(remaining)
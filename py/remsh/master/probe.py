@@ -0,0 +1,224 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_probe -*-
+
+import os
+import sys
+import time
+import threading
+
+from remsh.master.pool import PoolTimeoutError
+
+# chunk sizes suggested by LinkEstimate.chunk_size are kept within these
+# bounds
+MIN_CHUNK_SIZE = 65536
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def measure(slave, size=None, count=3):
+    """
+    Measure the link to SLAVE, a RemoteSlave.  The round-trip time is the
+    fastest of COUNT empty pings; the throughput in each direction is found
+    by sending, then receiving, SIZE bytes (by default, as much as fits in
+    one box).  Returns a dictionary with keys 'rtt' (seconds), 'send_rate'
+    and 'fetch_rate' (bytes per second, master to slave and slave to master).
+    """
+    if size is None:
+        size = slave.wire.chunk_size()
+    rtt = min([slave.ping() for i in range(count)])
+
+    def rate(elapsed):
+        # the time beyond a round trip is the time to move the data
+        return size / max(elapsed - rtt, 1e-6)
+
+    return {
+        'rtt': rtt,
+        'send_rate': rate(slave.ping(data=os.urandom(size))),
+        'fetch_rate': rate(slave.ping(reply_size=size)),
+    }
+
+
+class LinkEstimate(object):
+    """
+
+    Running estimates of the round-trip time and throughput of the link to
+    one slave, from the samples returned by 'measure'.  Each new sample is
+    given weight ALPHA, so older samples are gradually forgotten.
+
+    """
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.rtt = None
+        self.send_rate = None
+        self.fetch_rate = None
+        self.samples = 0
+        self.updated = None
+
+    def add(self, sample):
+        for k in 'rtt', 'send_rate', 'fetch_rate':
+            old = getattr(self, k)
+            if old is None:
+                new = sample[k]
+            else:
+                new = old + self.alpha * (sample[k] - old)
+            setattr(self, k, new)
+        self.samples += 1
+        self.updated = time.time()
+
+    def transfer_time(self, size, fetch=False):
+        """
+        Return the expected time to move SIZE bytes to the slave, or from it
+        if FETCH is true.
+        """
+        if fetch:
+            rate = self.fetch_rate
+        else:
+            rate = self.send_rate
+        return self.rtt + size / rate
+
+    def chunk_size(self, fetch=False):
+        """
+        Return a suggested chunk size for transfers: the amount of data in
+        flight over one round trip, rounded up to a power of two.
+        """
+        if fetch:
+            rate = self.fetch_rate
+        else:
+            rate = self.send_rate
+        size = MIN_CHUNK_SIZE
+        while size < rate * self.rtt and size < MAX_CHUNK_SIZE:
+            size *= 2
+        return size
+
+    def snapshot(self):
+        return {
+            'rtt': self.rtt,
+            'send_rate': self.send_rate,
+            'fetch_rate': self.fetch_rate,
+            'samples': self.samples,
+            'updated': self.updated,
+        }
+
+
+class Prober(object):
+    """
+
+    Periodically measure the link to each slave in a SlavePool, keeping a
+    LinkEstimate for each.  A slave is only measured when the pool has a
+    handle free for it, so probing never delays jobs.  Probes are made every
+    INTERVAL seconds once started, or whenever 'probe_all' is called; SIZE
+    and COUNT are passed to 'measure'.
+
+    A Prober has a 'snapshot' method, so it can be given to a StatsDumper.
+
+    """
+
+    def __init__(self, pool, interval=60.0, size=None, count=3):
+        self.pool = pool
+        self.interval = interval
+        self.size = size
+        self.count = count
+        self.lock = threading.Lock()
+        # name: LinkEstimate
+        self.estimates = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while 1:
+            self.probe_all()
+            self.stopping.wait(self.interval)
+            if self.stopping.isSet():
+                break
+
+    def probe_all(self):
+        """
+        Measure each slave in the pool which is not busy, and forget slaves
+        which have left the pool.
+        """
+        names = self.pool.names()
+        for name in names:
+            if self.stopping.isSet():
+                break
+            self.probe(name)
+
+        self.lock.acquire()
+        try:
+            for name in self.estimates.keys():
+                if name not in names:
+                    del self.estimates[name]
+        finally:
+            self.lock.release()
+
+    def probe(self, name):
+        """
+        Measure the slave NAME now, if it is not busy.  Returns true if it
+        was measured.
+        """
+        fn = lambda slave: measure(slave, self.size, self.count)
+        try:
+            sample = self.pool.run(fn, name=name, timeout=0)
+        except PoolTimeoutError:
+            return False
+        except Exception, e:
+            print >>sys.stderr, "could not probe slave %s: %s" % (name, e)
+            return False
+
+        self.lock.acquire()
+        try:
+            if name not in self.estimates:
+                self.estimates[name] = LinkEstimate()
+            self.estimates[name].add(sample)
+        finally:
+            self.lock.release()
+        return True
+
+    def estimate(self, name):
+        """
+        Return the LinkEstimate for the slave NAME, or None if it has not been
+        measured.
+        """
+        self.lock.acquire()
+        try:
+            return self.estimates.get(name)
+        finally:
+            self.lock.release()
+
+    def fastest(self, size, fetch=False, names=None):
+        """
+        Return the name of the slave, of NAMES or of all measured slaves,
+        which is expected to move SIZE bytes soonest, or None if none of them
+        have been measured.
+        """
+        self.lock.acquire()
+        try:
+            if names is None:
+                names = self.estimates.keys()
+            timed = [(self.estimates[name].transfer_time(size, fetch), name)
+                     for name in names if name in self.estimates]
+        finally:
+            self.lock.release()
+        if not timed:
+            return None
+        return min(timed)[1]
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return dict([(name, estimate.snapshot())
+                         for name, estimate in self.estimates.iteritems()])
+        finally:
+            self.lock.release()
@@ -5,6 +5,12 @@
 
 import sys
 import os
+import time
+import hashlib
+import tarfile
+
+from remsh import delta, partial, sparse, tree
+from remsh.mux import Multiplexer
 
 
 class ProtocolError(Exception):
@@ -27,6 +33,28 @@ class FailedError(ProtocolError):
     "An operation on the slave failed (failed)"
 
 
+# buffer size for copying files locally
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+def file_digest(filename, algorithm='sha256'):
+    """
+    Return the hex digest of the contents of the local file FILENAME, as the
+    'hash' operation computes it on the slave.
+    """
+    h = hashlib.new(algorithm)
+    f = open(filename, "rb")
+    try:
+        while 1:
+            data = f.read(COPY_BUFFER_SIZE)
+            if not data:
+                break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+
 # utility function
 def bool(b):
     if b:
@@ -34,72 +62,351 @@ def bool(b):
     return 'n'
 
 
-class RemoteSlave(object):
+class RemoteSlaveBase(object):
+    """
 
-    def __init__(self, wire):
-        self.wire = wire
+    Functionality shared by the blocking and non-blocking master-side
+    implementations of the operations: building request boxes and handling
+    responses.
 
-        # TODO: ???
-        self._disconnect_listeners = []
+    """
 
-    def set_cwd(self, cwd=None):
+    standard_errors = {
+        'invalid-meth': ProtocolError,
+        'version-too-new': ProtocolError,
+        'version-unsupported': ProtocolError,
+        'invalid': ProtocolError,
+        'unknown': RuntimeError,
+    }
+
+    def handle_errors(self, box, **more_errcodes):
+        if box is None:
+            raise ProtocolError("unexpected EOF during operation")
+
+        if 'error' not in box:
+            return
+
+        if 'errtag' not in box:
+            box['errtag'] = 'unknown'
+        errtag = box['errtag']
+        exc_cls = more_errcodes.get(errtag)
+        if not exc_cls:
+            exc_cls = self.standard_errors.get(errtag)
+        if not exc_cls:
+            exc_cls = self.standard_errors.get('unknown')
+
+        raise exc_cls(box['error'])
+
+    # Version 2 of execute adds flow control for the output: the master grants
+    # a window of this many bytes, and grants more as it consumes the output.
+    execute_window = 1024 * 1024
+
+    def _execute_request(self, args, stdout_cb, stderr_cb, window):
+        box = {
+            'meth': 'execute',
+            'version': 1,
+            'args': '\0'.join(args),
+            'want_stdout': bool(stdout_cb),
+            'want_stderr': bool(stderr_cb),
+        }
+        if window:
+            box['version'] = 2
+            box['window'] = window
+        return box
+
+    def _window_failed(self, box):
+        # Check the first response to a flow-controlled execute request,
+        # returning true if the caller should fall back to version 1
+        if box is None:
+            return False
+        if box.get('errtag') == 'version-too-new':
+            self.windowed = False
+            return True
+        if 'error' not in box:
+            self.windowed = True
+        return False
+
+    # Simple operations consist of a single request box and a single response
+    # box.  Each is implemented by an _op_* method which returns the request
+    # box and a function to handle the response, so that they can be run in
+    # different ways.
+
+    def _op_wireopts(self, large_values, compress, channels):
+        box = {
+            'meth': 'wireopts',
+            'version': 1,
+            'large_values': bool(large_values),
+        }
+        if compress:
+            box['compress'] = 'y'
+        if channels:
+            box['channels'] = 'y'
+
+        # the handler returns the options the slave agreed to; the caller is
+        # responsible for applying them to the wire
+        def handle(box):
+            # slaves without this operation simply keep the default options
+            if box and box.get('errtag') == 'invalid-meth':
+                return {}
+            self.handle_errors(box)
+            return dict([(k, True)
+                         for k in ('large_values', 'compress', 'channels')
+                         if box.get(k) == 'y'])
+        return box, handle
+
+    def _op_set_cwd(self, cwd=None):
         box = {
             'meth': 'set_cwd',
             'version': 1,
         }
         if cwd is not None:
             box['cwd'] = cwd
-        self.wire.send_box(box)
-        box = self.wire.read_box()
-        self.handle_errors(box,
-            notfound=NotFoundError)
-        return box['cwd']
 
-    def getenv(self):
+        def handle(box):
+            self.handle_errors(box,
+                notfound=NotFoundError)
+            return box['cwd']
+        return box, handle
+
+    def _op_getenv(self):
         box = {
             'meth': 'getenv',
             'version': 1,
         }
-        self.wire.send_box(box)
-        box = self.wire.read_box()
-        self.handle_errors(box)
-        return dict([(k[4:], v)
-                      for (k, v) in box.iteritems()
-                      if k.startswith('env_')])
 
-    def mkdir(self, dir):
+        def handle(box):
+            self.handle_errors(box)
+            return dict([(k[4:], v)
+                          for (k, v) in box.iteritems()
+                          if k.startswith('env_')])
+        return box, handle
+
+    def _op_ping(self, data='', reply_size=0):
+        box = {
+            'meth': 'ping',
+            'version': 1,
+        }
+        if data:
+            box['data'] = data
+        if reply_size:
+            box['reply_size'] = reply_size
+
+        def handle(box):
+            # an empty ping only needs an answer, so a slave without this
+            # operation will do
+            if (box and box.get('errtag') == 'invalid-meth'
+                    and not data and not reply_size):
+                return
+            self.handle_errors(box)
+            if len(box.get('data', '')) != reply_size:
+                raise ProtocolError('reply has the wrong size')
+        return box, handle
+
+    def _op_mkdir(self, dir):
         box = {
             'meth': 'mkdir',
             'version': 1,
             'dir': dir,
         }
-        self.wire.send_box(box)
-        box = self.wire.read_box()
-        self.handle_errors(box)
 
-    def execute(self, args=[], stdout_cb=None, stderr_cb=None):
+        def handle(box):
+            self.handle_errors(box)
+        return box, handle
+
+    def _op_remove(self, path):
         box = {
-            'meth': 'execute',
+            'meth': 'remove',
             'version': 1,
-            'args': '\0'.join(args),
-            'want_stdout': bool(stdout_cb),
-            'want_stderr': bool(stderr_cb),
+            'path': path,
         }
-        self.wire.send_box(box)
 
-        # loop, handling calls without answers, until we get 'finished'
-        def finished(rq):
-            result['result'] = int(rq['result'])
+        def handle(box):
+            self.handle_errors(box,
+                failed=FailedError)
+        return box, handle
+
+    def _op_rename(self, src, dest):
+        box = {
+            'meth': 'rename',
+            'version': 1,
+            'src': src,
+            'dest': dest,
+        }
+
+        def handle(box):
+            self.handle_errors(box,
+                fileexists=FileExistsError,
+                notfound=NotFoundError,
+                failed=FailedError)
+        return box, handle
+
+    def _op_copy(self, src, dest):
+        box = {
+            'meth': 'copy',
+            'version': 1,
+            'src': src,
+            'dest': dest,
+        }
+
+        def handle(box):
+            self.handle_errors(box,
+                fileexists=FileExistsError,
+                notfound=NotFoundError,
+                failed=FailedError)
+        return box, handle
+
+    def _op_hash(self, path, algorithm='sha256', size=None):
+        box = {
+            'meth': 'hash',
+            'version': 1,
+            'path': path,
+            'algorithm': algorithm,
+        }
+        if size is not None:
+            box['size'] = size
+
+        # the handler returns None if the file is not of the given size
+        def handle(box):
+            self.handle_errors(box,
+                notfound=NotFoundError,
+                openfailed=OpenFailedError,
+                failed=FailedError)
+            if 'digest' not in box and size is None:
+                raise ProtocolError('response did not include a digest')
+            return box.get('digest')
+        return box, handle
+
+    def _op_stat(self, path):
+        box = {
+            'meth': 'stat',
+            'version': 1,
+            'path': path,
+        }
+
+        def handle(box):
+            self.handle_errors(box,
+                failed=FailedError)
+            if 'result' not in box:
+                raise ProtocolError('response did not include a result')
+            return box['result']
+        return box, handle
+
+
+def timed(fn):
+    """
+    Decorator to record the latency of a RemoteSlave operation in the slave's
+    'stats' attribute, if it is set.
+    """
+    name = fn.__name__
+
+    def wrapper(self, *args, **kwargs):
+        if not self.stats:
+            return fn(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return fn(self, *args, **kwargs)
+        finally:
+            self.stats.record(name, time.time() - start)
+    wrapper.__name__ = name
+    wrapper.__doc__ = fn.__doc__
+    return wrapper
+
+
+class RemoteSlave(RemoteSlaveBase):
+
+    def __init__(self, wire):
+        self.wire = wire
+        self.mux = None
+        # a remsh.stats.OpStats instance, if latencies are wanted
+        self.stats = None
+        # whether send and fetch can pass file descriptors: None if unknown
+        self.fdpass = None
+        # whether execute supports flow control: None if unknown
+        self.windowed = None
+        # whether fetch can send raw file data: None if unknown
+        self.rawfetch = None
+        # whether send and fetch can skip holes: None if unknown
+        self.sparse = None
+
+        # TODO: ???
+        self._disconnect_listeners = []
+
+    @timed
+    def set_wire_options(self, large_values=False, compress=False,
+                         channels=False):
+        options = self._simple_op(
+                self._op_wireopts(large_values, compress, channels))
+        if options.get('large_values'):
+            self.wire.set_large_values(True)
+        if options.get('compress'):
+            self.wire.set_compression(True)
+        if options.get('channels'):
+            # this object's own operations continue on channel 0
+            self.mux = Multiplexer(self.wire)
+            self.mux.start()
+            self.wire = self.mux.channel(0)
+        return options
 
-        def data(rq):
-            if rq['stream'] == 'stdout':
-                stdout_cb(rq['data'])
-            elif rq['stream'] == 'stderr':
-                stderr_cb(rq['data'])
+    def open_channel(self):
+        """
+        Return a new RemoteSlave for the same slave, using a new channel.
+        Operations on different channels can run concurrently, in different
+        threads.  Close the channel with close() when it is no longer needed.
+        """
+        if not self.mux:
+            raise RuntimeError("channels have not been negotiated")
+        slave = RemoteSlave(self.mux.channel())
+        slave.mux = self.mux
+        slave.stats = self.stats
+        return slave
 
-        done = False
-        while not done:
+    def close(self):
+        self.wire.close()
+
+    @timed
+    def set_cwd(self, cwd=None):
+        return self._simple_op(self._op_set_cwd(cwd))
+
+    @timed
+    def getenv(self):
+        return self._simple_op(self._op_getenv())
+
+    @timed
+    def ping(self, data='', reply_size=0):
+        """
+        Make a round trip to the slave, sending DATA and receiving REPLY_SIZE
+        bytes, each at most wire.chunk_size().  Returns the elapsed time, in
+        seconds.
+        """
+        start = time.time()
+        self._simple_op(self._op_ping(data, reply_size))
+        return time.time() - start
+
+    @timed
+    def mkdir(self, dir):
+        return self._simple_op(self._op_mkdir(dir))
+
+    @timed
+    def execute(self, args=[], stdout_cb=None, stderr_cb=None):
+        window = None
+        if self.windowed is not False:
+            window = self.execute_window
+        self.wire.send_box(
+                self._execute_request(args, stdout_cb, stderr_cb, window))
+        box = self.wire.read_box()
+        if window and self._window_failed(box):
+            window = None
+            self.wire.send_box(
+                    self._execute_request(args, stdout_cb, stderr_cb, None))
             box = self.wire.read_box()
+
+        # loop, handling stream boxes, until we get a result; with flow
+        # control, output is acknowledged once the callbacks have returned
+        consumed = 0
+        while 1:
+            if window and box and 'error' in box:
+                # version 2 ends a failed operation with an empty box, too
+                self.wire.send_box({})
             self.handle_errors(box)
             if 'stream' in box:
                 stream = box['stream']
@@ -112,18 +419,50 @@ class RemoteSlave(object):
                     stderr_cb(data)
                 else:
                     raise ProtocolError('got data for unknown stream')
+                if window:
+                    consumed += len(data)
+                    if consumed >= window / 2:
+                        self.wire.send_box({'credit': consumed})
+                        consumed = 0
             elif 'result' in box:
                 try:
                     result = int(box['result'])
                 except ValueError:
                     raise ProtocolError('invalid result value')
-                done = True
+                if window:
+                    self.wire.send_box({})
+                return result
             else:
                 raise ProtocolError('unknown response box')
+            box = self.wire.read_box()
+
+    @timed
+    def hash(self, path, algorithm='sha256'):
+        """
+        Return the hex digest of the file PATH on the slave, computed with
+        ALGORITHM ('sha256', 'sha1' or 'md5').
+        """
+        return self._simple_op(self._op_hash(path, algorithm))
 
-        return result
+    @timed
+    def send(self, src, dest, skip_identical=False, resume=False):
+        """
+        Copy SRC on the master to DEST on the slave.  If SKIP_IDENTICAL is
+        true and DEST already has the same contents, nothing is sent.
+        Returns true if the copy was skipped.  If RESUME is true, the slave
+        keeps what it receives in a partial file until the copy is complete,
+        and a later send of the same file carries on from where an
+        interrupted one stopped.
+        """
+        if skip_identical and self._identical(src, dest):
+            return True
+        if resume:
+            self._send_resume(src, dest)
+        else:
+            self._send(src, dest)
+        return False
 
-    def send(self, src, dest):
+    def _send(self, src, dest):
         # the caller is responsible for any errors from open()
         srcfile = open(src, "rb")
 
@@ -133,6 +472,48 @@ class RemoteSlave(object):
             'failed': FailedError,
         }
 
+        # on the same host, just hand the slave the open file
+        if self.fdpass is not False and self.wire.can_pass_fds():
+            try:
+                self.wire.send_box_with_fd({
+                    'meth': 'send',
+                    'version': 2,
+                    'dest': dest,
+                }, srcfile.fileno())
+            finally:
+                srcfile.close()
+            box = self.wire.read_box()
+            if not self._fdpass_failed(box):
+                self.handle_errors(box, **error_handling)
+                return
+            srcfile = open(src, "rb")
+
+        # a file with holes is sent as its data extents, leaving holes in the
+        # slave's copy
+        if self.sparse is not False and sparse.has_holes(srcfile):
+            self.wire.send_box({
+                'meth': 'send',
+                'version': 4,
+                'dest': dest,
+            })
+            box = self.wire.read_box()
+            if not self._sparse_failed(box):
+                try:
+                    self.handle_errors(box, **error_handling)
+                    self.wire.cork()
+                    try:
+                        for box in sparse.boxes(srcfile,
+                                                self.wire.chunk_size()):
+                            self.wire.send_box(box)
+                        self.wire.send_box({})
+                    finally:
+                        self.wire.uncork()
+                finally:
+                    srcfile.close()
+                box = self.wire.read_box()
+                self.handle_errors(box, **error_handling)
+                return
+
         self.wire.send_box({
             'meth': 'send',
             'version': 1,
@@ -142,23 +523,93 @@ class RemoteSlave(object):
         box = self.wire.read_box()
         self.handle_errors(box, **error_handling)
 
-        # write the data
-        while 1:
-            data = srcfile.read(65535)
-            if not data:
-                break
-            self.wire.send_box({
-                'data': data,
-            })
+        # write the data, letting the wire batch boxes into larger writes; the
+        # final read_box flushes anything left over
+        chunk_size = self.wire.chunk_size()
+        self.wire.cork()
+        try:
+            while 1:
+                data = srcfile.read(chunk_size)
+                if not data:
+                    break
+                self.wire.send_box({
+                    'data': data,
+                })
 
-        self.wire.send_box({})
+            self.wire.send_box({})
+        finally:
+            self.wire.uncork()
         box = self.wire.read_box()
         self.handle_errors(box, **error_handling)
 
-    def fetch(self, src, dest):
+    def _send_resume(self, src, dest):
+        # the caller is responsible for any errors from open()
+        srcfile = open(src, "rb")
+        try:
+            error_handling = {
+                'fileexists': FileExistsError,
+                'openfailed': OpenFailedError,
+                'failed': FailedError,
+            }
+
+            self.wire.send_box({
+                'meth': 'send',
+                'version': 3,
+                'dest': dest,
+                'size': os.fstat(srcfile.fileno()).st_size,
+                'digest': file_digest(src),
+            })
+            box = self.wire.read_box()
+            if box and box.get('errtag') == 'version-too-new':
+                # an older slave cannot resume, so send the whole file
+                srcfile.close()
+                self._send(src, dest)
+                return
+            self.handle_errors(box, **error_handling)
+            try:
+                offset = int(box['offset'])
+            except (KeyError, ValueError):
+                raise ProtocolError('invalid offset')
+
+            chunk_size = self.wire.chunk_size()
+            srcfile.seek(offset)
+            self.wire.cork()
+            try:
+                while 1:
+                    data = srcfile.read(chunk_size)
+                    if not data:
+                        break
+                    self.wire.send_box({
+                        'data': data,
+                    })
+
+                self.wire.send_box({})
+            finally:
+                self.wire.uncork()
+            box = self.wire.read_box()
+            self.handle_errors(box, **error_handling)
+        finally:
+            srcfile.close()
+
+    @timed
+    def fetch(self, src, dest, skip_identical=False, resume=False):
+        """
+        Copy SRC on the slave to DEST on the master.  If SKIP_IDENTICAL is
+        true and DEST already has the same contents, nothing is sent.
+        Returns true if the copy was skipped.  RESUME is as for 'send', with
+        the partial file kept on the master.
+        """
         if os.path.exists(dest):
+            if skip_identical and self._identical(dest, src):
+                return True
             raise FileExistsError("Destination already exists on the master")
+        if resume:
+            self._fetch_resume(src, dest)
+        else:
+            self._fetch(src, dest)
+        return False
 
+    def _fetch(self, src, dest):
         # the caller is responsible for any errors from open()
         destfile = open(dest, "wb")
 
@@ -168,21 +619,78 @@ class RemoteSlave(object):
             'failed': FailedError,
         }
 
-        self.wire.send_box({
+        # on the same host, the slave hands over the open file
+        if self.fdpass is not False and self.wire.can_pass_fds():
+            self.wire.send_box({
+                'meth': 'fetch',
+                'version': 2,
+                'src': src,
+            })
+            box = self.wire.read_box()
+            if not self._fdpass_failed(box):
+                try:
+                    self.handle_errors(box, **error_handling)
+                    srcfile = os.fdopen(self.wire.take_fd(), "rb")
+                    try:
+                        sparse.copy(srcfile, destfile, COPY_BUFFER_SIZE)
+                    finally:
+                        srcfile.close()
+                finally:
+                    destfile.close()
+                return
+
+        # otherwise, the slave can send the file's bytes outside of boxes,
+        # straight from its file to the transport
+        if self.rawfetch is not False and self.wire.can_send_raw():
+            self.wire.send_box({
+                'meth': 'fetch',
+                'version': 3,
+                'src': src,
+            })
+            box = self.wire.read_box()
+            if not self._raw_failed(box):
+                try:
+                    self.handle_errors(box, **error_handling)
+                    try:
+                        length = int(box['length'])
+                    except (KeyError, ValueError):
+                        raise ProtocolError('invalid length')
+                    try:
+                        self.wire.read_raw(length, destfile)
+                    except IOError:
+                        # read the final box, then raise the exception
+                        self.wire.read_box()
+                        raise
+                    self.handle_errors(self.wire.read_box(), **error_handling)
+                finally:
+                    destfile.close()
+                return
+
+        # version 5 skips over holes in the file, and is otherwise the same
+        # as version 1
+        request = {
             'meth': 'fetch',
-            'version': 1,
+            'version': 5,
             'src': src,
-        })
+        }
+        if self.sparse is False:
+            request['version'] = 1
+        self.wire.send_box(request)
+        box = self.wire.read_box()
+        if request['version'] == 5 and self._sparse_failed(box):
+            request['version'] = 1
+            self.wire.send_box(request)
+            box = self.wire.read_box()
 
         while True:
-            box = self.wire.read_box()
             if box == {}:
                 break
             self.handle_errors(box, **error_handling)
-            if 'data' not in box:
-                raise ProtocolError('not a data box')
             try:
-                destfile.write(box['data'])
+                if not sparse.write_box(destfile, box):
+                    raise ProtocolError('not a data box')
+            except ValueError:
+                raise ProtocolError('invalid offset')
             except IOError:
                 # read and ignore the rest of the data, then raise the
                 # exception
@@ -191,89 +699,383 @@ class RemoteSlave(object):
                     self.handle_errors(box, **error_handling)
                     if box == {}:
                         raise
+            box = self.wire.read_box()
 
-    def remove(self, path):
-        box = {
-            'meth': 'remove',
-            'version': 1,
-            'path': path,
+        # a hole at the end of the file is made by extending it
+        try:
+            destfile.truncate()
+        finally:
+            destfile.close()
+
+    def _fetch_resume(self, src, dest):
+        error_handling = {
+            'notfound': NotFoundError,
+            'openfailed': OpenFailedError,
+            'failed': FailedError,
         }
-        self.wire.send_box(box)
+
+        self.wire.send_box({
+            'meth': 'fetch',
+            'version': 4,
+            'src': src,
+        })
         box = self.wire.read_box()
-        self.handle_errors(box,
-            failed=FailedError)
+        if box and box.get('errtag') == 'version-too-new':
+            # an older slave cannot resume, so fetch the whole file
+            self._fetch(src, dest)
+            return
+        self.handle_errors(box, **error_handling)
 
-    def rename(self, src, dest):
-        box = {
-            'meth': 'rename',
+        # the slave waits to hear where to start
+        try:
+            try:
+                size = int(box['size'])
+                destfile = partial.PartialFile(dest, size, box['digest'])
+            except (KeyError, ValueError):
+                raise ProtocolError('invalid size or digest')
+        except:
+            self.wire.send_box({'abort': 'y'})
+            raise
+
+        try:
+            self.wire.send_box({'offset': destfile.offset})
+            while True:
+                box = self.wire.read_box()
+                if box == {}:
+                    break
+                self.handle_errors(box, **error_handling)
+                if 'data' not in box:
+                    raise ProtocolError('not a data box')
+                try:
+                    destfile.write(box['data'])
+                except IOError:
+                    # read and ignore the rest of the data, then raise the
+                    # exception
+                    while True:
+                        box = self.wire.read_box()
+                        self.handle_errors(box, **error_handling)
+                        if box == {}:
+                            raise
+            try:
+                destfile.finish()
+            except ValueError, e:
+                raise FailedError(str(e))
+        finally:
+            destfile.close()
+
+    @timed
+    def sync(self, src, dest):
+        """
+        Make DEST on the slave a copy of SRC, replacing any existing file,
+        but sending only the parts of SRC that DEST does not already have.
+        Returns a dictionary giving the number of bytes sent ('literal') and
+        the number copied from the old file ('matched').
+        """
+        srcfile = open(src, "rb")
+        try:
+            error_handling = {
+                'openfailed': OpenFailedError,
+                'failed': FailedError,
+            }
+            self.wire.send_box({
+                'meth': 'sync',
+                'version': 1,
+                'dest': dest,
+            })
+
+            # the slave describes the blocks of its existing file
+            box = self.wire.read_box()
+            self.handle_errors(box, **error_handling)
+            try:
+                block_size = int(box['block_size'])
+            except (KeyError, ValueError):
+                raise ProtocolError('invalid block size')
+            sigs = []
+            while 1:
+                box = self.wire.read_box()
+                self.handle_errors(box, **error_handling)
+                if not box:
+                    break
+                try:
+                    sigs.extend(delta.unpack_signatures(box['sigs']))
+                except (KeyError, ValueError):
+                    raise ProtocolError('invalid signatures')
+
+            # and the master describes the new file in terms of them
+            result = {'literal': 0, 'matched': 0}
+            chunk_size = self.wire.chunk_size()
+            self.wire.cork()
+            try:
+                for item in delta.delta(srcfile, block_size, sigs):
+                    if type(item) is tuple:
+                        first, count = item
+                        self.wire.send_box({'block': first, 'count': count})
+                        result['matched'] += count * block_size
+                        continue
+                    for i in xrange(0, len(item), chunk_size):
+                        self.wire.send_box({'data': item[i:i + chunk_size]})
+                    result['literal'] += len(item)
+                self.wire.send_box({})
+            finally:
+                self.wire.uncork()
+
+            box = self.wire.read_box()
+            self.handle_errors(box, **error_handling)
+            return result
+        finally:
+            srcfile.close()
+
+    @timed
+    def send_tree(self, src, dest):
+        """
+        Copy the contents of the directory SRC on the master into the
+        directory DEST on the slave, creating it if necessary and replacing
+        existing files, as a single streamed operation.
+        """
+        error_handling = {
+            'fileexists': FileExistsError,
+            'openfailed': OpenFailedError,
+            'failed': FailedError,
+        }
+        self.wire.send_box({
+            'meth': 'send_tree',
             'version': 1,
-            'src': src,
             'dest': dest,
-        }
-        self.wire.send_box(box)
+        })
         box = self.wire.read_box()
-        self.handle_errors(box,
-            fileexists=FileExistsError,
-            notfound=NotFoundError,
-            failed=FailedError)
+        self.handle_errors(box, **error_handling)
 
-    def copy(self, src, dest):
-        box = {
-            'meth': 'copy',
+        exc_info = None
+        self.wire.cork()
+        try:
+            writer = tree.BoxWriter(self.wire)
+            try:
+                tree.pack(writer, src)
+                writer.flush()
+            except:
+                exc_info = sys.exc_info()
+            if exc_info:
+                # the slave stops unpacking, and replies with an error
+                self.wire.send_box({'abort': 'y'})
+            else:
+                self.wire.send_box({})
+        finally:
+            self.wire.uncork()
+
+        box = self.wire.read_box()
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.handle_errors(box, **error_handling)
+
+    @timed
+    def fetch_tree(self, src, dest):
+        """
+        Copy the contents of the directory SRC on the slave into the
+        directory DEST on the master, creating it if necessary and replacing
+        existing files, as a single streamed operation.
+        """
+        if os.path.exists(dest) and not os.path.isdir(dest):
+            raise FileExistsError("Destination is not a directory")
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+
+        error_handling = {
+            'notfound': NotFoundError,
+            'openfailed': OpenFailedError,
+            'failed': FailedError,
+        }
+        self.wire.send_box({
+            'meth': 'fetch_tree',
             'version': 1,
             'src': src,
-            'dest': dest,
-        }
-        self.wire.send_box(box)
+        })
+
+        reader = tree.BoxReader(self.wire,
+                lambda box: self.handle_errors(box, **error_handling))
+        exc_info = None
+        try:
+            tree.unpack(reader, dest)
+        except (EnvironmentError, ValueError, tarfile.TarError):
+            exc_info = sys.exc_info()
+        reader.drain()
+
+        # an error on the slave explains any problem with the archive
         box = self.wire.read_box()
-        self.handle_errors(box,
-            fileexists=FileExistsError,
-            notfound=NotFoundError,
-            failed=FailedError)
+        self.handle_errors(box, **error_handling)
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    @timed
+    def remove(self, path):
+        return self._simple_op(self._op_remove(path))
 
+    @timed
+    def rename(self, src, dest):
+        return self._simple_op(self._op_rename(src, dest))
+
+    @timed
+    def copy(self, src, dest):
+        return self._simple_op(self._op_copy(src, dest))
+
+    @timed
     def stat(self, path):
-        box = {
-            'meth': 'stat',
-            'version': 1,
-            'path': path,
-        }
-        self.wire.send_box(box)
-        box = self.wire.read_box()
-        self.handle_errors(box,
-            failed=FailedError)
-        if 'result' not in box:
-            raise ProtocolError('response did not include a result')
-        return box['result']
+        return self._simple_op(self._op_stat(path))
 
-    ## utilities
+    def batch(self):
+        """
+        Return a new Batch for this slave.
+        """
+        return Batch(self)
 
-    standard_errors = {
-        'invalid-meth': ProtocolError,
-        'version-too-new': ProtocolError,
-        'version-unsupported': ProtocolError,
-        'invalid': ProtocolError,
-        'unknown': RuntimeError,
-    }
+    ## utilities
 
-    def handle_errors(self, box, **more_errcodes):
+    def _fdpass_failed(self, box):
+        # Check the response to a descriptor-passing request, returning true
+        # if the caller should fall back to streaming.  Slaves that cannot
+        # pass descriptors are remembered, and not asked again.
         if box is None:
-            raise ProtocolError("unexpected EOF during operation")
+            return False
+        if box.get('errtag') in ('version-too-new', 'fdpass-unsupported'):
+            self.fdpass = False
+            return True
+        if 'error' not in box:
+            self.fdpass = True
+        return False
+
+    def _identical(self, local, remote):
+        # Return true if the slave's file REMOTE has the same contents as the
+        # master's file LOCAL.  The slave hashes its file while the master
+        # hashes its own, and does not bother if the sizes differ.
+        box, handle = self._op_hash(remote, size=os.path.getsize(local))
+        self.wire.send_box(box)
+        self.wire.flush()
+        digest = file_digest(local)
+        box = self.wire.read_box()
+        # a slave without the operation cannot tell, so the file is copied
+        if box is not None and box.get('errtag') == 'invalid-meth':
+            return False
+        try:
+            return handle(box) == digest
+        except NotFoundError:
+            return False
 
+    def _raw_failed(self, box):
+        # Check the response to a raw fetch request, returning true if the
+        # caller should fall back to data boxes.  'raw-unsupported' applies
+        # only to this request, but slaves without version 3 are remembered.
+        if box is None:
+            return False
+        if box.get('errtag') == 'version-too-new':
+            self.rawfetch = False
+            return True
+        if box.get('errtag') == 'raw-unsupported':
+            return True
         if 'error' not in box:
-            return
+            self.rawfetch = True
+        return False
 
-        if 'errtag' not in box:
-            box['errtag'] = 'unknown'
-        errtag = box['errtag']
-        exc_cls = more_errcodes.get(errtag)
-        if not exc_cls:
-            exc_cls = self.standard_errors.get(errtag)
-        if not exc_cls:
-            exc_cls = self.standard_errors.get('unknown')
+    def _sparse_failed(self, box):
+        # Check the response to a sparse send or fetch request, returning
+        # true if the caller should fall back to version 1.  Slaves without
+        # the sparse versions are remembered.
+        if box is None:
+            return False
+        if box.get('errtag') == 'version-too-new':
+            self.sparse = False
+            return True
+        if 'error' not in box:
+            self.sparse = True
+        return False
 
-        raise exc_cls(box['error'])
+    def _simple_op(self, op):
+        box, handle = op
+        self.wire.send_box(box)
+        return handle(self.wire.read_box())
 
     def on_disconnect(self, callable):
         # TODO: synchronization so that this gets called immediately if
         # the slave has already disconnected?
         self._disconnect_listeners.append(callable)
+
+
+class Batch(object):
+    """
+
+    A pipeline of simple operations on a slave.  Operations are queued by
+    calling the methods of the same names as those of RemoteSlave, and then
+    run() sends the requests back to back and collects the responses.
+
+    """
+
+    # maximum number of requests awaiting a response; this keeps the slave's
+    # responses from filling the transport's buffers while the master is
+    # still writing requests
+    window = 256
+
+    def __init__(self, slave):
+        self.slave = slave
+        self.ops = []
+
+    def set_cwd(self, cwd=None):
+        self.ops.append(self.slave._op_set_cwd(cwd))
+
+    def getenv(self):
+        self.ops.append(self.slave._op_getenv())
+
+    def ping(self, data='', reply_size=0):
+        self.ops.append(self.slave._op_ping(data, reply_size))
+
+    def mkdir(self, dir):
+        self.ops.append(self.slave._op_mkdir(dir))
+
+    def remove(self, path):
+        self.ops.append(self.slave._op_remove(path))
+
+    def rename(self, src, dest):
+        self.ops.append(self.slave._op_rename(src, dest))
+
+    def copy(self, src, dest):
+        self.ops.append(self.slave._op_copy(src, dest))
+
+    def stat(self, path):
+        self.ops.append(self.slave._op_stat(path))
+
+    def hash(self, path, algorithm='sha256'):
+        self.ops.append(self.slave._op_hash(path, algorithm))
+
+    def __len__(self):
+        return len(self.ops)
+
+    def run(self):
+        """
+        Run all queued operations, in order, and return a list of their
+        results.  If an operation failed on the slave, its result is the
+        exception it would have raised.  Errors that affect the connection as
+        a whole are raised immediately.  The batch is empty afterward.
+        """
+        ops, self.ops = self.ops, []
+        wire = self.slave.wire
+        results = []
+        sent = 0
+        while len(results) < len(ops):
+            # top up the pipeline ..
+            if sent < len(ops):
+                wire.cork()
+                try:
+                    while sent < len(ops) and sent - len(results) < self.window:
+                        wire.send_box(ops[sent][0])
+                        sent += 1
+                finally:
+                    wire.uncork()
+
+            # .. and then drain it until it is half empty
+            while len(results) < sent and (sent == len(ops)
+                        or sent - len(results) > self.window / 2):
+                box = wire.read_box()
+                if box is None:
+                    raise ProtocolError("unexpected EOF during operation")
+                try:
+                    results.append(ops[len(results)][1](box))
+                except (ProtocolError, RuntimeError), e:
+                    results.append(e)
+        return results
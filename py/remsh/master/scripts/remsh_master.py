@@ -4,29 +4,29 @@
 
 import sys
 import readline
-import socket
+import optparse
+import threading
 
-from remsh.xport.fd import FDXport
-from remsh.wire import Wire
-from remsh.master.remote import RemoteSlave
+from remsh.xport.sock import SocketXport
+from remsh.master.pool import SlavePool
 
 
-def print_stream(data):
-    sys.stdout.write(data)
+def for_each(pool, fn):
+    """
+    Call FN with each slave in POOL, concurrently, and return a dictionary
+    mapping slave names to results (or exceptions).
+    """
+    results = {}
 
-
-def run_on_all(sslavelaves, cmd):
-
-    def run_on(slave, cmd):
-
-        def print_stream(data):
-            sys.stdout.write("%s: %s" % (slave.hostname, data))
-
-        rc = slave.execute(args=['/bin/sh', '-c', cmd],
-                stdout_cb=print_stream, stderr_cb=print_stream)
+    def run_on(name):
+        try:
+            results[name] = pool.run(fn, name=name)
+        except Exception, e:
+            results[name] = e
 
     # make a thread for each slave
-    thds = [threading.Thread(target=run_on, args=(sl, cmd)) for sl in slaves]
+    thds = [threading.Thread(target=run_on, args=(name,))
+            for name in pool.names()]
 
     # start them
     for thd in thds:
@@ -35,17 +35,45 @@ def run_on_all(sslavelaves, cmd):
     # and join them
     for thd in thds:
         thd.join()
+    return results
+
+
+def run_on_all(pool, cmd):
+
+    def run_on(slave):
+
+        def print_stream(data):
+            sys.stdout.write("%s: %s" % (slave.hostname, data))
+
+        return slave.execute(args=['/bin/sh', '-c', cmd],
+                stdout_cb=print_stream, stderr_cb=print_stream)
+
+    return for_each(pool, run_on)
 
 
 def main():
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(("", 0))
-    print "connect to port %d" % s.getsockname()[1]
-
-    s.listen(5)
-    subsock, addr = s.accept()
-    s.close()
-    rem = RemoteSlave(Wire(FDXport(subsock.fileno())))
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--port", dest="port", type="int", default=0,
+            help="port to listen on (default: any free port)")
+    parser.add_option("--slaves", dest="slaves", type="int", default=1,
+            metavar="N", help="wait for N slaves to connect")
+    parser.add_option("--tls-cert", dest="tls_cert", metavar="FILE",
+            help="accept TLS connections, presenting the certificate in FILE")
+    parser.add_option("--tls-key", dest="tls_key", metavar="FILE",
+            help="private key for --tls-cert, if not in the same file")
+    opts, args = parser.parse_args()
+
+    if opts.tls_cert:
+        from remsh.xport.tls import TLSXport, server_context
+        context = server_context(opts.tls_cert, opts.tls_key)
+        xport_factory = lambda sock: TLSXport(sock, context, server_side=True,
+                                              keepalive=True)
+    else:
+        xport_factory = lambda sock: SocketXport(sock, keepalive=True)
+
+    pool = SlavePool(xport_factory=xport_factory)
+    print "connect to port %d" % pool.listen(opts.port)
+    pool.wait_for_slaves(opts.slaves)
     print "connected"
 
     done = False
@@ -53,16 +81,16 @@ def main():
         cmd = raw_input("remsh> ")
         if cmd == "quit":
             done = True
-        elif cmd == "cd":
-            newdir = rem.set_cwd()
-            print "now in %s" % newdir
-        elif cmd.startswith("cd "):
-            newdir = rem.set_cwd(cmd[3:])
-            print "now in %s" % newdir
+        elif cmd == "cd" or cmd.startswith("cd "):
+            newdir = cmd[3:] or None
+            results = for_each(pool, lambda slave: slave.set_cwd(newdir))
+            for name, result in sorted(results.items()):
+                print "%s: now in %s" % (name, result)
         elif cmd:
-            rc = rem.execute(args=['/bin/sh', '-c', cmd],
-                    stdout_cb=print_stream, stderr_cb=print_stream)
-            print "$? = %d" % rc
+            results = run_on_all(pool, cmd)
+            for name, rc in sorted(results.items()):
+                print "%s: $? = %s" % (name, rc)
+    pool.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,305 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_ops -*-
+
+import threading
+import collections
+
+# the number of bytes of box values that may be sent on a channel before the
+# other side returns credit for them; this is part of the protocol
+WINDOW = 1024 * 1024
+
+
+class Multiplexer(object):
+    """
+
+    Carries several independent box streams ("channels") over a single wire.
+    Every box on the wire has a 'channel' key giving its channel number, and a
+    box with a 'channel_close' key closes that channel.  A single reader thread
+    routes incoming boxes to per-channel queues, while boxes from any thread
+    are written to the wire under a lock.
+
+    Each channel has its own flow-control window: a sender may have at most
+    WINDOW bytes of box values outstanding on a channel, and the receiver
+    returns credit in a box with a 'channel_credit' key as the channel's
+    consumer reads them.  A sender without credit waits, but only for its own
+    channel, and the reader thread never waits, so a channel whose boxes go
+    unread holds up nothing else.
+
+    If NEW_CHANNEL_CB is given, then it is called with a new Channel object
+    whenever a box arrives for an unknown channel; otherwise, such boxes are
+    discarded.
+
+    """
+
+    def __init__(self, wire, new_channel_cb=None):
+        self.wire = wire
+        self.new_channel_cb = new_channel_cb
+        self.write_lock = threading.Lock()
+        self.channels_lock = threading.Lock()
+        self.channels = {}
+        self.next_id = 1
+        self.eof = False
+        self.thread = None
+
+        # only the reader thread reads from the wire, and it must not flush
+        # boxes that another thread is in the middle of writing
+        wire.flush_before_read = False
+
+    def start(self):
+        """
+        Start a daemon thread to read boxes from the wire.
+        """
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def run(self):
+        """
+        Read and route boxes until EOF on the wire.
+        """
+        try:
+            while 1:
+                box = self.wire.read_box()
+                if box is None:
+                    break
+                self._route(box)
+        finally:
+            self.channels_lock.acquire()
+            try:
+                self.eof = True
+                channels = self.channels.values()
+                self.channels = {}
+            finally:
+                self.channels_lock.release()
+            for channel in channels:
+                channel._eof()
+
+    def channel(self, id=None):
+        """
+        Open a new channel, with the given ID or the next available ID.
+        """
+        self.channels_lock.acquire()
+        try:
+            if id is None:
+                while self.next_id in self.channels:
+                    self.next_id += 1
+                id = self.next_id
+                self.next_id += 1
+            channel = Channel(self, id)
+            if self.eof:
+                channel._eof()
+            else:
+                self.channels[id] = channel
+            return channel
+        finally:
+            self.channels_lock.release()
+
+    def send_boxes(self, id, boxes):
+        self.write_lock.acquire()
+        try:
+            self.wire.cork()
+            try:
+                for box in boxes:
+                    box = box.copy()
+                    box['channel'] = id
+                    self.wire.send_box(box)
+            finally:
+                self.wire.uncork()
+        finally:
+            self.write_lock.release()
+
+    def close_channel(self, id):
+        self.channels_lock.acquire()
+        try:
+            channel = self.channels.pop(id, None)
+        finally:
+            self.channels_lock.release()
+        if channel:
+            channel._eof()
+        if not self.eof:
+            self.send_boxes(id, [{'channel_close': 'y'}])
+
+    def close(self):
+        self.wire.close()
+
+    def _route(self, box):
+        try:
+            id = int(box.pop('channel'))
+        except (KeyError, ValueError):
+            return # not for any channel; drop it
+
+        if 'channel_credit' in box:
+            # the other side has read some of what was sent on this channel
+            self.channels_lock.acquire()
+            try:
+                channel = self.channels.get(id)
+            finally:
+                self.channels_lock.release()
+            if channel:
+                channel._credit(box['channel_credit'])
+            return
+
+        self.channels_lock.acquire()
+        try:
+            channel = self.channels.get(id)
+            if 'channel_close' in box:
+                if channel:
+                    del self.channels[id]
+                    channel._eof()
+                return
+            new = channel is None and self.new_channel_cb is not None
+            if new:
+                channel = self.channels[id] = Channel(self, id)
+        finally:
+            self.channels_lock.release()
+
+        if channel is None:
+            return # a late box for a closed channel
+        if new:
+            self.new_channel_cb(channel)
+        channel._deliver(box)
+
+
+class Channel(object):
+    """
+
+    One channel of a Multiplexer.  This has the same interface as a Wire, so
+    operations can use it in place of one.  Boxes are delivered in order within
+    a channel, but there is no ordering between channels.  Sending blocks
+    while the other side has not returned credit for earlier boxes.
+
+    """
+
+    def __init__(self, mux, id):
+        self.mux = mux
+        self.id = id
+        # unread boxes, with their sizes; 'consumed' counts the bytes read
+        # but not yet credited to the other side
+        self.cond = threading.Condition(threading.Lock())
+        self.queue = collections.deque()
+        self.queued = 0
+        self.consumed = 0
+        # the bytes which may be sent before more credit arrives
+        self.send_window = WINDOW
+        self.eof = False
+        self.corked = 0
+        self.write_buf = []
+        self.write_len = 0
+        # as for a Wire
+        self.flush_before_read = True
+
+    def send_box(self, box):
+        if not self.corked:
+            self._send([box], _box_size(box))
+            return
+
+        # as for a Wire, limit the amount of buffered data
+        self.write_buf.append(box)
+        self.write_len += _box_size(box)
+        if self.write_len >= self.mux.wire.max_buffered:
+            self.flush()
+
+    def read_box(self):
+        if self.flush_before_read:
+            self.flush()
+        self.cond.acquire()
+        try:
+            while not self.queue and not self.eof:
+                self.cond.wait()
+            if not self.queue:
+                return None
+            box, size = self.queue.popleft()
+            self.queued -= size
+            self.consumed += size
+            credit = 0
+            if self.consumed >= WINDOW / 2 and not self.eof:
+                credit, self.consumed = self.consumed, 0
+        finally:
+            self.cond.release()
+        if credit:
+            self.mux.send_boxes(self.id, [{'channel_credit': credit}])
+        return box
+
+    def cork(self):
+        self.corked += 1
+
+    def uncork(self):
+        self.corked -= 1
+        if not self.corked:
+            self.flush()
+
+    def flush(self):
+        if self.write_buf:
+            boxes, self.write_buf = self.write_buf, []
+            size, self.write_len = self.write_len, 0
+            self._send(boxes, size)
+
+    def chunk_size(self):
+        return self.mux.wire.chunk_size()
+
+    def can_send_raw(self):
+        # raw bytes would not be framed for the channel
+        return False
+
+    def can_pass_fds(self):
+        # descriptors are not associated with a particular channel
+        return False
+
+    def close(self):
+        self.flush()
+        self.mux.close_channel(self.id)
+
+    def _send(self, boxes, size):
+        # wait for credit; any credit at all allows a batch, however large,
+        # so the window is exceeded by at most one batch
+        self.cond.acquire()
+        try:
+            while self.send_window <= 0 and not self.eof:
+                self.cond.wait()
+            self.send_window -= size
+        finally:
+            self.cond.release()
+        self.mux.send_boxes(self.id, boxes)
+
+    def _deliver(self, box):
+        # called by the reader thread, which never waits; the sender keeps
+        # within the window
+        size = _box_size(box)
+        self.cond.acquire()
+        try:
+            self.queue.append((box, size))
+            self.queued += size
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _credit(self, count):
+        # called by the reader thread
+        try:
+            count = int(count)
+        except ValueError:
+            return
+        self.cond.acquire()
+        try:
+            self.send_window += count
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def _eof(self):
+        # boxes already queued can still be read
+        self.cond.acquire()
+        try:
+            self.eof = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+
+def _box_size(box):
+    size = 0
+    for v in box.itervalues():
+        size += len(str(v))
+    return size
@@ -0,0 +1,113 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_partial -*-
+
+"""
+
+Partial files for resumable 'send' and 'fetch' operations.  The receiving side
+writes a file beside its destination, named for the SHA-256 digest of the
+expected contents, and renames it into place once it is complete and its
+digest checks out.  If a transfer is interrupted, the partial file remains,
+and the next transfer of the same contents carries on from its end.  Since
+the name includes the digest, a partial copy of some other version of the
+file is never resumed.
+
+"""
+
+import os
+import stat
+import errno
+import string
+import hashlib
+
+# buffer size for hashing the existing part of a partial file
+READ_BUFFER_SIZE = 1024 * 1024
+
+# where the system cannot refuse to follow a link, the check of the opened
+# file still applies
+O_NOFOLLOW = getattr(os, 'O_NOFOLLOW', 0)
+
+
+def partial_name(dest, digest):
+    """
+    Return the name of the partial file for DEST, whose contents should have
+    the hex SHA-256 digest DIGEST.  Raises ValueError if DIGEST is not a
+    SHA-256 hex digest.
+    """
+    if len(digest) != 64 or digest.strip(string.hexdigits):
+        raise ValueError("invalid digest")
+    dirname, basename = os.path.split(dest)
+    return os.path.join(dirname,
+            ".remsh-partial-%s-%s" % (digest[:16].lower(), basename))
+
+
+class PartialFile(object):
+    """
+
+    The partial file for DEST, which should end up with SIZE bytes with the
+    hex SHA-256 digest DIGEST.  The file is created if it does not exist;
+    otherwise, the data already in it is kept, and 'offset' is the position
+    from which writing continues.  Call 'finish' once all data is written, or
+    'close' to leave the file to be resumed later.
+
+    """
+
+    def __init__(self, dest, size, digest):
+        self.dest = dest
+        self.size = size
+        self.digest = digest.lower()
+        self.name = partial_name(dest, digest)
+        self.hash = hashlib.sha256()
+
+        # created as open() would, so the mode follows the umask.  The name is
+        # predictable, so it is never followed as a link, and an existing
+        # file is only used if it is one of ours.
+        fd = os.open(self.name, os.O_RDWR | os.O_CREAT | O_NOFOLLOW, 0666)
+        try:
+            st = os.fstat(fd)
+            if not stat.S_ISREG(st.st_mode) or st.st_uid != os.getuid():
+                raise OSError(errno.EPERM,
+                        "not a regular file owned by this user", self.name)
+        except:
+            os.close(fd)
+            raise
+        self.file = os.fdopen(fd, "r+b")
+        try:
+            # hash what is already there, up to the expected size; anything
+            # beyond that cannot be right
+            offset = 0
+            while offset < size:
+                data = self.file.read(min(size - offset, READ_BUFFER_SIZE))
+                if not data:
+                    break
+                self.hash.update(data)
+                offset += len(data)
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        except:
+            self.file.close()
+            raise
+        self.offset = offset
+
+    def write(self, data):
+        self.file.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+
+    def finish(self):
+        """
+        Check that the file is complete, and rename it to its destination.
+        Raises ValueError, and removes the partial file, if its contents are
+        not those expected.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        if self.offset != self.size or self.hash.hexdigest() != self.digest:
+            os.unlink(self.name)
+            raise ValueError("the data received does not match its digest")
+        os.rename(self.name, self.dest)
+
+    def close(self):
+        self.file.close()
@@ -4,32 +4,61 @@
 # See COPYING for license information
 
 import sys
+import time
 import socket
+import optparse
 
-from remsh.xport.fd import FDXport
+from remsh.xport.base import Error as XportError
+from remsh.xport.sock import SocketXport
 from remsh.wire import Wire
 from remsh.slave.server import SlaveServer
 
 
-def usage():
-    print "USAGE: %s master-hostname master-port"
-    sys.exit(1)
-
-
 def main():
-    if len(sys.argv) != 3:
-        usage()
-    master = sys.argv[1]
+    parser = optparse.OptionParser(
+            usage="%prog [options] master-hostname master-port")
+    parser.add_option("--tls-ca", dest="tls_ca", metavar="FILE",
+            help="connect with TLS, trusting the authorities in FILE")
+    parser.add_option("--reconnect", dest="reconnect", type="float",
+            metavar="SECONDS",
+            help="reconnect SECONDS after the connection is lost")
+    opts, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error("expected master-hostname and master-port")
+    master = args[0]
     try:
-        port = int(sys.argv[2])
+        port = int(args[1])
     except ValueError:
-        usage()
+        parser.error("invalid port")
 
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.connect((master, port))
+    connect = lambda session: \
+            SocketXport(socket.create_connection((master, port)))
+    if opts.tls_ca:
+        from remsh.xport.tls import TLSXport, client_context
+        context = client_context(cafile=opts.tls_ca)
+        # reconnections offer the previous session, to skip a full handshake
+        connect = lambda session: \
+            TLSXport.connect((master, port), context, session=session)
 
-    svr = SlaveServer(Wire(FDXport(s.fileno())))
-    svr.serve()
+    session = None
+    while 1:
+        xport = None
+        try:
+            xport = connect(session)
+            svr = SlaveServer(Wire(xport))
+            svr.serve()
+        except (socket.error, XportError), e:
+            if opts.reconnect is None:
+                raise
+            print >>sys.stderr, "connection failed: %s" % (e,)
+        if xport is not None:
+            # with TLS 1.3, the session arrives after the handshake, so it is
+            # taken once the connection is over
+            session = getattr(xport, 'session', None) or session
+            xport.close()
+        if opts.reconnect is None:
+            break
+        time.sleep(opts.reconnect)
 
 if __name__ == "__main__":
     main()
@@ -11,6 +11,13 @@ import select
 import shutil
 import errno
 import stat
+import hashlib
+import tarfile
+import threading
+
+from remsh import delta, partial, sparse, tree
+from remsh.mux import Multiplexer, Channel
+from remsh.wire import Error as WireError
 
 
 class RemoteError(Exception):
@@ -37,6 +44,110 @@ class InvalidRequestError(RemoteError):
     def __init__(self):
         RemoteError.__init__(self, 'invalid', 'invalid format for this method')
 
+class _Credit(object):
+    """
+
+    The flow-control window for a version-2 execute operation.  A thread
+    reads 'credit' boxes from the wire while the operation runs, adding to
+    the window and writing to a pipe (wake_fd is its read end) so that the
+    operation's select wakes up.  The master ends the operation with an
+    empty box once it has the result or an error box.
+
+    """
+
+    def __init__(self, wire, window):
+        self.wire = wire
+        self.window = window
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        # nothing is allocated until the operation is under way, so a request
+        # which fails earlier has nothing to clean up
+        self.wake_fd, self.wake_w = os.pipe()
+        # the operation does its own flushing, and the reading thread must not
+        # write boxes that the operation is in the middle of producing
+        self.flush_before_read = self.wire.flush_before_read
+        self.wire.flush_before_read = False
+        self.thread = threading.Thread(target=self._read_credit)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def available(self):
+        self.lock.acquire()
+        try:
+            return max(self.window, 0)
+        finally:
+            self.lock.release()
+
+    def consume(self, count):
+        self.lock.acquire()
+        try:
+            self.window -= count
+        finally:
+            self.lock.release()
+
+    def drain(self):
+        r, w, x = select.select([self.wake_fd], [], [], 0)
+        if r:
+            os.read(self.wake_fd, 4096)
+
+    def finish(self):
+        """
+        Wait for the empty box ending the operation.  The result or error box
+        must already have been sent, since the master waits for it first.
+        """
+        if self.thread:
+            self.thread.join()
+        else:
+            # the operation failed before it started
+            self._read_credit()
+        self.close()
+
+    def close(self):
+        if self.thread:
+            self.wire.flush_before_read = self.flush_before_read
+            os.close(self.wake_fd)
+            os.close(self.wake_w)
+            self.thread = None
+
+    def _read_credit(self):
+        while 1:
+            try:
+                box = self.wire.read_box()
+            except (EOFError, WireError):
+                box = None
+            if box is None:
+                # the master is gone, so stop limiting the output; writing
+                # it will fail soon enough
+                self.consume(-sys.maxint)
+                self._wake()
+                break
+            if not box:
+                # an empty box ends the operation
+                break
+            try:
+                count = int(box.get('credit', 0))
+            except ValueError:
+                continue
+            self.lock.acquire()
+            try:
+                self.window += count
+            finally:
+                self.lock.release()
+            self._wake()
+
+    def _wake(self):
+        if self.thread:
+            os.write(self.wake_w, 'c')
+
+
+# buffer size for copying files locally
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# hash algorithms available to the 'hash' operation
+HASH_ALGORITHMS = ('sha256', 'sha1', 'md5')
+
 # contains pointers to the SlaveServer methods for each operation, in a
 # two-level dictionary by key and then version.  This has to be global
 # during parsing, but is made a class variable below
@@ -48,6 +159,7 @@ class SlaveServer(object):
     def __init__(self, wire):
         self.wire = wire
         self.default_wd = os.getcwd()
+        self.use_channels = False
 
     # decorator for op methods
     def op_method(name, version=1):
@@ -68,6 +180,10 @@ class SlaveServer(object):
 
     def serve(self):
         while 1:
+            if self.use_channels:
+                self._serve_channels()
+                break
+
             box = self.wire.read_box()
             if box is None:
                 break
@@ -120,8 +236,45 @@ class SlaveServer(object):
             except RemoteError, e:
                 self.wire.send_box(e.errbox)
 
+    def _serve_channels(self):
+        # each channel gets its own server, in its own thread; note that these
+        # all share the process's working directory
+        def new_channel(channel):
+            server = SlaveServer(channel)
+            server.default_wd = self.default_wd
+            thd = threading.Thread(target=server.serve)
+            thd.setDaemon(1)
+            thd.start()
+
+        Multiplexer(self.wire, new_channel_cb=new_channel).run()
+
     ## operations
 
+    @op_method('wireopts', 1)
+    def remote_wireopts(self, box):
+        if isinstance(self.wire, Channel):
+            raise RemoteError('invalid',
+                              'wire options cannot be changed on a channel')
+
+        large_values = self._getbool(box, 'large_values')
+        compress = 'compress' in box and self._getbool(box, 'compress')
+        channels = 'channels' in box and self._getbool(box, 'channels')
+
+        # the reply is sent in the old format; the new options apply to every
+        # box after it
+        reply = {'large_values': large_values and 'y' or 'n'}
+        if 'compress' in box:
+            reply['compress'] = compress and 'y' or 'n'
+        if 'channels' in box:
+            reply['channels'] = channels and 'y' or 'n'
+        self.wire.send_box(reply)
+        if large_values:
+            self.wire.set_large_values(True)
+        if compress:
+            self.wire.set_compression(True)
+        if channels:
+            self.use_channels = True
+
     @op_method('set_cwd', 1)
     def remote_set_cwd(self, box):
         cwd = box.get('cwd')
@@ -143,6 +296,22 @@ class SlaveServer(object):
                      for (k, v) in os.environ.iteritems()])
         self.wire.send_box(resp)
 
+    @op_method('ping', 1)
+    def remote_ping(self, box):
+        # any 'data' in the request is ignored; it is only there to measure
+        # the time taken to send it
+        try:
+            reply_size = int(box.get('reply_size', 0))
+        except ValueError:
+            raise InvalidRequestError()
+        if reply_size < 0 or reply_size > self.wire.chunk_size():
+            raise InvalidRequestError()
+        if reply_size:
+            # random, so that compression does not shrink it
+            self.wire.send_box({'data': os.urandom(reply_size)})
+        else:
+            self.wire.send_box({})
+
     @op_method('mkdir', 1)
     def remote_mkdir(self, box):
         if 'dir' not in box:
@@ -159,6 +328,35 @@ class SlaveServer(object):
 
     @op_method('execute', 1)
     def remote_execute(self, box):
+        self._execute(box, None)
+
+    @op_method('execute', 2)
+    def remote_execute_window(self, box):
+        # version 2 adds credit-based flow control: the request grants an
+        # initial window of stream data, and the master grants more with
+        # 'credit' boxes as it consumes the output.  The slave stops reading
+        # the child's pipes while the window is exhausted, so a slow master
+        # slows the child rather than filling buffers.  After the result or
+        # an error box, the master ends the stream of credit boxes with an
+        # empty box.
+        credit = _Credit(self.wire, 0)
+        try:
+            try:
+                try:
+                    credit.window = int(box['window'])
+                except (KeyError, ValueError):
+                    raise InvalidRequestError()
+                if credit.window <= 0:
+                    raise InvalidRequestError()
+                self._execute(box, credit)
+            except RemoteError, e:
+                # the master only sends the empty box once it has the error
+                self.wire.send_box(e.errbox)
+            credit.finish()
+        finally:
+            credit.close()
+
+    def _execute(self, box, credit):
         for k in 'want_stdout want_stderr args'.split():
             if k not in box:
                 raise InvalidRequestError()
@@ -177,12 +375,16 @@ class SlaveServer(object):
         else:
             stderr = null
         try:
-            proc = subprocess.Popen(args=args,
-                stdin=null, stdout=stdout, stderr=stderr,
-                universal_newlines=False)
-        except Exception, e:
-            # TODO: more explicit
-            raise RemoteError('execfail', `e`)
+            try:
+                proc = subprocess.Popen(args=args,
+                    stdin=null, stdout=stdout, stderr=stderr,
+                    universal_newlines=False)
+            except Exception, e:
+                # TODO: more explicit
+                raise RemoteError('execfail', `e`)
+        finally:
+            # the child has its own copy
+            null.close()
 
         # now use select to watch those files, with a short timeout to watch
         # for process exit (this timeout grows up to 1 second)
@@ -192,28 +394,67 @@ class SlaveServer(object):
             readfiles.append(proc.stdout)
         if want_stderr:
             readfiles.append(proc.stderr)
-        while 1:
-            rlist, wlist, xlist = select.select(readfiles, [], [], timeout)
-            timeout = min(1.0, timeout * 2)
 
-            def send(file, name):
-                data = file.read(65535)
-                if not data:
-                    readfiles.remove(file)
-                else:
-                    self.wire.send_box({
-                        'data': data,
-                        'stream': name,
-                    })
-            if proc.stdout in rlist:
-                send(proc.stdout, 'stdout')
-            if proc.stderr in rlist:
-                send(proc.stderr, 'stderr')
-            if not rlist and proc.poll() is not None:
-                break
-        self.wire.send_box({
-            'result': proc.returncode,
-        })
+        if credit:
+            credit.start()
+
+        # output gathered in each pass through the loop is batched into a
+        # single write, and flushed before waiting again
+        self.wire.cork()
+        try:
+            try:
+                while 1:
+                    self.wire.flush()
+                    if credit:
+                        available = credit.available()
+                        # with no credit, leave the output in the pipes
+                        watching = available > 0
+                        rlist, wlist, xlist = select.select(
+                                (watching and readfiles or [])
+                                + [credit.wake_fd], [], [], timeout)
+                        credit.drain()
+                    else:
+                        available = 65535
+                        watching = True
+                        rlist, wlist, xlist = select.select(
+                                readfiles, [], [], timeout)
+                    timeout = min(1.0, timeout * 2)
+
+                    def send(file, name):
+                        # os.read returns what is available, rather than
+                        # waiting for a whole chunk
+                        data = os.read(file.fileno(), min(65535, available))
+                        if not data:
+                            readfiles.remove(file)
+                        else:
+                            self.wire.send_box({
+                                'data': data,
+                                'stream': name,
+                            })
+                            if credit:
+                                credit.consume(len(data))
+                        return len(data)
+                    if proc.stdout in rlist:
+                        available -= send(proc.stdout, 'stdout')
+                    if proc.stderr in rlist and available:
+                        send(proc.stderr, 'stderr')
+                    if not readfiles:
+                        # all output is finished, so just wait for the exit
+                        proc.wait()
+                        break
+                    if (watching and proc.stdout not in rlist
+                            and proc.stderr not in rlist
+                            and proc.poll() is not None):
+                        break
+            except (OSError, IOError, select.error), e:
+                raise RemoteError('failed',
+                                  "reading the command's output failed: %s"
+                                  % (e,))
+            self.wire.send_box({
+                'result': proc.returncode,
+            })
+        finally:
+            self.wire.uncork()
 
     @op_method("send", 1)
     def remote_send(self, box):
@@ -253,11 +494,161 @@ class SlaveServer(object):
             while box:
                 box = self.wire.read_box()
 
+        # the file must be complete on disk before the master is told so
+        try:
+            file.close()
+        except Exception, e:
+            error = error or str(e)
+
         if error:
             raise RemoteError('writefailed', error)
         else:
             self.wire.send_box({})
 
+    @op_method("send", 2)
+    def remote_send_fdpass(self, box):
+        # the master's open source file arrives with the request; claim it
+        # before anything else can fail
+        try:
+            srcfd = self.wire.take_fd()
+        except WireError:
+            raise RemoteError('fdpass-unsupported',
+                              "cannot receive file descriptors")
+        src = os.fdopen(srcfd, "rb")
+        try:
+            if 'dest' not in box:
+                raise InvalidRequestError()
+            dest = box['dest']
+
+            if os.path.exists(dest):
+                raise RemoteError('fileexists',
+                                  "destination file already exists")
+            try:
+                file = open(dest, "wb")
+            except IOError, e:
+                raise RemoteError('openfailed', e.strerror)
+
+            try:
+                try:
+                    sparse.copy(src, file, COPY_BUFFER_SIZE)
+                finally:
+                    file.close()
+            except (IOError, OSError), e:
+                raise RemoteError('writefailed', str(e))
+        finally:
+            src.close()
+
+        self.wire.send_box({})
+
+    @op_method("send", 3)
+    def remote_send_resume(self, box):
+        # version 3 writes to a partial file named for the expected digest,
+        # telling the master how much of it is already there; an interrupted
+        # transfer leaves the partial file to be resumed
+        try:
+            dest = box['dest']
+            size = int(box['size'])
+            digest = box['digest']
+            partial.partial_name(dest, digest)
+        except (KeyError, ValueError):
+            raise InvalidRequestError()
+
+        if os.path.exists(dest):
+            raise RemoteError('fileexists', "destination file already exists")
+        try:
+            file = partial.PartialFile(dest, size, digest)
+        except EnvironmentError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        try:
+            self.wire.send_box({'offset': file.offset})
+
+            # as for version 1, errors are reported once all of the data has
+            # arrived
+            error = None
+            while True:
+                box = self.wire.read_box()
+                if not box:
+                    if box is None:
+                        raise InvalidRequestError()
+                    break
+                if error:
+                    continue
+                if 'data' not in box:
+                    raise InvalidRequestError()
+                try:
+                    file.write(box['data'])
+                except EnvironmentError, e:
+                    error = RemoteError('writefailed', str(e))
+
+            if error:
+                raise error
+            try:
+                file.finish()
+            except EnvironmentError, e:
+                raise RemoteError('writefailed', str(e))
+            except ValueError, e:
+                raise RemoteError('failed', str(e))
+        finally:
+            file.close()
+
+        self.wire.send_box({})
+
+    @op_method("send", 4)
+    def remote_send_sparse(self, box):
+        # version 4 is version 1 with 'offset' boxes between the data boxes,
+        # skipping over holes in the master's file
+        if 'dest' not in box:
+            raise InvalidRequestError()
+
+        dest = box['dest']
+
+        if os.path.exists(dest):
+            raise RemoteError('fileexists', "destination file already exists")
+        try:
+            file = open(dest, "wb")
+        except IOError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        # send an empty box to indicate "go ahead"
+        self.wire.send_box({})
+
+        error = None
+        try:
+            while True:
+                box = self.wire.read_box()
+                if not box:
+                    if box is None:
+                        raise InvalidRequestError()
+                    break
+                if error:
+                    continue
+                try:
+                    if not sparse.write_box(file, box):
+                        error = InvalidRequestError()
+                except ValueError:
+                    error = InvalidRequestError()
+                except EnvironmentError, e:
+                    error = RemoteError('writefailed', str(e))
+
+            # a hole at the end of the file is made by extending it; this
+            # also flushes the file
+            if not error:
+                try:
+                    file.truncate()
+                except EnvironmentError, e:
+                    error = RemoteError('writefailed', str(e))
+        finally:
+            # anything left unflushed follows an error already reported
+            try:
+                file.close()
+            except EnvironmentError:
+                pass
+
+        if error:
+            raise error
+        self.wire.send_box({})
+
     @op_method("fetch", 1)
     def remote_fetch(self, box):
         if 'src' not in box:
@@ -273,19 +664,365 @@ class SlaveServer(object):
         except IOError, e:
             raise RemoteError('openfailed', e.strerror)
 
-        # now send data boxes until we're done
-        while 1:
+        # now send data boxes until we're done, letting the wire batch them
+        chunk_size = self.wire.chunk_size()
+        self.wire.cork()
+        try:
+            while 1:
+                try:
+                    data = file.read(chunk_size)
+                except Exception, e:
+                    raise RemoteError('readfailed', str(e))
+                if not data:
+                    break
+                self.wire.send_box({'data': data})
+
+            file.close()
+            self.wire.send_box({})
+        finally:
+            self.wire.uncork()
+
+    @op_method("fetch", 2)
+    def remote_fetch_fdpass(self, box):
+        if not self.wire.can_pass_fds():
+            raise RemoteError('fdpass-unsupported',
+                              "cannot send file descriptors")
+        if 'src' not in box:
+            raise InvalidRequestError()
+
+        src = box['src']
+
+        if not os.path.exists(src):
+            raise RemoteError('notfound', "Source file does not exist")
+        try:
+            file = open(src, "rb")
+        except IOError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        # the master reads the file itself
+        try:
+            self.wire.send_box_with_fd({}, file.fileno())
+        finally:
+            file.close()
+
+    @op_method("fetch", 3)
+    def remote_fetch_raw(self, box):
+        # version 3 sends a box giving the file's length, then the file's
+        # bytes outside of any box, so the kernel can copy them from the file
+        # to the transport; a final box reports success or failure.  Files
+        # whose length is not known in advance are refused with
+        # 'raw-unsupported', and the master falls back to version 1.
+        if 'src' not in box:
+            raise InvalidRequestError()
+        if not self.wire.can_send_raw():
+            raise RemoteError('raw-unsupported',
+                              "cannot send raw data on this connection")
+
+        src = box['src']
+
+        if not os.path.exists(src):
+            raise RemoteError('notfound', "Source file does not exist")
+        try:
+            file = open(src, "rb")
+        except IOError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        try:
+            st = os.fstat(file.fileno())
+            # files in /proc and the like claim to be empty
+            if not stat.S_ISREG(st.st_mode) or not st.st_size:
+                raise RemoteError('raw-unsupported',
+                                  "file length is not known in advance")
+            # holes are better sent as offsets than as raw zeroes
+            if sparse.has_holes(file):
+                raise RemoteError('raw-unsupported', "file has holes")
+            length = st.st_size
+
+            self.wire.send_box({'length': length})
+            sent = self.wire.send_raw_file(file, 0, length)
+        finally:
+            file.close()
+
+        if sent < length:
+            raise RemoteError('failed', "file shrank while being sent")
+        self.wire.send_box({})
+
+    @op_method("fetch", 4)
+    def remote_fetch_resume(self, box):
+        # version 4 first sends the file's size and digest, so the master can
+        # find its partial copy, and then the data from the offset the master
+        # gives.  A box without an offset means the master has given up.
+        if 'src' not in box:
+            raise InvalidRequestError()
+
+        src = box['src']
+
+        if not os.path.exists(src):
+            raise RemoteError('notfound', "Source file does not exist")
+        try:
+            file = open(src, "rb")
+        except IOError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        try:
+            h = hashlib.sha256()
+            size = 0
+            while 1:
+                try:
+                    data = file.read(COPY_BUFFER_SIZE)
+                except IOError, e:
+                    raise RemoteError('readfailed', str(e))
+                if not data:
+                    break
+                h.update(data)
+                size += len(data)
+            self.wire.send_box({'size': size, 'digest': h.hexdigest()})
+
+            box = self.wire.read_box()
+            if box is None:
+                raise InvalidRequestError()
+            if 'offset' not in box:
+                return
             try:
-                data = file.read(65535)
-            except Exception, e:
+                offset = int(box['offset'])
+            except ValueError:
+                raise InvalidRequestError()
+            if not 0 <= offset <= size:
+                raise InvalidRequestError()
+
+            chunk_size = self.wire.chunk_size()
+            self.wire.cork()
+            try:
+                try:
+                    file.seek(offset)
+                    while 1:
+                        data = file.read(chunk_size)
+                        if not data:
+                            break
+                        self.wire.send_box({'data': data})
+                except IOError, e:
+                    raise RemoteError('readfailed', str(e))
+                self.wire.send_box({})
+            finally:
+                self.wire.uncork()
+        finally:
+            file.close()
+
+    @op_method("fetch", 5)
+    def remote_fetch_sparse(self, box):
+        # version 5 is version 1 with 'offset' boxes between the data boxes,
+        # skipping over holes in the file
+        if 'src' not in box:
+            raise InvalidRequestError()
+
+        src = box['src']
+
+        if not os.path.exists(src):
+            raise RemoteError('notfound', "Source file does not exist")
+        try:
+            file = open(src, "rb")
+        except IOError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        self.wire.cork()
+        try:
+            try:
+                for box in sparse.boxes(file, self.wire.chunk_size()):
+                    self.wire.send_box(box)
+            except EnvironmentError, e:
                 raise RemoteError('readfailed', str(e))
-            if not data:
+            self.wire.send_box({})
+        finally:
+            self.wire.uncork()
+            file.close()
+
+    @op_method("sync", 1)
+    def remote_sync(self, box):
+        if 'dest' not in box:
+            raise InvalidRequestError()
+
+        dest = box['dest']
+
+        if os.path.isdir(dest):
+            raise RemoteError('openfailed', "destination is a directory")
+        old = None
+        if os.path.exists(dest):
+            try:
+                old = open(dest, "rb")
+            except IOError, e:
+                raise RemoteError('openfailed', e.strerror)
+
+        try:
+            # the new file is built beside the old one, and renamed over it
+            # once complete
+            tmp = os.path.join(os.path.dirname(dest),
+                    ".remsh-sync-%s" % os.urandom(8).encode('hex'))
+            try:
+                # created as open() would, so the mode follows the umask
+                fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+            except OSError, e:
+                raise RemoteError('openfailed', e.strerror)
+            file = os.fdopen(fd, "wb")
+            try:
+                self._sync(old, file, tmp, dest)
+            except:
+                file.close()
+                os.unlink(tmp)
+                raise
+        finally:
+            if old:
+                old.close()
+
+    def _sync(self, old, file, tmp, dest):
+        # describe the old file's blocks, in boxes holding as many signatures
+        # as fit
+        if old:
+            block_size = delta.block_size_for(os.fstat(old.fileno()).st_size)
+        else:
+            block_size = delta.MIN_BLOCK_SIZE
+        self.wire.cork()
+        try:
+            self.wire.send_box({'block_size': block_size})
+            nblocks = 0
+            if old:
+                per_box = self.wire.chunk_size() // delta.SIGNATURE.size
+                sigs = []
+                try:
+                    for sig in delta.signatures(old, block_size):
+                        sigs.append(sig)
+                        if len(sigs) == per_box:
+                            self.wire.send_box({'sigs': ''.join(sigs)})
+                            nblocks += len(sigs)
+                            sigs = []
+                except EnvironmentError, e:
+                    raise RemoteError('failed', str(e))
+                if sigs:
+                    self.wire.send_box({'sigs': ''.join(sigs)})
+                    nblocks += len(sigs)
+            self.wire.send_box({})
+        finally:
+            self.wire.uncork()
+
+        # build the new file from the master's instructions; as for send,
+        # errors are reported once the master has finished
+        error = None
+        while True:
+            box = self.wire.read_box()
+            if not box:
+                if box is None:
+                    raise InvalidRequestError()
                 break
-            self.wire.send_box({'data': data})
+            if error:
+                continue
+            if 'data' in box:
+                try:
+                    file.write(box['data'])
+                except EnvironmentError, e:
+                    error = RemoteError('failed', str(e))
+                continue
+            try:
+                first = int(box['block'])
+                count = int(box['count'])
+            except (KeyError, ValueError):
+                error = InvalidRequestError()
+                continue
+            if first < 0 or count < 1 or first + count > nblocks:
+                error = InvalidRequestError()
+                continue
+            try:
+                old.seek(first * block_size)
+                remaining = count * block_size
+                while remaining:
+                    data = old.read(min(remaining, COPY_BUFFER_SIZE))
+                    if not data:
+                        raise IOError("file changed during sync")
+                    file.write(data)
+                    remaining -= len(data)
+            except EnvironmentError, e:
+                error = RemoteError('failed', str(e))
+
+        try:
+            if not error:
+                file.flush()
+                os.fsync(file.fileno())
+                if old:
+                    shutil.copymode(dest, tmp)
+            file.close()
+            if not error:
+                os.rename(tmp, dest)
+        except EnvironmentError, e:
+            error = error or RemoteError('failed', str(e))
+        if error:
+            raise error
+        self.wire.send_box({})
+
+    @op_method("send_tree", 1)
+    def remote_send_tree(self, box):
+        if 'dest' not in box:
+            raise InvalidRequestError()
+
+        dest = box['dest']
+
+        if os.path.exists(dest) and not os.path.isdir(dest):
+            raise RemoteError('fileexists', "destination is not a directory")
+        try:
+            if not os.path.exists(dest):
+                os.makedirs(dest)
+        except OSError, e:
+            raise RemoteError('openfailed', e.strerror)
+
+        # send an empty box to indicate "go ahead"
+        self.wire.send_box({})
+
+        def handle_errors(box):
+            if box is None:
+                raise InvalidRequestError()
+            if 'abort' in box:
+                raise RemoteError('failed', "the master aborted the transfer")
+
+        # as for send, errors are reported once all of the data has arrived
+        reader = tree.BoxReader(self.wire, handle_errors)
+        error = None
+        try:
+            tree.unpack(reader, dest)
+        except (EnvironmentError, ValueError, tarfile.TarError), e:
+            error = str(e)
+        reader.drain()
 
-        file.close()
+        if error:
+            raise RemoteError('failed', error)
         self.wire.send_box({})
 
+    @op_method("fetch_tree", 1)
+    def remote_fetch_tree(self, box):
+        if 'src' not in box:
+            raise InvalidRequestError()
+
+        src = box['src']
+
+        if not os.path.exists(src):
+            raise RemoteError('notfound', "Source directory does not exist")
+        if not os.path.isdir(src):
+            raise RemoteError('openfailed', "Source is not a directory")
+
+        # the archive is sent in data boxes ending with an empty box, and
+        # then a box reporting whether it is complete
+        error = None
+        self.wire.cork()
+        try:
+            writer = tree.BoxWriter(self.wire)
+            try:
+                tree.pack(writer, src)
+            except (EnvironmentError, tarfile.TarError), e:
+                error = str(e)
+            writer.flush()
+            self.wire.send_box({})
+            if error:
+                raise RemoteError('failed', error)
+            self.wire.send_box({})
+        finally:
+            self.wire.uncork()
+
     @op_method('remove', 1)
     def remote_remove(self, box):
         if 'path' not in box:
@@ -380,6 +1117,45 @@ class SlaveServer(object):
         else:
             self.wire.send_box({'result': 'f'})
 
+    @op_method('hash', 1)
+    def remote_hash(self, box):
+        if 'path' not in box:
+            raise InvalidRequestError()
+
+        path = box['path']
+        algorithm = box.get('algorithm', 'sha256')
+        if algorithm not in HASH_ALGORITHMS:
+            raise RemoteError('invalid', "unknown hash algorithm")
+
+        try:
+            file = open(path, "rb")
+        except IOError, e:
+            if e.errno == errno.ENOENT:
+                raise RemoteError('notfound', e.strerror)
+            raise RemoteError('openfailed', e.strerror)
+
+        try:
+            size = os.fstat(file.fileno()).st_size
+            # a file of the wrong size cannot be the one the master is
+            # looking for, so there is no need to read it
+            if 'size' in box and box['size'] != str(size):
+                self.wire.send_box({'size': size})
+                return
+
+            h = hashlib.new(algorithm)
+            while 1:
+                try:
+                    data = file.read(COPY_BUFFER_SIZE)
+                except IOError, e:
+                    raise RemoteError('failed', e.strerror)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            file.close()
+
+        self.wire.send_box({'size': size, 'digest': h.hexdigest()})
+
     def _getbool(self, rq, name):
         if name not in rq or rq[name] not in 'ny':
             raise RemoteError('invalid', "invalid boolean value")
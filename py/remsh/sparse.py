@@ -0,0 +1,131 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_sparse -*-
+
+"""
+
+Sparse files for the 'send' and 'fetch' operations.  A file with holes is
+sent as data boxes for its data extents only, with an 'offset' box before
+each extent which does not follow on from the previous one, and one more at
+the end if the file ends with a hole.  The receiver seeks to each offset, so
+the skipped ranges become holes, and truncates the file at its final
+position.
+
+"""
+
+import os
+import stat
+import errno
+
+# lseek whence values for finding data and holes (Linux, Solaris, FreeBSD);
+# Python 2's os module does not name them
+SEEK_DATA = 3
+SEEK_HOLE = 4
+
+
+def has_holes(file):
+    """
+    Return true if FILE, an open regular file, occupies less space than its
+    length, and so has holes.
+    """
+    st = os.fstat(file.fileno())
+    if not stat.S_ISREG(st.st_mode) or not hasattr(st, 'st_blocks'):
+        return False
+    return st.st_blocks * 512 < st.st_size
+
+
+def data_extents(fd, size):
+    """
+    Generate (offset, length) for each extent of data in the first SIZE bytes
+    of the file open as FD.  If the system cannot find holes, the whole file
+    is one extent.  This moves the file position of FD.
+    """
+    try:
+        pos = os.lseek(fd, 0, SEEK_DATA)
+    except OSError, e:
+        if e.errno == errno.ENXIO:
+            # nothing but holes
+            return
+        if e.errno != errno.EINVAL:
+            raise
+        pos = 0
+        end = size
+    else:
+        end = None
+
+    while pos < size:
+        if end is None:
+            end = min(os.lseek(fd, pos, SEEK_HOLE), size)
+        yield pos, end - pos
+        if end == size:
+            return
+        try:
+            pos = os.lseek(fd, end, SEEK_DATA)
+        except OSError, e:
+            if e.errno != errno.ENXIO:
+                raise
+            return
+        end = None
+
+
+def boxes(file, chunk_size):
+    """
+    Generate the data and offset boxes describing the contents of FILE, with
+    up to CHUNK_SIZE bytes of data in each.  A file without holes is read
+    from its current position to its end, without any offset boxes.
+    """
+    fd = file.fileno()
+    if not has_holes(file):
+        while 1:
+            data = file.read(chunk_size)
+            if not data:
+                return
+            yield {'data': data}
+
+    # the descriptor is read directly, since the file position moves under
+    # the file object's feet
+    size = os.fstat(fd).st_size
+    pos = 0
+    for offset, length in data_extents(fd, size):
+        if offset != pos:
+            yield {'offset': offset}
+        os.lseek(fd, offset, os.SEEK_SET)
+        pos = offset
+        while length:
+            data = os.read(fd, min(length, chunk_size))
+            if not data:
+                # the file shrank
+                return
+            yield {'data': data}
+            pos += len(data)
+            length -= len(data)
+    if pos != size:
+        yield {'offset': size}
+
+
+def write_box(file, box):
+    """
+    Apply a data or offset box to FILE.  Returns false if BOX is neither.
+    Raises ValueError for an invalid offset.
+    """
+    if 'data' in box:
+        file.write(box['data'])
+    elif 'offset' in box:
+        offset = int(box['offset'])
+        if offset < 0:
+            raise ValueError("negative offset")
+        file.seek(offset)
+    else:
+        return False
+    return True
+
+
+def copy(src, dest, chunk_size):
+    """
+    Copy the contents of the file SRC to the file DEST, leaving holes in DEST
+    where SRC has them.
+    """
+    for box in boxes(src, chunk_size):
+        write_box(dest, box)
+    dest.truncate()
@@ -0,0 +1,196 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_stats -*-
+
+import sys
+import time
+import threading
+import json
+
+
+class Histogram(object):
+    """
+
+    A histogram with power-of-two buckets: bucket N counts values V with
+    2**(N-1) <= V < 2**N, and bucket 0 counts zeroes.
+
+    """
+
+    def __init__(self):
+        self.buckets = [0] * 65
+
+    def add(self, value):
+        self.buckets[value.bit_length()] += 1
+
+    def snapshot(self):
+        """
+        Return a list of (upper_bound, count) for the non-empty buckets, where
+        each bucket counts values less than upper_bound.
+        """
+        return [(1 << i, count) for i, count in enumerate(self.buckets)
+                if count]
+
+
+class WireStats(object):
+    """
+
+    Counters for a Wire.  Assign an instance to the wire's 'stats' attribute
+    to start counting.  Outgoing and incoming counters are updated separately,
+    so a wire's reading and writing may happen in different threads.
+
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.boxes_sent = 0
+        self.bytes_sent = 0
+        self.sent_sizes = Histogram()
+        self.writes = 0
+        self.write_time = 0.0
+
+        self.boxes_received = 0
+        self.bytes_received = 0
+        self.received_sizes = Histogram()
+        self.reads = 0
+        self.read_time = 0.0
+
+    def box_sent(self, size):
+        self.boxes_sent += 1
+        self.sent_sizes.add(size)
+
+    def box_received(self, size):
+        self.boxes_received += 1
+        self.received_sizes.add(size)
+
+    def wrote(self, size, elapsed):
+        """
+        Note that a write of SIZE bytes to the transport blocked for ELAPSED
+        seconds.
+        """
+        self.writes += 1
+        self.bytes_sent += size
+        self.write_time += elapsed
+
+    def read(self, size, elapsed):
+        """
+        Note that a read from the transport returned SIZE bytes after
+        blocking for ELAPSED seconds.
+        """
+        self.reads += 1
+        self.bytes_received += size
+        self.read_time += elapsed
+
+    def snapshot(self):
+        return {
+            'boxes_sent': self.boxes_sent,
+            'bytes_sent': self.bytes_sent,
+            'sent_sizes': self.sent_sizes.snapshot(),
+            'writes': self.writes,
+            'write_time': self.write_time,
+            'boxes_received': self.boxes_received,
+            'bytes_received': self.bytes_received,
+            'received_sizes': self.received_sizes.snapshot(),
+            'reads': self.reads,
+            'read_time': self.read_time,
+        }
+
+
+class OpStats(object):
+    """
+
+    Per-method request latency for a RemoteSlave.  Assign an instance to the
+    slave's 'stats' attribute to start recording.  An instance may be shared
+    by several slaves, or several channels to the same slave.
+
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            # meth: [count, total_time, max_time, Histogram of microseconds]
+            self.meths = {}
+        finally:
+            self.lock.release()
+
+    def record(self, meth, elapsed):
+        self.lock.acquire()
+        try:
+            try:
+                m = self.meths[meth]
+            except KeyError:
+                m = self.meths[meth] = [0, 0.0, 0.0, Histogram()]
+            m[0] += 1
+            m[1] += elapsed
+            if elapsed > m[2]:
+                m[2] = elapsed
+            m[3].add(int(elapsed * 1000000))
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            rv = {}
+            for meth, (count, total, max, hist) in self.meths.iteritems():
+                rv[meth] = {
+                    'count': count,
+                    'total_time': total,
+                    'mean_time': total / count,
+                    'max_time': max,
+                    'usec': hist.snapshot(),
+                }
+            return rv
+        finally:
+            self.lock.release()
+
+
+class StatsDumper(object):
+    """
+
+    Periodically write snapshots of one or more stats objects to a file, one
+    JSON object per line.  SOURCES is a dictionary mapping names to objects
+    with a 'snapshot' method.
+
+    """
+
+    def __init__(self, sources, interval=10.0, output=None):
+        self.sources = sources
+        self.interval = interval
+        self.output = output or sys.stderr
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the dumper, after writing a final snapshot.
+        """
+        self.stopping.set()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while 1:
+            self.stopping.wait(self.interval)
+            self.dump()
+            if self.stopping.isSet():
+                break
+
+    def dump(self):
+        record = {'time': time.time()}
+        for name, source in self.sources.iteritems():
+            record[name] = source.snapshot()
+        self.output.write(json.dumps(record, sort_keys=True) + "\n")
+        self.output.flush()
@@ -0,0 +1,186 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_tree -*-
+
+"""
+
+Directory trees for the 'send_tree' and 'fetch_tree' operations.  A tree is
+carried as a tar archive in the data boxes of a single operation, written and
+read incrementally with tarfile's stream modes, so neither side holds more
+than a few boxes of it at once.
+
+"""
+
+import os
+import copy
+import stat
+import errno
+import tarfile
+
+
+class BoxWriter(object):
+    """
+
+    A file-like object which sends what is written to it as data boxes on
+    WIRE, each of up to wire.chunk_size() bytes.
+
+    """
+
+    def __init__(self, wire):
+        self.wire = wire
+        self.chunk_size = wire.chunk_size()
+        self.buf = []
+        self.buf_len = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_len += len(data)
+        if self.buf_len >= self.chunk_size:
+            data = ''.join(self.buf)
+            while len(data) >= self.chunk_size:
+                self.wire.send_box({'data': data[:self.chunk_size]})
+                data = data[self.chunk_size:]
+            self.buf = [data]
+            self.buf_len = len(data)
+
+    def flush(self):
+        if self.buf_len:
+            self.wire.send_box({'data': ''.join(self.buf)})
+        self.buf = []
+        self.buf_len = 0
+
+
+class BoxReader(object):
+    """
+
+    A file-like object which reads the data boxes arriving on WIRE, up to the
+    empty box which ends them.  HANDLE_ERRORS is called with each box, and
+    should raise an exception for an error box.
+
+    """
+
+    def __init__(self, wire, handle_errors):
+        self.wire = wire
+        self.handle_errors = handle_errors
+        self.data = ''
+        self.eof = False
+
+    def read(self, size):
+        while not self.data and not self.eof:
+            box = self.wire.read_box()
+            self.handle_errors(box)
+            if not box:
+                self.eof = True
+            elif 'data' not in box:
+                raise ValueError('not a data box')
+            else:
+                self.data = box['data']
+        data = self.data[:size]
+        self.data = self.data[size:]
+        return data
+
+    def drain(self):
+        """
+        Discard data up to the end of the stream.
+        """
+        self.data = ''
+        while not self.eof:
+            self.read(1)
+
+
+class _TarFile(tarfile.TarFile):
+
+    # files are owned by whoever unpacks them, as for a copy
+    def chown(self, tarinfo, targetpath):
+        pass
+
+
+def pack(fileobj, src):
+    """
+    Write the contents of the directory SRC to FILEOBJ as a tar stream, with
+    names relative to SRC.  Symbolic links are archived as links.
+    """
+    tar = _TarFile.open(fileobj=fileobj, mode="w|")
+    try:
+        for name in sorted(os.listdir(src)):
+            tar.add(os.path.join(src, name), arcname=name)
+    finally:
+        tar.close()
+
+
+def unpack(fileobj, dest):
+    """
+    Extract the tar stream read from FILEOBJ into the directory DEST,
+    replacing any existing files of the same names.  Raises ValueError for a
+    member which would be placed outside of DEST, or which is not a file,
+    directory or link.
+    """
+    realdest = os.path.realpath(dest)
+    tar = _TarFile.open(fileobj=fileobj, mode="r|")
+    try:
+        directories = []
+        for member in tar:
+            _check_member(member, dest, realdest)
+            target = os.path.join(dest, member.name)
+            if member.isdir():
+                # chmod and utime follow links, so anything but a real
+                # directory is replaced
+                if not _is_real_dir(target):
+                    if os.path.lexists(target):
+                        os.unlink(target)
+                # as for extractall: directories are writable until the end
+                directories.append(member)
+                member = copy.copy(member)
+                member.mode = 0700
+            elif os.path.lexists(target) and not os.path.isdir(target):
+                # never write through an existing link
+                os.unlink(target)
+            tar.extract(member, dest)
+
+        directories.reverse()
+        for member in directories:
+            target = os.path.join(dest, member.name)
+            if not _is_real_dir(target):
+                raise ValueError("%r is no longer a directory" % member.name)
+            tar.utime(member, target)
+            tar.chmod(member, target)
+    finally:
+        tar.close()
+
+
+def _check_member(member, dest, realdest):
+    def inside(name):
+        name = os.path.normpath(name)
+        return not (os.path.isabs(name) or name == os.pardir
+                    or name.startswith(os.pardir + os.sep))
+
+    def within(path):
+        path = os.path.realpath(path)
+        return path == realdest or path.startswith(os.path.join(realdest, ''))
+
+    if not inside(member.name):
+        raise ValueError("%r is outside the tree" % member.name)
+    # a hard link's target may be reached through symbolic links already
+    # extracted, so it is checked where it really is
+    if member.islnk() and not (inside(member.linkname) and
+            within(os.path.join(dest, member.linkname))):
+        raise ValueError("%r links outside the tree" % member.name)
+    if not (member.isreg() or member.isdir() or member.issym()
+            or member.islnk()):
+        raise ValueError("%r is not a file, directory or link" % member.name)
+
+    # the parent directory must not be reached through a symbolic link
+    # leading out of the tree
+    if not within(os.path.dirname(os.path.join(dest, member.name))):
+        raise ValueError("%r is outside the tree" % member.name)
+
+
+def _is_real_dir(path):
+    try:
+        st = os.lstat(path)
+    except OSError, e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    return stat.S_ISDIR(st.st_mode)
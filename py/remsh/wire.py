@@ -4,58 +4,572 @@
 # -*- test-case-name: test.test_wire -*-
 
 import os
+import time
 import types
 import struct
+import zlib
+
+from remsh.xport.base import Error as XportError
 
 
 class Error(Exception):
     "Wire-layer error"
 
 
+# parser states for BoxDecoder
+_KLEN, _KEY, _VLEN, _VAL = range(4)
+
+# with the large-values extension, this bit in a key length indicates that the
+# value length that follows the key is four bytes long
+LARGE_VALUE_FLAG = 0x8000
+
+# with the compression extension, this bit in a key length indicates that the
+# value is compressed
+COMPRESSED_FLAG = 0x4000
+
+# upper limit on the length of a single value with the large-values extension
+MAX_LARGE_VALUE = 16 * 1024 * 1024
+
+# chunk size for data boxes with and without the large-values extension; the
+# compressed chunk size leaves room for incompressible data to grow slightly
+LARGE_CHUNK_SIZE = 1024 * 1024
+SMALL_CHUNK_SIZE = 65535
+SMALL_COMPRESSED_CHUNK_SIZE = 65535 - 256
+
+# size of the buffer used to read raw bytes (see Wire.read_raw)
+RAW_BUFFER_SIZE = 1024 * 1024
+
+
+def _compress_bound(length):
+    """
+    Return the largest size LENGTH bytes could be compressed to, including the
+    sync flush at the end of each compressed value.
+    """
+    return length + (length >> 12) + (length >> 14) + (length >> 25) + 18
+
+
+class BoxSchema(object):
+    """
+
+    A frequently-used box shape, with a fixed set of keys.  Boxes of this
+    shape are encoded with one precompiled struct per key, which packs the
+    key header and value length together, and are decoded by matching the
+    cached key headers directly against the incoming bytes.  Boxes that do
+    not fit the schema exactly -- other keys, large or compressed values, or
+    keys in a different order on the wire -- use the generic code instead.
+
+    """
+
+    def __init__(self, keys):
+        self.keys = tuple(keys)
+        self.fields = []
+        for key in self.keys:
+            header = struct.pack("!H", len(key)) + key
+            packer = struct.Struct("!%dsH" % len(header))
+            self.fields.append((key, header, packer))
+
+    def encode(self, box, bytes):
+        """
+        Append the byte strings representing BOX to the list BYTES and return
+        their total length, or return None if the box does not fit this
+        schema.
+        """
+        pieces = []
+        total = 2
+        for key, header, packer in self.fields:
+            try:
+                v = box[key]
+            except KeyError:
+                return None
+            if type(v) is not str:
+                v = str(v)
+            vlen = len(v)
+            if vlen > 65535:
+                return None
+            pieces.append(packer.pack(header, vlen))
+            pieces.append(v)
+            total += packer.size + vlen
+        pieces.append('\x00\x00')
+        bytes.extend(pieces)
+        return total
+
+    def decode(self, buf, pos, avail):
+        """
+        Decode a box of this shape starting at POS in bytearray BUF, returning
+        (box, new_pos), or None if the bytes there do not match the schema or
+        the box is not complete yet.
+        """
+        box = {}
+        for key, header, packer in self.fields:
+            if not buf.startswith(header, pos):
+                return None
+            pos += len(header)
+            if avail - pos < 2:
+                return None
+            vlen = (buf[pos] << 8) | buf[pos + 1]
+            pos += 2
+            if avail - pos < vlen:
+                return None
+            box[key] = str(buffer(buf, pos, vlen))
+            pos += vlen
+        if avail - pos < 2 or buf[pos] or buf[pos + 1]:
+            return None
+        return box, pos + 2
+
+# registered schemas, by the length of their first key for decoding, and by
+# number of keys for encoding
+_schemas_by_klen = {}
+_schemas_by_size = {}
+
+
+def register_schema(*keys):
+    """
+    Register a box shape with the given keys for fast encoding and decoding.
+    Keys are encoded in the order given.  The empty box is already as fast as
+    it can be, so at least one key is required.
+    """
+    schema = BoxSchema(keys)
+    _schemas_by_klen.setdefault(len(keys[0]), []).append(schema)
+    _schemas_by_size.setdefault(len(keys), []).append(schema)
+    return schema
+
+# the most frequent boxes: file data, command output, and results
+register_schema('data')
+register_schema('stream', 'data')
+register_schema('result')
+
+
+class BoxDecoder(object):
+    """
+
+    Incremental box parser.  Bytes are added with 'feed', and complete boxes
+    are retrieved with 'next_box'.  The parse state is kept between calls, so
+    each byte is examined only once, no matter how the incoming bytestream is
+    split up, and strings are only created for complete keys and values.
+
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.box = {}
+        self.key = None
+        self.state = _KLEN
+        self.need = 2
+        self.large = False
+        self.large_values = False
+        self.compressed = False
+        self.decompressor = None
+        # total bytes parsed so far
+        self.consumed = 0
+
+    def feed(self, data):
+        self.buf.extend(data)
+
+    def next_box(self):
+        """
+        Return the next complete box, or None if more bytes are required.
+        Raises an Error for an invalid packet.
+        """
+        buf = self.buf
+        pos = self.pos
+        avail = len(buf)
+        box = None
+
+        # at the beginning of a box, try the registered schemas first
+        if self.state == _KLEN and not self.box and avail - pos >= 2:
+            klen = (buf[pos] << 8) | buf[pos + 1]
+            for schema in _schemas_by_klen.get(klen, ()):
+                found = schema.decode(buf, pos, avail)
+                if found:
+                    box, pos = found
+                    break
+
+        while box is None and avail - pos >= self.need:
+            state = self.state
+            if state == _KLEN:
+                klen = (buf[pos] << 8) | buf[pos + 1]
+                pos += 2
+                self.large = self.compressed = False
+                if klen & LARGE_VALUE_FLAG and self.large_values:
+                    klen &= ~LARGE_VALUE_FLAG
+                    self.large = True
+                if klen & COMPRESSED_FLAG and self.decompressor:
+                    klen &= ~COMPRESSED_FLAG
+                    self.compressed = True
+                if klen >= 256:
+                    raise Error("invalid key length 0x%04x" % klen)
+                if klen == 0:
+                    box = self.box
+                    self.box = {}
+                    break # found a full box
+                self.state, self.need = _KEY, klen
+            elif state == _KEY:
+                key = str(buffer(buf, pos, self.need))
+                pos += self.need
+                if key in self.box:
+                    raise Error("duplicate key %r" % key)
+                self.key = key
+                if self.large:
+                    self.state, self.need = _VLEN, 4
+                else:
+                    self.state, self.need = _VLEN, 2
+            elif state == _VLEN:
+                if self.large:
+                    vlen = struct.unpack_from("!I", buf, pos)[0]
+                    if vlen > MAX_LARGE_VALUE:
+                        raise Error("invalid value length 0x%08x" % vlen)
+                else:
+                    vlen = (buf[pos] << 8) | buf[pos + 1]
+                pos += self.need
+                if vlen == 0:
+                    self.box[self.key] = ''
+                    self.state, self.need = _KLEN, 2
+                else:
+                    self.state, self.need = _VAL, vlen
+            else:
+                val = str(buffer(buf, pos, self.need))
+                if self.compressed:
+                    val = self._decompress(val)
+                self.box[self.key] = val
+                pos += self.need
+                self.state, self.need = _KLEN, 2
+
+        self.consumed += pos - self.pos
+
+        # discard consumed bytes; small leftovers are cheap to move, and large
+        # ones are only moved once they are at least half of the buffer
+        if pos == avail:
+            del buf[:]
+            pos = 0
+        elif pos > 65536 and pos * 2 > avail:
+            del buf[:pos]
+            pos = 0
+        self.pos = pos
+
+        return box
+
+    def _decompress(self, val):
+        if self.large_values:
+            limit = MAX_LARGE_VALUE
+        else:
+            limit = 65535
+        try:
+            val = self.decompressor.decompress(val, limit)
+        except zlib.error, e:
+            raise Error("invalid compressed value: %s" % e)
+        if self.decompressor.unconsumed_tail:
+            raise Error("compressed value is too long")
+        return val
+
+    def pending(self):
+        """
+        Return true if a partial box has been received.
+        """
+        return self.pos < len(self.buf) or self.state != _KLEN or self.box
+
+    def take(self, count):
+        """
+        Remove and return up to COUNT bytes that have not been parsed, for
+        data which the other side sent between boxes.  This must only be
+        called between boxes.
+        """
+        assert self.state == _KLEN and not self.box
+        end = min(self.pos + count, len(self.buf))
+        data = str(buffer(self.buf, self.pos, end - self.pos))
+        if end == len(self.buf):
+            del self.buf[:]
+            self.pos = 0
+        else:
+            self.pos = end
+        return data
+
+    def remaining(self):
+        """
+        Return any bytes that have not been parsed into a box yet, as a string.
+        """
+        return str(buffer(self.buf, self.pos))
+
+
 class Wire(object):
 
+    # buffered output is written once it exceeds this many bytes, even when
+    # the wire is corked
+    max_buffered = 262144
+
     def __init__(self, xport):
         self.xport = xport
-        self.read_buf = ''
+        self.decoder = BoxDecoder()
+        self.write_buf = []
+        self.write_len = 0
+        self.corked = 0
+        self.flush_before_read = True
+        self.large_values = False
+        self.compressor = None
+        self.compress_threshold = 128
         self.debug = 0
+        # a remsh.stats.WireStats instance, if statistics are wanted
+        self.stats = None
+        self.stats_consumed = 0
+
+    def set_large_values(self, enabled):
+        """
+        Enable or disable the large-values extension in both directions.  This
+        must only be called at a point where both sides of the connection
+        agree to switch.
+        """
+        self.large_values = enabled
+        self.decoder.large_values = enabled
+
+    def set_compression(self, enabled):
+        """
+        Enable or disable the compression extension in both directions.  Each
+        direction has its own compression context, which lasts as long as the
+        extension is enabled.  As for set_large_values, both sides must agree
+        on the point at which this takes effect.
+        """
+        if enabled:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+            self.decoder.decompressor = zlib.decompressobj(-15)
+        else:
+            self.compressor = None
+            self.decoder.decompressor = None
+
+    def chunk_size(self):
+        """
+        Return the preferred size of the values in data boxes.
+        """
+        if self.large_values:
+            return LARGE_CHUNK_SIZE
+        if self.compressor:
+            return SMALL_COMPRESSED_CHUNK_SIZE
+        return SMALL_CHUNK_SIZE
 
     def send_box(self, box):
         if self.debug:
             print ">> ", box
-        bytes = self._box_to_bytes(box)
-        self.xport.write(bytes)
+        size = self._encode_box(box, self.write_buf)
+        self.write_len += size
+        if self.stats:
+            self.stats.box_sent(size)
+        if not self.corked or self.write_len >= self.max_buffered:
+            self.flush()
 
-    def read_box(self):
-        # avoid reading anything from the socket if not necessary
-        if self.read_buf:
-            box, self.read_buf = self._bytes_to_box(self.read_buf)
-            if box:
-                return box
+    def can_pass_fds(self):
+        """
+        Return true if file descriptors can be passed over this wire.
+        """
+        return getattr(self.xport, 'can_pass_fds', False)
+
+    def send_box_with_fd(self, box, fd):
+        """
+        Send BOX, passing a copy of the open file descriptor FD along with it.
+        The receiver claims the descriptor with take_fd after reading the box.
+        """
+        if self.debug:
+            print ">> ", box, "+ fd", fd
+        self.flush()
+        bytes = []
+        size = self._encode_box(box, bytes)
+        if self.stats:
+            self.stats.box_sent(size)
+        self.xport.write_fds(''.join(bytes), [fd])
+
+    def take_fd(self):
+        """
+        Return the file descriptor that arrived with the most recently read
+        box that carried one.  Raises Error if none is available.
+        """
+        if not self.can_pass_fds():
+            raise Error("file descriptor passing is not supported")
+        try:
+            return self.xport.take_fd()
+        except XportError, e:
+            raise Error(str(e))
+
+    def can_send_raw(self):
+        """
+        Return true if raw bytes may be sent between boxes with
+        send_raw_file.  This is not possible with compression, since raw
+        bytes are sent as they are.
+        """
+        return not self.compressor
+
+    def send_raw_file(self, file, offset, count):
+        """
+        Flush any buffered boxes, then write COUNT bytes of the open FILE,
+        starting at OFFSET, directly to the transport, where the transport
+        allows without copying them through Python.  If the file ends first,
+        zero bytes are written in place of the rest, so the other side still
+        receives COUNT bytes.  Returns the number of bytes taken from the
+        file.
+        """
+        self.flush()
+        if self.stats:
+            start = time.time()
+        sent = self.xport.sendfile(file, offset, count)
+        if sent < count:
+            pad = '\0' * min(count - sent, 65536)
+            padded = sent
+            while padded < count:
+                chunk = pad[:count - padded]
+                self.xport.write(chunk)
+                padded += len(chunk)
+        if self.stats:
+            self.stats.wrote(count, time.time() - start)
+        return sent
+
+    def read_raw(self, count, file):
+        """
+        Read COUNT raw bytes, sent with send_raw_file, from between boxes, and
+        write them to FILE.  If writing to FILE fails, the remaining bytes are
+        still read, and then the IOError is raised.  Raises EOFError if the
+        connection ends first.
+        """
+        error = [None]
+
+        def write(data):
+            if error[0] is None:
+                try:
+                    file.write(data)
+                except IOError, e:
+                    error[0] = e
+
+        data = self.decoder.take(count)
+        if data:
+            write(data)
+            count -= len(data)
+
+        # where the transport allows, read straight into a buffer, rather than
+        # into a new string for each read
+        readinto = getattr(self.xport, 'readinto', None)
+        if readinto:
+            buf = bytearray(min(count, RAW_BUFFER_SIZE))
+            view = memoryview(buf)
+        while count:
+            if self.stats:
+                start = time.time()
+            if readinto:
+                got = readinto(view[:min(count, len(buf))])
+                data = buffer(buf, 0, got)
+            else:
+                data = self.xport.read()
+                got = len(data)
+                if got > count:
+                    # the start of the next box
+                    self.decoder.feed(buffer(data, count))
+                    data = buffer(data, 0, count)
+                    got = count
+            if self.stats:
+                self.stats.read(got, time.time() - start)
+            if not got:
+                raise EOFError
+            write(data)
+            count -= got
+
+        if error[0] is not None:
+            raise error[0]
+
+    def cork(self):
+        """
+        Buffer outgoing boxes until a matching call to uncork(), so that
+        several boxes can be written to the transport at once.  Calls nest.
+        Buffered boxes are flushed before blocking in read_box, unless
+        flush_before_read is false (when another thread does the writing).
+        """
+        self.corked += 1
 
+    def uncork(self):
+        self.corked -= 1
+        if not self.corked:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any buffered boxes to the transport.
+        """
+        if not self.write_buf:
+            return
+        data = ''.join(self.write_buf)
+        self.write_buf = []
+        self.write_len = 0
+        if self.stats:
+            start = time.time()
+            self.xport.write(data)
+            self.stats.wrote(len(data), time.time() - start)
+        else:
+            self.xport.write(data)
+
+    def read_box(self):
+        decoder = self.decoder
         while 1:
-            newd = self.xport.read()
-            if not newd:
-                if self.read_buf != '':
-                    raise EOFError
-                return None
-            box, self.read_buf = self._bytes_to_box(self.read_buf + newd)
+            # avoid reading anything from the socket if not necessary
+            box = decoder.next_box()
             if box is not None:
                 if self.debug:
                     print "<< ", box
+                if self.stats:
+                    self._box_received_stats()
                 return box
 
+            # the other side may be waiting for our output before it answers
+            if self.flush_before_read:
+                self.flush()
+            if self.stats:
+                start = time.time()
+                newd = self.xport.read()
+                self.stats.read(len(newd), time.time() - start)
+            else:
+                newd = self.xport.read()
+            if not newd:
+                if decoder.pending():
+                    raise EOFError
+                return None
+            decoder.feed(newd)
+
     def close(self):
+        self.flush()
         self.xport.close()
 
     ##
     # Utility functions
 
+    def _box_received_stats(self):
+        # boxes are contiguous, so each box's size is the number of bytes
+        # parsed since the previous box
+        consumed = self.decoder.consumed
+        self.stats.box_received(consumed - self.stats_consumed)
+        self.stats_consumed = consumed
+
     def _box_to_bytes(self, box):
         """
         Turn a box into a byte sequence.  Raises an Error for an
         invalid packet.
         """
         bytes = []
+        self._encode_box(box, bytes)
+        return ''.join(bytes)
+
+    def _encode_box(self, box, bytes):
+        """
+        Append the byte strings representing a box to the list BYTES, and
+        return their total length.  Raises an Error for an invalid packet,
+        in which case BYTES is not modified.
+        """
+        if not self.compressor:
+            for schema in _schemas_by_size.get(len(box), ()):
+                total = schema.encode(box, bytes)
+                if total is not None:
+                    return total
+
+        if self.large_values:
+            max_len = MAX_LARGE_VALUE
+        else:
+            max_len = 65535
+
+        # validate everything before compressing anything, since the
+        # compression context cannot be rewound
+        items = []
         for k, v in box.iteritems():
             if type(k) != types.StringType:
                 k = str(k)
@@ -63,14 +577,33 @@ class Wire(object):
                 raise Error("key length must be < 256")
             if len(k) < 1:
                 raise Error("key length must be nonzero")
-            bytes.append(struct.pack("!H", len(k)) + k)
             if type(v) != types.StringType:
                 v = str(v)
+            if len(v) > max_len:
+                raise Error("value length must be <= %d" % max_len)
+            items.append((k, v))
+
+        pieces = []
+        total = 2
+        for k, v in items:
+            klen = len(k)
+            if (self.compressor and len(v) >= self.compress_threshold
+                    and _compress_bound(len(v)) <= max_len):
+                v = (self.compressor.compress(v)
+                     + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+                klen |= COMPRESSED_FLAG
             if len(v) > 65535:
-                raise Error("value length must be <= 65535")
-            bytes.append(struct.pack("!H", len(v)) + str(v))
-        bytes.append('\x00\x00')
-        return ''.join(bytes)
+                pieces.append(struct.pack("!H", klen | LARGE_VALUE_FLAG) + k)
+                pieces.append(struct.pack("!I", len(v)))
+                total += 6 + len(k) + len(v)
+            else:
+                pieces.append(struct.pack("!H", klen) + k)
+                pieces.append(struct.pack("!H", len(v)))
+                total += 4 + len(k) + len(v)
+            pieces.append(v)
+        pieces.append('\x00\x00')
+        bytes.extend(pieces)
+        return total
 
     def _bytes_to_box(self, bytes):
         """
@@ -78,44 +611,93 @@ class Wire(object):
         is None if a full box's worth of data is not available.  Raises an
         Error for an invalid packet.
         """
+        decoder = BoxDecoder()
+        decoder.feed(bytes)
+        box = decoder.next_box()
+        if box is None:
+            return (None, bytes) # not enough bytes
+        return (box, decoder.remaining())
 
-        # see if we have a full box
-        pos = 0
-        nbytes = len(bytes)
-        while 1:
-            if pos + 2 > nbytes:
-                return (None, bytes) # not enough bytes
-            klen = struct.unpack("!H", bytes[pos:pos + 2])[0]
-            if klen >= 256:
-                raise Error("invalid key length 0x%04x" % klen)
-            if klen == 0:
-                break # found a full box
-            if pos + 2 + klen + 2 > nbytes:
-                return (None, bytes)
-            vlen = struct.unpack("!H",
-                bytes[pos + 2 + klen:pos + 2 + klen + 2])[0]
-            if pos + 2 + klen + 2 + vlen > nbytes:
-                return (None, bytes)
-            pos += 2 + klen + 2 + vlen
-
-        # at this point, bytes[0:pos+2] is a full box, so convert it to
-        # a dictionary and return it
-        remaining = bytes[pos + 2:]
-        pos = 0
-        box = {}
+
+class AsyncWire(object):
+    """
+
+    The box encoding and decoding of a Wire, for use with non-blocking
+    transports and event loops.  It has no transport: bytes passed to
+    data_received are turned into boxes, and the bytes of outgoing boxes
+    accumulate until they are collected with take_output.  Since nothing is
+    read or written here, there is no read_box, cork or flush.
+
+    """
+
+    def __init__(self):
+        self.decoder = BoxDecoder()
+        self.write_buf = []
+        self.write_len = 0
+        self.large_values = False
+        self.compressor = None
+        self.compress_threshold = 128
+        self.debug = 0
+        # a remsh.stats.WireStats instance, if statistics are wanted
+        self.stats = None
+        self.stats_consumed = 0
+
+    # the extensions and the encoding are exactly as for a Wire
+    set_large_values = Wire.set_large_values.im_func
+    set_compression = Wire.set_compression.im_func
+    chunk_size = Wire.chunk_size.im_func
+    _encode_box = Wire._encode_box.im_func
+    _box_received_stats = Wire._box_received_stats.im_func
+
+    def send_box(self, box):
+        if self.debug:
+            print ">> ", box
+        size = self._encode_box(box, self.write_buf)
+        self.write_len += size
+        if self.stats:
+            self.stats.box_sent(size)
+
+    def data_received(self, data):
+        """
+        Add DATA to the incoming bytestream, and return a list of any boxes it
+        completed.
+        """
+        if self.stats:
+            # a non-blocking transport never waits for data
+            self.stats.read(len(data), 0.0)
+        self.decoder.feed(data)
+        boxes = []
         while 1:
-            klen = struct.unpack("!H", bytes[pos:pos + 2])[0]
-            key = bytes[pos + 2:pos + 2 + klen]
-            if klen == 0:
-                break
+            box = self.decoder.next_box()
+            if box is None:
+                return boxes
+            if self.debug:
+                print "<< ", box
+            if self.stats:
+                self._box_received_stats()
+            boxes.append(box)
 
-            vlen = struct.unpack("!H",
-                bytes[pos + 2 + klen:pos + 2 + klen + 2])[0]
+    def eof_received(self):
+        """
+        Note that the incoming bytestream has ended; raises EOFError if this
+        was in the middle of a box.
+        """
+        if self.decoder.pending():
+            raise EOFError
 
-            val = bytes[pos + 2 + klen + 2:pos + 2 + klen + 2 + vlen]
-            if key in box:
-                raise Error("duplicate key %r" % key)
-            box[key] = val
-            pos += 2 + klen + 2 + vlen
+    def pending_output(self):
+        """
+        Return the number of bytes of output waiting to be collected.
+        """
+        return self.write_len
 
-        return (box, remaining)
+    def take_output(self):
+        """
+        Return and forget all of the waiting output, as a string.
+        """
+        data = ''.join(self.write_buf)
+        self.write_buf = []
+        self.write_len = 0
+        if self.stats:
+            self.stats.wrote(len(data), 0.0)
+        return data
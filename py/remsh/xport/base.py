@@ -3,6 +3,10 @@
 # See COPYING for license information
 
 
+# size of the reads made by Xport.sendfile
+SENDFILE_BUFFER_SIZE = 1024 * 1024
+
+
 class Error(Exception):
     "Transport-layer error"
 
@@ -38,3 +42,71 @@ class Xport(object):
         Close the connection.
 
         """
+
+    def sendfile(self, file, offset, count):
+        """
+
+        Write COUNT bytes of the open FILE, starting at OFFSET, to the
+        connection.  Returns the number of bytes written, which is less than
+        COUNT only if the file ends first, or cannot be read.  Transports over
+        a file descriptor override this to have the kernel copy the data;
+        this version reads it into memory and writes it.
+
+        """
+        sent = 0
+        while sent < count:
+            try:
+                file.seek(offset + sent)
+                data = file.read(min(count - sent, SENDFILE_BUFFER_SIZE))
+            except (IOError, OSError):
+                break
+            if not data:
+                break
+            self.write(data)
+            sent += len(data)
+        return sent
+
+    # Transports which can be driven by an event loop set 'can_poll' and
+    # implement the following methods.  A transport should be used either with
+    # the blocking methods above or with these, not both.
+
+    can_poll = False
+
+    def fileno(self):
+        """
+
+        Return a file descriptor which becomes readable when read_nonblocking
+        may return data or EOF, and writable when flush_nonblocking may make
+        progress.
+
+        """
+
+    def read_nonblocking(self):
+        """
+
+        Like read, but return None instead of blocking if no data is
+        available.
+
+        """
+
+    def write_nonblocking(self, data):
+        """
+
+        Queue DATA for transmission, and write as much of the queue as
+        possible without blocking.
+
+        """
+
+    def flush_nonblocking(self):
+        """
+
+        Write as much of the queued data as possible without blocking.
+
+        """
+
+    def wants_write(self):
+        """
+
+        Return true if queued data remains to be written.
+
+        """
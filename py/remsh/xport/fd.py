@@ -1,10 +1,14 @@
 # This file is part of remsh
 # Copyright 2009, 2010 Dustin J. Mitchell
 # See COPYING for license information
+# -*- test-case-name: test.test_xport_fd -*-
 
 import os
+import errno
+import fcntl
 
 from remsh.xport.base import Error, Xport
+from remsh.xport.sendfile import sendfile, SendfileUnsupported
 
 
 class FDXport(Xport):
@@ -12,13 +16,24 @@ class FDXport(Xport):
 
     Base class for file-descriptor-based transports.  Not for use by users.
 
+    The non-blocking methods put the descriptor in non-blocking mode when
+    first used, after which the blocking methods must not be used.
+
     """
 
+    read_size = 32768
+    can_poll = True
+
     def __init__(self, fd):
         self.fd = fd
+        self.nonblocking = False
+        # data queued by write_nonblocking, and the offset of the unsent part
+        # of its first element
+        self.outq = []
+        self.outpos = 0
 
     def read(self):
-        return os.read(self.fd, 32768)
+        return os.read(self.fd, self.read_size)
 
     def write(self, data):
         while data:
@@ -28,10 +43,67 @@ class FDXport(Xport):
             else:
                 break
 
+    def sendfile(self, file, offset, count):
+        try:
+            return sendfile(self.fd, file.fileno(), offset, count)
+        except SendfileUnsupported:
+            return Xport.sendfile(self, file, offset, count)
+        except OSError, e:
+            raise Error(str(e))
+
+    def fileno(self):
+        return self.fd
+
+    def read_nonblocking(self):
+        self._set_nonblocking()
+        while 1:
+            try:
+                return os.read(self.fd, self.read_size)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                if e.errno == errno.ECONNRESET:
+                    return ''
+                raise Error(str(e))
+
+    def write_nonblocking(self, data):
+        if data:
+            self.outq.append(data)
+        self.flush_nonblocking()
+
+    def flush_nonblocking(self):
+        self._set_nonblocking()
+        outq = self.outq
+        while outq:
+            data = outq[0]
+            try:
+                sent = os.write(self.fd, buffer(data, self.outpos))
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise Error(str(e))
+            self.outpos += sent
+            if self.outpos == len(data):
+                outq.pop(0)
+                self.outpos = 0
+
+    def wants_write(self):
+        return bool(self.outq)
+
     def close(self):
         os.close(self.fd)
         self.fd = -1
 
+    def _set_nonblocking(self):
+        if not self.nonblocking:
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.nonblocking = True
+
     def __del__(self):
         if self.fd >= 0:
             os.close(self.fd)
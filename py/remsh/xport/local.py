@@ -3,43 +3,110 @@
 # See COPYING for license information
 # -*- test-case-name: test.test_xport_local -*-
 
-import os
-import Queue
+import threading
 
 from remsh.xport.base import Error, Xport
 
 
+class _Pipe(object):
+    """
+
+    One direction of a pair of LocalXports: a buffer shared by a writer and a
+    reader.  Written strings are queued without copying, and a read takes and
+    joins everything queued.  A writer blocks while the buffer holds CAPACITY
+    bytes or more.
+
+    """
+
+    def __init__(self, capacity):
+        self.cond = threading.Condition(threading.Lock())
+        self.chunks = []
+        self.size = 0
+        self.capacity = capacity
+        self.writer_closed = False
+        self.reader_closed = False
+
+    def read(self):
+        self.cond.acquire()
+        try:
+            while not self.chunks:
+                if self.writer_closed or self.reader_closed:
+                    return ''
+                self.cond.wait()
+            chunks = self.chunks
+            self.chunks = []
+            self.size = 0
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunks)
+
+    def write(self, data):
+        self.cond.acquire()
+        try:
+            while self.size >= self.capacity and not self.reader_closed:
+                self.cond.wait()
+            if self.reader_closed:
+                return # nobody will read this data
+            self.chunks.append(data)
+            self.size += len(data)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def close_writer(self):
+        self.cond.acquire()
+        try:
+            self.writer_closed = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def close_reader(self):
+        self.cond.acquire()
+        try:
+            self.reader_closed = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+
 class LocalXport(Xport):
     """
 
     A process-local transport; created in pairs by the 'create' class method.
+    A write blocks while CAPACITY bytes or more are waiting in its direction,
+    so a writer cannot get far ahead of its reader.  Each read returns all of
+    the data available, coalescing any number of writes.
 
     """
 
+    # default buffer capacity in each direction
+    capacity = 1024 * 1024
+
     @classmethod
-    def create(cls):
-        up = Queue.Queue()
-        down = Queue.Queue()
+    def create(cls, capacity=None):
+        if capacity is None:
+            capacity = cls.capacity
+        up = _Pipe(capacity)
+        down = _Pipe(capacity)
         top = cls(up, down)
         bottom = cls(down, up)
         return (top, bottom)
 
-    def __init__(self, input_queue, output_queue):
-        self.input_queue = input_queue
-        self.output_queue = output_queue
+    def __init__(self, input_pipe, output_pipe):
+        self.input_pipe = input_pipe
+        self.output_pipe = output_pipe
 
     def read(self):
-        rv = self.input_queue.get()
-        if not rv:
-            # re-push the EOF
-            self.input_queue.put(rv)
-        return rv
+        return self.input_pipe.read()
 
     def write(self, data):
         if data:
-            self.output_queue.put(data)
+            self.output_pipe.write(data)
 
     def close(self):
-        self.input_queue = None
-        self.output_queue.put('')
-        self.output_queue = None
+        self.input_pipe.close_reader()
+        self.output_pipe.close_writer()
@@ -0,0 +1,69 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_fd -*-
+
+import os
+import sys
+import errno
+import ctypes
+import ctypes.util
+
+# Python 2 has no os.sendfile, so the C library is called directly.  Linux's
+# sendfile can write to any descriptor, including sockets and pipes; on other
+# platforms, the transports copy file data through Python instead.
+
+
+class SendfileUnsupported(Exception):
+    "sendfile cannot copy between these descriptors"
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # the 64-bit variant takes a 64-bit offset on 32-bit platforms, too
+        fn = libc.sendfile64
+    except (OSError, AttributeError):
+        return None
+    fn.argtypes = [ctypes.c_int, ctypes.c_int,
+                   ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    fn.restype = ctypes.c_ssize_t
+    return fn
+
+_sendfile = _load_libc()
+
+# largest count passed to a single sendfile call
+MAX_SENDFILE = 0x7ffff000
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """
+    Copy up to COUNT bytes from the file IN_FD, starting at OFFSET, to the
+    descriptor OUT_FD, without the data passing through this process.  The
+    file position of IN_FD is not used or changed.  Returns the number of
+    bytes copied, which is less than COUNT only if the file ends first.
+
+    Raises SendfileUnsupported, having copied nothing, if this platform or
+    this pair of descriptors does not support sendfile, and OSError for other
+    errors.
+    """
+    if _sendfile is None:
+        raise SendfileUnsupported("sendfile is not available")
+    off = ctypes.c_int64(offset)
+    copied = 0
+    while copied < count:
+        result = _sendfile(out_fd, in_fd, ctypes.byref(off),
+                           min(count - copied, MAX_SENDFILE))
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            if not copied and err in (errno.EINVAL, errno.ENOSYS):
+                raise SendfileUnsupported("sendfile is not supported here")
+            raise OSError(err, os.strerror(err))
+        if result == 0:
+            break
+        copied += result
+    return copied
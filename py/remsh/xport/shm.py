@@ -0,0 +1,277 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_shm -*-
+
+import os
+import mmap
+import errno
+import fcntl
+import select
+import struct
+import platform
+import tempfile
+
+from remsh.xport.base import Error, Xport
+
+# Layout of the shared region, which is shared with the C implementation in
+# c/lib/xport-shm.c.  The region begins with a header:
+#
+#   0   u32 magic
+#   4   u32 ring size
+#
+# followed by two rings, one for each direction, at REGION_HEADER and
+# REGION_HEADER + RING_HEADER + ring size.  Each ring has a header:
+#
+#   0   u64 head: total bytes written (written only by the producer)
+#   8   u32 closed: the producer has closed the ring
+#   12  u32 reader_waiting: the consumer is waiting for data
+#   64  u64 tail: total bytes read (written only by the consumer)
+#   72  u32 writer_waiting: the producer is waiting for space
+#   76  u32 reader_closed: the consumer has closed the ring
+#
+# followed by the ring data.  Side 0 writes to the first ring and reads from
+# the second, and side 1 does the opposite.  Integers are in native byte
+# order, since both sides are on the same host.
+
+MAGIC = 0x52534d31 # 'RSM1'
+REGION_HEADER = 64
+RING_HEADER = 128
+
+_HEAD, _CLOSED, _READER_WAITING = 0, 8, 12
+_TAIL, _WRITER_WAITING, _READER_CLOSED = 64, 72, 76
+
+_u32 = struct.Struct("=I")
+_u64 = struct.Struct("=Q")
+_header = struct.Struct("=II")
+
+# Python has no memory barriers, so the Python side relies on the processor
+# keeping stores in order with other stores, and loads with other loads, as
+# x86 does.  The data is then always visible before the head or tail which
+# publishes it, as the C side ensures with __sync_synchronize.  Loads may
+# still pass earlier stores, so a waiting flag can be missed, which only costs
+# a wait_timeout.
+ORDERED_MACHINES = ('i386', 'i486', 'i586', 'i686', 'i86pc', 'x86',
+                    'x86_64', 'amd64', 'AMD64')
+
+
+def _check_machine():
+    machine = platform.machine()
+    if machine not in ORDERED_MACHINES:
+        raise Error("shared-memory transports need x86 memory ordering, "
+                    "not %s" % (machine or 'an unknown machine',))
+
+
+def region_size(ring_size):
+    return REGION_HEADER + 2 * (RING_HEADER + ring_size)
+
+
+class ShmXport(Xport):
+    """
+
+    A transport between two processes on the same host, through a pair of
+    ring buffers in a shared memory region.  Each side has a wakeup pipe,
+    which the other side writes to only when the first is waiting; the data
+    itself never passes through the kernel.
+
+    Pairs are created with the 'create' class method.  To connect two
+    processes, create a pair, fork, and 'release' the unused end in each
+    process, or pass the region and pipe descriptors for one end to the other
+    process (see 'fds') and construct it there.
+
+    A side whose waiting flag was missed still wakes up after wait_timeout
+    seconds.  If the other process exits without closing the transport, this
+    is detected through the wakeup pipe, as long as neither process holds
+    descriptors for both ends.  The Python implementation relies on x86
+    memory ordering, and raises Error on other processors.
+
+    """
+
+    ring_size = 1024 * 1024
+    wait_timeout = 0.1
+
+    @classmethod
+    def create(cls, ring_size=None):
+        if ring_size is None:
+            ring_size = cls.ring_size
+        _check_machine()
+        memfile = tempfile.TemporaryFile()
+        try:
+            os.ftruncate(memfile.fileno(), region_size(ring_size))
+            mem = mmap.mmap(memfile.fileno(), region_size(ring_size),
+                            mmap.MAP_SHARED)
+            _header.pack_into(mem, 0, MAGIC, ring_size)
+            mem.close()
+
+            r0, w0 = os.pipe()
+            r1, w1 = os.pipe()
+            top = cls(memfile.fileno(), 0, r0, w1)
+            bottom = cls(memfile.fileno(), 1, r1, w0)
+        finally:
+            memfile.close()
+        return (top, bottom)
+
+    def __init__(self, mem_fd, side, wake_fd, peer_wake_fd):
+        """
+        Attach to the region in MEM_FD as SIDE (0 or 1).  WAKE_FD is the read
+        end of this side's wakeup pipe, and PEER_WAKE_FD the write end of the
+        other side's; this object owns both descriptors.
+        """
+        _check_machine()
+        size = os.fstat(mem_fd).st_size
+        self.mem = mmap.mmap(mem_fd, size, mmap.MAP_SHARED)
+        magic, ring_size = _header.unpack_from(self.mem, 0)
+        if magic != MAGIC or region_size(ring_size) != size:
+            self.mem.close()
+            raise Error("not a shared-memory transport region")
+        self.size = ring_size
+        self.side = side
+
+        first = REGION_HEADER
+        second = REGION_HEADER + RING_HEADER + ring_size
+        if side == 0:
+            self.out_ring, self.in_ring = first, second
+        else:
+            self.out_ring, self.in_ring = second, first
+
+        self.wake_fd = wake_fd
+        self.peer_wake_fd = peer_wake_fd
+        for fd in wake_fd, peer_wake_fd:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.closed = False
+        self.peer_gone = False
+
+    def fds(self):
+        """
+        Return the descriptors needed to construct this end in another
+        process: (wake_fd, peer_wake_fd).  The region itself can be shared
+        by passing any descriptor for the same file.
+        """
+        return (self.wake_fd, self.peer_wake_fd)
+
+    def read(self):
+        mem = self.mem
+        ring = self.in_ring
+        while 1:
+            if self.closed:
+                return ''
+            head = _u64.unpack_from(mem, ring + _HEAD)[0]
+            tail = _u64.unpack_from(mem, ring + _TAIL)[0]
+            if head != tail:
+                data = self._copy_out(ring, tail, head - tail)
+                _u64.pack_into(mem, ring + _TAIL, head)
+                if _u32.unpack_from(mem, ring + _WRITER_WAITING)[0]:
+                    self._wake_peer()
+                return data
+            if _u32.unpack_from(mem, ring + _CLOSED)[0] or self.peer_gone:
+                return ''
+            self._wait(ring + _READER_WAITING,
+                       lambda: (_u64.unpack_from(mem, ring + _HEAD)[0] != head
+                                or _u32.unpack_from(mem, ring + _CLOSED)[0]))
+
+    def write(self, data):
+        mem = self.mem
+        ring = self.out_ring
+        pos = 0
+        while pos < len(data):
+            if self.closed:
+                raise Error("transport is closed")
+            if (_u32.unpack_from(mem, ring + _READER_CLOSED)[0]
+                    or self.peer_gone):
+                return # nobody will read this data
+            head = _u64.unpack_from(mem, ring + _HEAD)[0]
+            tail = _u64.unpack_from(mem, ring + _TAIL)[0]
+            free = self.size - (head - tail)
+            if not free:
+                self._wait(ring + _WRITER_WAITING,
+                           lambda: (_u64.unpack_from(mem, ring + _TAIL)[0]
+                                        != tail
+                                    or _u32.unpack_from(mem,
+                                            ring + _READER_CLOSED)[0]))
+                continue
+            count = min(free, len(data) - pos)
+            self._copy_in(ring, head, data, pos, count)
+            _u64.pack_into(mem, ring + _HEAD, head + count)
+            pos += count
+            if _u32.unpack_from(mem, ring + _READER_WAITING)[0]:
+                self._wake_peer()
+
+    def close(self):
+        if self.closed:
+            return
+        _u32.pack_into(self.mem, self.out_ring + _CLOSED, 1)
+        _u32.pack_into(self.mem, self.in_ring + _READER_CLOSED, 1)
+        self._wake_peer()
+        # another thread may still be waiting in read or write, so the region
+        # and pipes are released only when this object is freed
+        self.closed = True
+
+    def release(self):
+        """
+        Release this process's resources for this end, without closing the
+        connection.  After a fork, call this in the process which does not
+        use this end.
+        """
+        if self.mem is None:
+            return
+        self.closed = True
+        self.mem.close()
+        self.mem = None
+        os.close(self.wake_fd)
+        os.close(self.peer_wake_fd)
+
+    def __del__(self):
+        if getattr(self, 'mem', None) is not None:
+            self.release()
+
+    ## utilities
+
+    def _copy_out(self, ring, tail, count):
+        base = ring + RING_HEADER
+        start = tail % self.size
+        first = min(count, self.size - start)
+        data = self.mem[base + start:base + start + first]
+        if first < count:
+            data += self.mem[base:base + count - first]
+        return data
+
+    def _copy_in(self, ring, head, data, pos, count):
+        base = ring + RING_HEADER
+        start = head % self.size
+        first = min(count, self.size - start)
+        self.mem[base + start:base + start + first] = data[pos:pos + first]
+        if first < count:
+            self.mem[base:base + count - first] = \
+                    data[pos + first:pos + count]
+
+    def _wait(self, flag, ready):
+        # set the waiting flag, then check once more before sleeping, so that
+        # the other side either sees the flag or made the change first
+        _u32.pack_into(self.mem, flag, 1)
+        try:
+            if not ready():
+                select.select([self.wake_fd], [], [], self.wait_timeout)
+            self._drain_wakeups()
+        finally:
+            _u32.pack_into(self.mem, flag, 0)
+
+    def _wake_peer(self):
+        try:
+            os.write(self.peer_wake_fd, 'w')
+        except OSError, e:
+            # a full pipe already holds a wakeup; a closed one needs none
+            if e.errno not in (errno.EAGAIN, errno.EPIPE):
+                raise
+
+    def _drain_wakeups(self):
+        try:
+            while 1:
+                if not os.read(self.wake_fd, 4096):
+                    # every copy of the peer's end of the pipe is closed, so
+                    # the peer exited without closing the transport
+                    self.peer_gone = True
+                    return
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
@@ -0,0 +1,163 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_sock -*-
+
+import socket
+import errno
+
+from remsh.xport.base import Error, Xport
+from remsh.xport.sendfile import sendfile, SendfileUnsupported
+
+
+class SocketXport(Xport):
+    """
+
+    A transport over a connected stream socket, which it owns.  Reads use
+    recv_into with a preallocated buffer, so each read can return up to
+    read_size bytes without allocating a buffer of that size.
+
+    Since the wire layer batches its writes, Nagle's algorithm only adds
+    latency, and TCP_NODELAY is set by default.  The other options are left to
+    the operating system unless given; see set_options.
+
+    The non-blocking methods use MSG_DONTWAIT, so the socket itself is left in
+    blocking mode.
+
+    """
+
+    read_size = 262144
+    can_poll = True
+
+    def __init__(self, sock, nodelay=True, **options):
+        self.sock = sock
+        self.buf = bytearray(self.read_size)
+        self.closed = False
+        # data queued by write_nonblocking, and the offset of the unsent part
+        # of its first element
+        self.outq = []
+        self.outpos = 0
+        self.set_options(nodelay=nodelay, **options)
+
+    def set_options(self, nodelay=None, sndbuf=None, rcvbuf=None,
+                    keepalive=None, keepidle=None, keepintvl=None,
+                    keepcnt=None):
+        """
+        Set socket options; options that are None are not changed.  NODELAY
+        and KEEPALIVE are booleans, SNDBUF and RCVBUF are buffer sizes in
+        bytes, and KEEPIDLE, KEEPINTVL and KEEPCNT tune keepalive probes
+        where the platform supports it.  TCP options are ignored for non-TCP
+        sockets.
+        """
+        sock = self.sock
+        tcp = sock.family in (socket.AF_INET, socket.AF_INET6)
+        if sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        if keepalive is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE,
+                            keepalive and 1 or 0)
+        if not tcp:
+            return
+        if nodelay is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY,
+                            nodelay and 1 or 0)
+        for name, value in [('TCP_KEEPIDLE', keepidle),
+                            ('TCP_KEEPINTVL', keepintvl),
+                            ('TCP_KEEPCNT', keepcnt)]:
+            if value is not None and hasattr(socket, name):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name),
+                                value)
+
+    def read(self):
+        return self._read(0)
+
+    def write(self, data):
+        try:
+            self.sock.sendall(data)
+        except socket.error, e:
+            raise Error(str(e))
+
+    def sendfile(self, file, offset, count):
+        try:
+            return sendfile(self.sock.fileno(), file.fileno(), offset, count)
+        except SendfileUnsupported:
+            return Xport.sendfile(self, file, offset, count)
+        except OSError, e:
+            raise Error(str(e))
+
+    def readinto(self, buf):
+        """
+        Read into the writable buffer BUF, as for read, returning the number
+        of bytes read.  This saves a copy when the caller has somewhere to put
+        the data.
+        """
+        while 1:
+            try:
+                return self.sock.recv_into(buf)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECONNRESET or self.closed:
+                    return 0
+                raise Error(str(e))
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def read_nonblocking(self):
+        return self._read(socket.MSG_DONTWAIT)
+
+    def write_nonblocking(self, data):
+        if data:
+            self.outq.append(data)
+        self.flush_nonblocking()
+
+    def flush_nonblocking(self):
+        outq = self.outq
+        while outq:
+            data = outq[0]
+            try:
+                sent = self.sock.send(buffer(data, self.outpos),
+                                      socket.MSG_DONTWAIT)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise Error(str(e))
+            self.outpos += sent
+            if self.outpos == len(data):
+                outq.pop(0)
+                self.outpos = 0
+
+    def wants_write(self):
+        return bool(self.outq)
+
+    def _read(self, flags):
+        while 1:
+            try:
+                return self._recv(flags)
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if flags and e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return None
+                if e.errno == errno.ECONNRESET or self.closed:
+                    return ''
+                raise Error(str(e))
+
+    def _recv(self, flags):
+        count = self.sock.recv_into(self.buf, 0, flags)
+        return str(buffer(self.buf, 0, count))
+
+    def close(self):
+        # shut the socket down first, so that a thread blocked reading from
+        # it wakes up
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass # already disconnected
+        self.sock.close()
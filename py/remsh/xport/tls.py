@@ -0,0 +1,142 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_tls -*-
+
+import socket
+import ssl
+
+from remsh.xport.base import Error, Xport
+from remsh.xport.sock import SocketXport
+from remsh.xport import tlssession
+
+# OpenSSL 3 reports a connection closed without a TLS close_notify as an error,
+# rather than as EOF.  The wire layer detects truncated boxes itself, and
+# transports close without close_notify, so restore the older behavior.
+OP_IGNORE_UNEXPECTED_EOF = 0x80
+
+def server_context(certfile, keyfile=None, cafile=None):
+    """
+    Return an SSLContext for the listening side, presenting the certificate
+    in CERTFILE (with its key in KEYFILE, or in CERTFILE itself).  If CAFILE
+    is given, the other side must present a certificate signed by one of the
+    authorities in it.  Use the same context for every connection, so that
+    returning clients can resume their sessions.
+    """
+    context = _context()
+    context.load_cert_chain(certfile, keyfile)
+    if cafile:
+        context.load_verify_locations(cafile)
+        context.verify_mode = ssl.CERT_REQUIRED
+    return context
+
+
+def client_context(cafile=None, certfile=None, keyfile=None):
+    """
+    Return an SSLContext for the connecting side, which verifies the server's
+    certificate against the authorities in CAFILE, or the system's default
+    authorities if CAFILE is None.  CERTFILE and KEYFILE give a client
+    certificate, if the server requires one.
+    """
+    context = _context()
+    context.verify_mode = ssl.CERT_REQUIRED
+    context.check_hostname = True
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs()
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+
+def _context():
+    context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+    context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3 | ssl.OP_NO_TLSv1 \
+                     | ssl.OP_NO_TLSv1_1
+    # box data is often already compressed, and the wire layer has its own
+    # compression extension
+    context.options |= ssl.OP_NO_COMPRESSION
+    if ssl.OPENSSL_VERSION_INFO >= (3,):
+        context.options |= OP_IGNORE_UNEXPECTED_EOF
+    return context
+
+
+class TLSXport(SocketXport):
+    """
+
+    A transport over a TLS connection on a connected socket.  CONTEXT is an
+    SSLContext from server_context or client_context; the handshake happens
+    in the constructor.  A client connecting to a host name should give it as
+    SERVER_HOSTNAME, for certificate checking.
+
+    A client can avoid a full handshake when it reconnects by passing the
+    'session' attribute of its previous transport as SESSION, if the server
+    used the same context and still has the session.  The 'session_reused'
+    attribute tells whether it did.  Python 2's ssl module cannot do this
+    itself, so remsh.xport.tlssession calls OpenSSL directly; where that is
+    not possible, SESSION is ignored and 'session' is always None.
+
+    The wire layer already coalesces each batch of boxes into a single write,
+    so writes become full-sized TLS records.  The non-blocking methods are not
+    supported, and 'can_poll' is false, since TLS may need to read in order to write, and sendfile
+    copies the data through Python, to encrypt it.
+
+    """
+
+    def __init__(self, sock, context, server_side=False,
+                 server_hostname=None, session=None, **options):
+        # set the socket options on the plain socket, before the handshake
+        SocketXport.__init__(self, sock, **options)
+        try:
+            # the session must be set between wrapping and the handshake
+            self.sock = context.wrap_socket(sock, server_side=server_side,
+                                            server_hostname=server_hostname,
+                                            do_handshake_on_connect=False)
+            if session is not None and not server_side:
+                tlssession.set_session(self.sock, session)
+            self.sock.do_handshake()
+        except (ssl.SSLError, ssl.CertificateError, socket.error), e:
+            sock.close()
+            raise Error("TLS handshake failed: %s" % (e,))
+
+    @classmethod
+    def connect(cls, address, context, session=None, **options):
+        """
+        Connect to ADDRESS, a (host, port) tuple, and return a new TLSXport.
+        The host name is used to check the server's certificate.
+        """
+        sock = socket.create_connection(address)
+        return cls(sock, context, server_hostname=address[0],
+                   session=session, **options)
+
+    @property
+    def session(self):
+        # with TLS 1.3, the server sends a resumable session only after the
+        # handshake, so this is best taken once data has been read
+        return tlssession.get_session(self.sock)
+
+    @property
+    def session_reused(self):
+        return tlssession.session_reused(self.sock)
+
+    def peer_certificate(self):
+        """
+        Return the other side's certificate, as a dictionary, or None.
+        """
+        return self.sock.getpeercert()
+
+    # the data must pass through the TLS layer to be encrypted
+    sendfile = Xport.sendfile.im_func
+
+    can_poll = False
+
+    def _nonblocking(self, *args):
+        raise Error("a TLS transport cannot be used without blocking")
+
+    fileno = read_nonblocking = write_nonblocking = flush_nonblocking = \
+        wants_write = _nonblocking
+
+    def _recv(self, flags):
+        count = self.sock.recv_into(self.buf)
+        return str(buffer(self.buf, 0, count))
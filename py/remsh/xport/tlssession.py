@@ -0,0 +1,140 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_tls -*-
+
+import ctypes
+
+import _ssl
+
+# Python 2's ssl module cannot carry a TLS session from one connection to the
+# next, so OpenSSL is called directly, through the same library that _ssl
+# uses.  The SSL pointer is found inside the _ssl socket object, where it
+# immediately precedes the pointer to the object's context; that pointer is
+# compared with the context before anything is called, so on an unfamiliar
+# build resumption is simply unavailable.
+
+
+def _load_libssl():
+    try:
+        lib = ctypes.CDLL(_ssl.__file__)
+        fns = {}
+        for name, restype, argtypes in [
+                ('SSL_get_session', ctypes.c_void_p, [ctypes.c_void_p]),
+                ('SSL_SESSION_dup', ctypes.c_void_p, [ctypes.c_void_p]),
+                ('SSL_set_session', ctypes.c_int,
+                    [ctypes.c_void_p, ctypes.c_void_p]),
+                ('SSL_SESSION_free', None, [ctypes.c_void_p]),
+                ('SSL_SESSION_is_resumable', ctypes.c_int,
+                    [ctypes.c_void_p]),
+                ('SSL_session_reused', ctypes.c_int, [ctypes.c_void_p]),
+                ('SSL_get_SSL_CTX', ctypes.c_void_p, [ctypes.c_void_p])]:
+            fn = getattr(lib, name)
+            fn.restype = restype
+            fn.argtypes = argtypes
+            fns[name] = fn
+    except (OSError, AttributeError):
+        # no shared _ssl module, or an OpenSSL older than 1.1.1
+        return None
+    return fns
+
+_libssl = _load_libssl()
+
+# the layout of the objects searched for pointers
+_POINTER_SIZE = ctypes.sizeof(ctypes.c_void_p)
+_HEAD_WORDS = 2     # PyObject_HEAD: reference count and type
+_MAX_WORDS = 8
+
+
+def _word(address):
+    return ctypes.c_void_p.from_address(address).value
+
+
+def _ssl_pointer(sslsock):
+    # Return the SSL pointer for the ssl.SSLSocket SSLSOCK, or None.
+    if _libssl is None:
+        return None
+    sslobj = getattr(sslsock, '_sslobj', None)
+    context = getattr(sslsock, 'context', None)
+    if sslobj is None or context is None:
+        return None
+    # a context object holds its SSL_CTX pointer just after its header
+    ssl_ctx = _word(id(context) + _HEAD_WORDS * _POINTER_SIZE)
+    for i in range(_HEAD_WORDS + 1, _MAX_WORDS):
+        if _word(id(sslobj) + i * _POINTER_SIZE) == id(context):
+            ssl = _word(id(sslobj) + (i - 1) * _POINTER_SIZE)
+            if ssl and _libssl['SSL_get_SSL_CTX'](ssl) == ssl_ctx:
+                return ssl
+            return None
+    return None
+
+
+def available(sslsock):
+    """
+    Return true if sessions can be carried to and from the ssl.SSLSocket
+    SSLSOCK.
+    """
+    return _ssl_pointer(sslsock) is not None
+
+
+class Session(object):
+    """
+
+    A TLS session from a previous connection, which a client can offer to
+    resume.  The underlying OpenSSL object is freed with this object.
+
+    """
+
+    def __init__(self, pointer):
+        self.pointer = pointer
+
+    def resumable(self):
+        return bool(_libssl['SSL_SESSION_is_resumable'](self.pointer))
+
+    def __del__(self):
+        if self.pointer and _libssl:
+            _libssl['SSL_SESSION_free'](self.pointer)
+            self.pointer = None
+
+
+def get_session(sslsock):
+    """
+    Return the Session of the ssl.SSLSocket SSLSOCK, or None if there is none
+    or sessions are unavailable.  With TLS 1.3, the server sends the session
+    after the handshake, so this is best called once data has been read.
+    """
+    ssl = _ssl_pointer(sslsock)
+    if ssl is None:
+        return None
+    pointer = _libssl['SSL_get_session'](ssl)
+    if not pointer:
+        return None
+    # OpenSSL marks the session of a connection which is closed without a TLS
+    # close_notify as not resumable, and transports close that way, so keep
+    # a copy of our own
+    pointer = _libssl['SSL_SESSION_dup'](pointer)
+    if not pointer:
+        return None
+    return Session(pointer)
+
+
+def set_session(sslsock, session):
+    """
+    Offer SESSION for resumption on the ssl.SSLSocket SSLSOCK, which must not
+    have done its handshake yet.  Returns true if the session was set.
+    """
+    ssl = _ssl_pointer(sslsock)
+    if ssl is None or not session.resumable():
+        return False
+    return _libssl['SSL_set_session'](ssl, session.pointer) == 1
+
+
+def session_reused(sslsock):
+    """
+    Return true if the handshake on the ssl.SSLSocket SSLSOCK resumed a
+    session.
+    """
+    ssl = _ssl_pointer(sslsock)
+    if ssl is None:
+        return False
+    return bool(_libssl['SSL_session_reused'](ssl))
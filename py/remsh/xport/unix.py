@@ -0,0 +1,194 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+# -*- test-case-name: test.test_xport_unix -*-
+
+import os
+import sys
+import socket
+import array
+import ctypes
+import ctypes.util
+
+from remsh.xport.base import Error
+from remsh.xport.sock import SocketXport
+
+# Python 2 has no socket.sendmsg or recvmsg, so file descriptors are passed by
+# calling the C library directly.  The structure layouts here are Linux's; on
+# other platforms, descriptor passing is simply unavailable.
+
+SCM_RIGHTS = 1
+MSG_CMSG_CLOEXEC = 0x40000000
+MSG_CTRUNC = 0x8
+
+# maximum number of descriptors accepted with a single read
+MAX_FDS = 16
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _cmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('cmsg_len', ctypes.c_size_t),
+        ('cmsg_level', ctypes.c_int),
+        ('cmsg_type', ctypes.c_int),
+    ]
+
+
+def _cmsg_align(length):
+    align = ctypes.sizeof(ctypes.c_size_t)
+    return (length + align - 1) & ~(align - 1)
+
+_CMSG_HDR_LEN = _cmsg_align(ctypes.sizeof(_cmsghdr))
+_FD_SIZE = ctypes.sizeof(ctypes.c_int)
+
+
+def _load_libc():
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.sendmsg, libc.recvmsg
+    except (OSError, AttributeError):
+        return None
+    for fn in libc.sendmsg, libc.recvmsg:
+        fn.argtypes = [ctypes.c_int, ctypes.POINTER(_msghdr), ctypes.c_int]
+        fn.restype = ctypes.c_ssize_t
+    return libc
+
+_libc = _load_libc()
+
+
+def _check(result):
+    if result < 0:
+        err = ctypes.get_errno()
+        raise socket.error(err, os.strerror(err))
+    return result
+
+
+class UnixXport(SocketXport):
+    """
+
+    A transport over a Unix-domain stream socket, which can also pass open file
+    descriptors to the other end, where the platform supports it.  Each
+    descriptor is attached to the bytes of a particular write, and received
+    descriptors are queued in order until claimed with take_fd.
+
+    """
+
+    @classmethod
+    def pair(cls):
+        """
+        Return a connected pair of UnixXports.
+        """
+        a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        return cls(a), cls(b)
+
+    @classmethod
+    def connect(cls, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        return cls(sock)
+
+    def __init__(self, sock, **options):
+        SocketXport.__init__(self, sock, **options)
+        self.can_pass_fds = _libc is not None
+        self.received_fds = []
+        if self.can_pass_fds:
+            self.cbuf = ctypes.create_string_buffer(self.read_size)
+            self.control = ctypes.create_string_buffer(
+                    _CMSG_HDR_LEN + _cmsg_align(MAX_FDS * _FD_SIZE))
+
+    def write_fds(self, data, fds):
+        """
+        Write DATA, passing copies of the file descriptors FDS along with it.
+        """
+        if not self.can_pass_fds:
+            raise Error("file descriptor passing is not supported")
+        try:
+            sent = self._sendmsg(data, fds)
+            if sent < len(data):
+                self.sock.sendall(buffer(data, sent))
+        except socket.error, e:
+            raise Error(str(e))
+
+    def take_fd(self):
+        """
+        Return the oldest file descriptor received and not yet claimed; the
+        caller is responsible for closing it.
+        """
+        if not self.received_fds:
+            raise Error("no file descriptor has been received")
+        return self.received_fds.pop(0)
+
+    def close(self):
+        SocketXport.close(self)
+        for fd in self.received_fds:
+            os.close(fd)
+        self.received_fds = []
+
+    def _sendmsg(self, data, fds):
+        databuf = ctypes.create_string_buffer(data, len(data))
+        iov = _iovec(ctypes.cast(databuf, ctypes.c_void_p), len(data))
+
+        fdbytes = array.array('i', fds).tostring()
+        control = ctypes.create_string_buffer(
+                _CMSG_HDR_LEN + _cmsg_align(len(fdbytes)))
+        hdr = _cmsghdr(_CMSG_HDR_LEN + len(fdbytes),
+                       socket.SOL_SOCKET, SCM_RIGHTS)
+        ctypes.memmove(control, ctypes.addressof(hdr), ctypes.sizeof(hdr))
+        ctypes.memmove(ctypes.addressof(control) + _CMSG_HDR_LEN,
+                       fdbytes, len(fdbytes))
+
+        msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                      ctypes.cast(control, ctypes.c_void_p),
+                      ctypes.sizeof(control), 0)
+        return _check(_libc.sendmsg(self.sock.fileno(), ctypes.byref(msg), 0))
+
+    def _recv(self, flags):
+        if not self.can_pass_fds:
+            return SocketXport._recv(self, flags)
+        return self._recvmsg(flags)
+
+    def _recvmsg(self, flags):
+        iov = _iovec(ctypes.cast(self.cbuf, ctypes.c_void_p),
+                     ctypes.sizeof(self.cbuf))
+        msg = _msghdr(None, 0, ctypes.pointer(iov), 1,
+                      ctypes.cast(self.control, ctypes.c_void_p),
+                      ctypes.sizeof(self.control), 0)
+        count = _check(_libc.recvmsg(self.sock.fileno(), ctypes.byref(msg),
+                                     MSG_CMSG_CLOEXEC | flags))
+
+        # collect any descriptors from the control messages
+        base = ctypes.addressof(self.control)
+        offset = 0
+        while offset + _CMSG_HDR_LEN <= msg.msg_controllen:
+            hdr = _cmsghdr.from_address(base + offset)
+            if (hdr.cmsg_level == socket.SOL_SOCKET
+                    and hdr.cmsg_type == SCM_RIGHTS):
+                nfds = (hdr.cmsg_len - _CMSG_HDR_LEN) / _FD_SIZE
+                fds = array.array('i', ctypes.string_at(
+                        base + offset + _CMSG_HDR_LEN, nfds * _FD_SIZE))
+                self.received_fds.extend(fds)
+            offset += _cmsg_align(hdr.cmsg_len)
+        if msg.msg_flags & MSG_CTRUNC:
+            raise Error("too many file descriptors received at once")
+
+        return ctypes.string_at(self.cbuf, count)
@@ -25,7 +25,7 @@ setup(name='remsh',
       author='Dustin J. Mitchell',
       author_email='dustin@zmanda.com',
       url='http://github.com/djmitche/remsh',
-      packages=find_packages('.', ['test']),
+      packages=find_packages('.', ['test', 'bench']),
       entry_points = {
         'console_scripts': [
           'remsh-slave = remsh.slave.scripts.remsh_slave:main',
@@ -0,0 +1,118 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import tempfile
+import asyncore
+import socket
+import shutil
+import os
+
+from remsh.xport.fd import FDXport
+from remsh.wire import Wire
+from remsh.slave.server import SlaveServer
+from remsh.master.remote import NotFoundError, ProtocolError
+from remsh.master.asyncremote import AsyncConnection
+
+
+class AsyncOps(unittest.TestCase):
+
+    def setUp(self):
+        # the slave server changes this process's cwd
+        self.origdir = os.getcwd()
+        self.basedir = tempfile.mkdtemp()
+
+        master_sock, slave_sock = socket.socketpair()
+        self.slave_sock = slave_sock
+        slave_server = SlaveServer(Wire(FDXport(os.dup(slave_sock.fileno()))))
+        self.slave_server_thd = threading.Thread(target=slave_server.serve)
+        self.slave_server_thd.setDaemon(1)
+        self.slave_server_thd.start()
+
+        self.map = {}
+        self.conn = AsyncConnection(master_sock, map=self.map)
+        self.slave = self.conn.slave
+
+    def tearDown(self):
+        self.conn.close()
+        self.slave_server_thd.join()
+        self.slave_sock.close()
+        os.chdir(self.origdir)
+        shutil.rmtree(self.basedir)
+
+    def run_until_done(self, *ops):
+        while [op for op in ops if not op.done]:
+            asyncore.loop(timeout=0.05, map=self.map, count=1)
+
+    def test_simple_ops(self):
+        dir = os.path.join(self.basedir, "dir")
+        ops = [
+            self.slave.set_cwd(self.basedir),
+            self.slave.mkdir("dir"),
+            self.slave.stat("dir"),
+            self.slave.fetch("nosuch", os.path.join(self.basedir, "x")),
+        ]
+        self.run_until_done(*ops)
+        self.assertEqual(ops[0].result, self.basedir)
+        self.failUnless(os.path.isdir(dir))
+        self.assertEqual(ops[2].result, 'd')
+        self.failUnless(isinstance(ops[3].error, NotFoundError))
+
+    def test_callbacks(self):
+        results = []
+        op = self.slave.set_cwd(self.basedir)
+
+        def chain(cwd):
+            results.append(cwd)
+            self.slave.getenv().add_callbacks(results.append)
+        op.add_callbacks(chain)
+
+        while len(results) < 2:
+            asyncore.loop(timeout=0.05, map=self.map, count=1)
+        self.assertEqual(results[0], self.basedir)
+        self.failUnless('PATH' in results[1])
+
+    def test_execute(self):
+        output = []
+        op = self.slave.execute(args=['sh', '-c', 'echo hi; exit 3'],
+                                stdout_cb=output.append)
+        self.run_until_done(op)
+        self.assertEqual(op.result, 3)
+        self.assertEqual(''.join(output), 'hi\n')
+
+    def test_execute_flow_control(self):
+        self.slave.execute_window = 1000
+        output = []
+        op = self.slave.execute(args=['sh', '-c', 'head -c 100000 /dev/zero'],
+                                stdout_cb=output.append)
+        op2 = self.slave.getenv()
+        self.run_until_done(op, op2)
+        self.assertEqual(op.result, 0)
+        self.assertEqual(self.slave.windowed, True)
+        self.assertEqual(''.join(output), '\0' * 100000)
+        self.assert_(max(len(d) for d in output) <= 1000)
+        self.failUnless('PATH' in op2.result)
+
+    def test_send_fetch(self):
+        src = os.path.join(self.basedir, "src")
+        data = os.urandom(1024) * 1000
+        f = open(src, "wb")
+        f.write(data)
+        f.close()
+
+        mid = os.path.join(self.basedir, "mid")
+        dest = os.path.join(self.basedir, "dest")
+        send = self.slave.send(src, mid)
+        fetch = self.slave.fetch(mid, dest)
+        self.run_until_done(send, fetch)
+        self.assertEqual(send.error, None)
+        self.assertEqual(fetch.error, None)
+        self.assertEqual(open(dest, "rb").read(), data)
+
+    def test_connection_lost(self):
+        self.slave_sock.shutdown(socket.SHUT_RDWR)
+        op = self.slave.getenv()
+        self.run_until_done(op)
+        self.failUnless(isinstance(op.error, ProtocolError))
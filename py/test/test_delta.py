@@ -0,0 +1,112 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import random
+import os
+from cStringIO import StringIO
+
+from remsh import delta
+
+
+class TestDelta(unittest.TestCase):
+
+    block_size = 2048
+
+    def sigs(self, old):
+        return delta.unpack_signatures(
+            ''.join(delta.signatures(StringIO(old), self.block_size)))
+
+    def apply(self, old, items):
+        bs = self.block_size
+        result = []
+        for item in items:
+            if type(item) is tuple:
+                first, count = item
+                result.append(old[first * bs:(first + count) * bs])
+            else:
+                result.append(item)
+        return ''.join(result)
+
+    def delta(self, old, new):
+        items = list(delta.delta(StringIO(new), self.block_size,
+                                 self.sigs(old)))
+        self.assertEqual(self.apply(old, items), new)
+        return items
+
+    def test_signatures(self):
+        old = os.urandom(self.block_size * 3 + 100)
+        sigs = self.sigs(old)
+        # the partial block at the end has no signature
+        self.assertEqual(len(sigs), 3)
+        self.assertEqual(sigs[1][0],
+            delta.weak_checksum(old[self.block_size:self.block_size * 2]))
+        self.assertRaises(ValueError,
+            lambda: delta.unpack_signatures('x' * 21))
+
+    def test_identical(self):
+        old = os.urandom(self.block_size * 10)
+        self.assertEqual(self.delta(old, old), [(0, 10)])
+
+    def test_no_old_file(self):
+        new = os.urandom(self.block_size * 10)
+        items = self.delta('', new)
+        self.assertEqual([i for i in items if type(i) is tuple], [])
+
+    def test_insertion(self):
+        old = os.urandom(self.block_size * 10)
+        new = old[:5000] + "inserted" + old[5000:]
+        items = self.delta(old, new)
+        literal = sum([len(i) for i in items if type(i) is not tuple])
+        # only the block containing the insertion is sent
+        self.assert_(literal <= self.block_size + 8 + self.block_size)
+        self.assertEqual(items[0], (0, 2))
+        self.assertEqual(items[-1], (3, 7))
+
+    def test_moved_blocks(self):
+        bs = self.block_size
+        old = os.urandom(bs * 4)
+        new = old[bs * 2:] + old[:bs * 2]
+        self.assertEqual(self.delta(old, new), [(2, 2), (0, 2)])
+
+    def test_random_edits(self):
+        rand = random.Random(42)
+        for i in range(50):
+            old = os.urandom(rand.randint(0, 40000))
+            new = bytearray(old)
+            for j in range(rand.randint(0, 4)):
+                pos = rand.randint(0, len(new))
+                kind = rand.choice(['insert', 'delete', 'change'])
+                if kind == 'insert':
+                    new[pos:pos] = os.urandom(rand.randint(1, 3000))
+                elif kind == 'delete':
+                    del new[pos:pos + rand.randint(1, 3000)]
+                else:
+                    new[pos:pos + 10] = os.urandom(10)
+            self.delta(old, str(new))
+
+    def test_long_unmatched(self):
+        # after a long stretch of new data, blocks are still found at block
+        # boundaries
+        bs = self.block_size
+        old = os.urandom(bs * 4)
+        new = os.urandom(bs * (delta.MAX_ROLLED_BLOCKS + 2)) + old
+        self.assertEqual(self.delta(old, new)[-1], (0, 4))
+
+    def test_long_unaligned_insertion(self):
+        # after an insertion of many blocks which is not a whole number of
+        # blocks long, the rest of the file is still found
+        bs = self.block_size
+        old = os.urandom(bs * 200)
+        insertion = os.urandom(bs * (delta.MAX_ROLLED_BLOCKS * 4) + 3)
+        new = old[:bs * 50] + insertion + old[bs * 50:]
+        items = self.delta(old, new)
+        literal = sum([len(i) for i in items if type(i) is not tuple])
+        self.assert_(literal <= len(insertion) + bs * delta.ROLL_INTERVAL)
+        self.assertEqual(items[-1][0] + items[-1][1], 200)
+
+    def test_block_size_for(self):
+        self.assertEqual(delta.block_size_for(0), delta.MIN_BLOCK_SIZE)
+        self.assertEqual(delta.block_size_for(100 * 1024 * 1024), 10240)
+        self.assertEqual(delta.block_size_for(1 << 40), delta.MAX_BLOCK_SIZE)
@@ -0,0 +1,117 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import tempfile
+import socket
+import shutil
+import os
+
+from remsh.xport.sock import SocketXport
+from remsh.xport.fd import FDXport
+from remsh.xport.local import LocalXport
+from remsh.wire import Wire
+from remsh.slave.server import SlaveServer
+from remsh.master.remote import ProtocolError
+from remsh.master.eventloop import EventLoop
+
+
+def start_slave(sock):
+    server = SlaveServer(Wire(SocketXport(sock)))
+    thd = threading.Thread(target=server.serve)
+    thd.setDaemon(1)
+    thd.start()
+    return thd
+
+
+class TestEventLoop(unittest.TestCase):
+
+    def setUp(self):
+        # the slave servers change this process's cwd
+        self.origdir = os.getcwd()
+        self.basedir = tempfile.mkdtemp()
+        self.loop = EventLoop()
+        self.threads = []
+
+    def tearDown(self):
+        self.loop.close()
+        for thd in self.threads:
+            thd.join()
+        os.chdir(self.origdir)
+        shutil.rmtree(self.basedir)
+
+    def add_slave(self):
+        master_sock, slave_sock = socket.socketpair()
+        self.threads.append(start_slave(slave_sock))
+        return self.loop.add_slave(SocketXport(master_sock))
+
+    def run_until_done(self, *ops):
+        self.failUnless(self.loop.run(
+                until=lambda: not [op for op in ops if not op.done],
+                timeout=10))
+
+    def test_many_slaves(self):
+        slaves = [self.add_slave() for i in range(20)]
+        ops = [slave.getenv() for slave in slaves]
+        ops += [slave.stat(self.basedir) for slave in slaves]
+        self.run_until_done(*ops)
+        for op in ops[:20]:
+            self.failUnless('PATH' in op.result)
+        for op in ops[20:]:
+            self.assertEqual(op.result, 'd')
+
+    def test_send_fetch(self):
+        # larger than the slave's low-water mark, so the loop must drain the
+        # transport's queue before more data is generated
+        src = os.path.join(self.basedir, "src")
+        data = os.urandom(1024) * 1000
+        f = open(src, "wb")
+        f.write(data)
+        f.close()
+
+        slave = self.add_slave()
+        mid = os.path.join(self.basedir, "mid")
+        dest = os.path.join(self.basedir, "dest")
+        send = slave.send(src, mid)
+        fetch = slave.fetch(mid, dest)
+        self.run_until_done(send, fetch)
+        self.assertEqual(send.error, None)
+        self.assertEqual(fetch.error, None)
+        self.assertEqual(open(dest, "rb").read(), data)
+
+    def test_listen(self):
+        slaves = []
+        port = self.loop.listen(0, slaves.append, host='127.0.0.1')
+        sock = socket.create_connection(('127.0.0.1', port))
+        self.threads.append(start_slave(sock))
+        self.failUnless(self.loop.run(until=lambda: slaves, timeout=10))
+
+        op = slaves[0].execute(args=['sh', '-c', 'echo hi'],
+                               stdout_cb=lambda data: None)
+        self.run_until_done(op)
+        self.assertEqual(op.result, 0)
+
+    def test_connection_lost(self):
+        master_sock, slave_sock = socket.socketpair()
+        slave = self.loop.add_slave(SocketXport(master_sock))
+        slave_sock.close()
+        op = slave.getenv()
+        self.run_until_done(op)
+        self.failUnless(isinstance(op.error, ProtocolError))
+        self.assertEqual(self.loop.handlers, {})
+
+
+    def test_fd_xport(self):
+        master_sock, slave_sock = socket.socketpair()
+        self.threads.append(start_slave(slave_sock))
+        slave = self.loop.add_slave(FDXport(os.dup(master_sock.fileno())))
+        master_sock.close()
+        op = slave.stat(self.basedir)
+        self.run_until_done(op)
+        self.assertEqual(op.result, 'd')
+
+    def test_blocking_xport(self):
+        top, bottom = LocalXport.create()
+        self.assertRaises(ValueError, lambda: self.loop.add_slave(top))
@@ -6,12 +6,24 @@ import unittest
 import threading
 import shutil
 import os
+import socket
+import time
+import errno
+import hashlib
 
 from remsh.xport.local import LocalXport
+from remsh.xport.sock import SocketXport
+from remsh.xport.unix import UnixXport
 from remsh.wire import Wire
 from remsh.slave.server import SlaveServer
+from remsh.slave import server as slave_server
 from remsh.master.remote import RemoteSlave, NotFoundError, \
-                               FileExistsError, FailedError
+                               FileExistsError, FailedError, ProtocolError, \
+                               OpenFailedError, file_digest
+from remsh.mux import WINDOW
+from remsh.partial import partial_name
+from remsh.sparse import has_holes
+from remsh.stats import WireStats, OpStats
 
 
 class Ops(unittest.TestCase):
@@ -42,8 +54,10 @@ class Ops(unittest.TestCase):
 
         shutil.rmtree(self.basedir)
 
-    def setUpSlave(self):
-        self.slave_xport, self.master_xport = LocalXport.create()
+    def setUpSlave(self, xports=None):
+        if xports is None:
+            xports = LocalXport.create()
+        self.slave_xport, self.master_xport = xports
 
         slave_wire = Wire(self.slave_xport)
         slave_server = SlaveServer(slave_wire)
@@ -129,6 +143,21 @@ class Ops(unittest.TestCase):
         env = self.slave.getenv()
         self.assertEqual(env, os.environ)
 
+    def test_ping(self):
+        self.assert_(self.slave.ping() >= 0)
+        self.assert_(self.slave.ping(data='x' * 1000, reply_size=1000) >= 0)
+        self.assertRaises(ProtocolError,
+            lambda: self.slave.ping(reply_size=self.slave.wire.chunk_size() + 1))
+
+        # an empty ping works even with a slave that does not support it
+        ping = SlaveServer.op_methods.pop('ping')
+        try:
+            self.assert_(self.slave.ping() >= 0)
+            self.assertRaises(ProtocolError,
+                lambda: self.slave.ping(reply_size=10))
+        finally:
+            SlaveServer.op_methods['ping'] = ping
+
     def test_mkdir(self):
         newdir = os.path.join(self.basedir, "newdir")
         self.assert_(not os.path.exists(newdir))
@@ -169,6 +198,86 @@ class Ops(unittest.TestCase):
         execute_output('echo "oh noes" >&2', stderr="oh noes")
         execute_output('echo "yes"; echo "no" >&2', stdout="yes", stderr="no")
 
+    def test_execute_flow_control(self):
+        self.slave.execute_window = 4096
+        done = os.path.join(self.basedir, "done")
+        chunks = []
+        finished_early = []
+
+        def stdout_cb(data):
+            if not chunks:
+                # give the command time to run ahead, if it could
+                time.sleep(0.5)
+                finished_early.append(os.path.exists(done))
+            chunks.append(data)
+
+        result = self.slave.execute(
+            args=['sh', '-c', 'head -c 300000 /dev/zero; touch %s' % done],
+            stdout_cb=stdout_cb)
+        self.assertEqual(result, 0)
+        self.assertEqual(self.slave.windowed, True)
+        self.assertEqual(''.join(chunks), '\0' * 300000)
+        self.assert_(max(len(c) for c in chunks) <= 4096)
+        # the command was held up until the output was consumed
+        self.assertEqual(finished_early, [False])
+        self.assert_(os.path.exists(done))
+
+        # the connection is still usable
+        self.assertEqual(self.slave.execute(args=['sh', '-c', 'exit 2']), 2)
+
+    def test_execute_failures(self):
+        # a failed execute leaves no descriptors open on the slave
+        def open_fds():
+            return len(os.listdir("/proc/self/fd"))
+        if not os.path.exists("/proc/self/fd"):
+            self.skipTest("cannot count open file descriptors")
+
+        self.assertRaises(RuntimeError, lambda:
+            self.slave.execute(args=[self.basedir + "/no-such-command"]))
+        before = open_fds()
+        for i in range(20):
+            self.assertRaises(RuntimeError, lambda:
+                self.slave.execute(args=[self.basedir + "/no-such-command"]))
+        self.assertEqual(open_fds(), before)
+        self.assertEqual(self.slave.execute(args=['sh', '-c', 'exit 2']), 2)
+
+    def test_execute_output_failure(self):
+        # reading the command's output fails on the slave, after the credit
+        # thread has started
+        class FailingOS(object):
+            def __getattr__(self, name):
+                return getattr(os, name)
+
+            def read(self, fd, count):
+                data = os.read(fd, count)
+                if 'boom' in data:
+                    raise OSError(errno.EIO, os.strerror(errno.EIO))
+                return data
+        slave_server.os = FailingOS()
+        try:
+            self.assertRaises(RuntimeError, lambda:
+                self.slave.execute(args=['sh', '-c', "echo bo''om"],
+                                   stdout_cb=lambda data: None))
+        finally:
+            slave_server.os = os
+        # the operation ended cleanly, so the connection is still usable
+        self.assertEqual(self.slave.execute(args=['sh', '-c', 'exit 2']), 2)
+        self.assertEqual(self.slave.windowed, True)
+
+    def test_execute_fallback(self):
+        # a slave without flow control
+        versions = SlaveServer.op_methods['execute']
+        remote_execute_window = versions.pop(2)
+        try:
+            self.clear_files()
+            result = self.slave.execute(args=['sh', '-c', 'echo hi'],
+                    stdout_cb=self.make_callback('stdout'))
+            self.assertEqual(result, 0)
+            self.assertEqual(self.get_file('stdout'), 'hi\n')
+            self.assertEqual(self.slave.windowed, False)
+        finally:
+            versions[2] = remote_execute_window
+
     def test_send(self):
         # prep
         destfile = os.path.join(self.basedir, "destfile")
@@ -193,6 +302,180 @@ class Ops(unittest.TestCase):
         os.unlink(destfile)
         os.unlink(localfile)
 
+    def test_fdpass(self):
+        self.tearDownSlave()
+        self.setUpSlave(UnixXport.pair())
+        if not self.master_xport.can_pass_fds:
+            raise unittest.SkipTest("no descriptor passing on this platform")
+
+        localfile = os.path.join(self.basedir, "localfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        data = os.urandom(100000)
+        f = open(localfile, "wb")
+        f.write(data)
+        f.close()
+
+        self.slave.send(localfile, destfile)
+        self.assertEqual(self.slave.fdpass, True)
+        self.assertEqual(open(destfile, "rb").read(), data)
+        self.assertRaises(FileExistsError,
+            lambda: self.slave.send(localfile, destfile))
+
+        self.slave.fetch(destfile, fetchfile)
+        self.assertEqual(open(fetchfile, "rb").read(), data)
+        self.assertRaises(NotFoundError,
+            lambda: self.slave.fetch("missing", fetchfile + "2"))
+
+    def test_fdpass_fallback(self):
+        # the slave's transport cannot receive descriptors
+        master_sock, slave_sock = socket.socketpair()
+        self.tearDownSlave()
+        self.setUpSlave((SocketXport(slave_sock), UnixXport(master_sock)))
+
+        localfile = os.path.join(self.basedir, "localfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        f = open(localfile, "wb")
+        f.write("hello" * 1000)
+        f.close()
+
+        self.slave.send(localfile, destfile)
+        self.assertEqual(self.slave.fdpass, False)
+        self.slave.fetch(destfile, fetchfile)
+        self.assertEqual(open(fetchfile, "rb").read(), "hello" * 1000)
+
+    def test_large_values(self):
+        self.assertEqual(self.slave.set_wire_options(large_values=True),
+            {'large_values': True})
+
+        srcfile = os.path.join(self.basedir, "srcfile")
+        localfile = os.path.join(self.basedir, "localfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        f = open(localfile, "w")
+        f.write("0123456789abcdef" * 200000)
+        f.close()
+
+        self.slave.send(localfile, srcfile)
+        self.slave.fetch(srcfile, fetchfile)
+        self.assertEqual(open(fetchfile).read(), open(localfile).read())
+
+        # ordinary operations still work
+        self.assertEqual(self.slave.stat(srcfile), 'f')
+
+    def test_compression(self):
+        self.assertEqual(self.slave.set_wire_options(compress=True),
+            {'compress': True})
+
+        self.clear_files()
+        result = self.slave.execute(
+            args=['sh', '-c', 'for i in 1 2 3 4 5 6 7 8; do ls -l /; done'],
+            stdout_cb=self.make_callback('stdout'))
+        self.assertEqual(result, 0)
+        self.assert_(self.get_file('stdout').count('\n') >= 8)
+        self.assertEqual(self.slave.set_cwd(""), self.basedir)
+
+    def test_channels(self):
+        self.assertEqual(self.slave.set_wire_options(channels=True),
+            {'channels': True})
+        slow = self.slave.open_channel()
+        fast = self.slave.open_channel()
+
+        # run a slow command on one channel ..
+        results = []
+        def run_slow():
+            results.append(slow.execute(
+                args=['sh', '-c', 'sleep 1; echo slow'],
+                stdout_cb=self.make_callback('stdout')))
+        thd = threading.Thread(target=run_slow)
+        thd.start()
+
+        # .. while running quick operations on the other
+        fast.mkdir("newdir")
+        self.assertEqual(fast.stat("newdir"), 'd')
+        self.assert_(thd.isAlive(), "fast operations did not wait")
+        self.assertRaises(NotFoundError, lambda: fast.set_cwd("missing"))
+
+        thd.join()
+        self.assertEqual(results, [0])
+        self.assertEqual(self.get_file('stdout'), 'slow\n')
+
+        slow.close()
+        fast.close()
+
+        # the original object still works, too
+        self.assertEqual(self.slave.stat("newdir"), 'd')
+
+    def test_channel_window(self):
+        self.slave.set_wire_options(channels=True)
+        channel = self.slave.open_channel()
+        other = self.slave.open_channel()
+        srcfile = os.path.join(self.basedir, "srcfile")
+        data = os.urandom(4 * WINDOW)
+        f = open(srcfile, "wb")
+        f.write(data)
+        f.close()
+
+        # start a fetch, but do not read its data yet; the slave stops
+        # sending once the window is full ..
+        channel.wire.send_box({'meth': 'fetch', 'version': 1, 'src': srcfile})
+        time.sleep(0.5)
+        self.assert_(channel.wire.queued
+                     <= WINDOW + self.slave.mux.wire.max_buffered)
+
+        # .. while other channels carry on
+        self.assertEqual(other.stat(srcfile), 'f')
+
+        received = []
+        while 1:
+            box = channel.wire.read_box()
+            if box == {}:
+                break
+            received.append(box['data'])
+        self.assertEqual(''.join(received), data)
+        self.assertEqual(channel.stat(srcfile), 'f')
+        channel.close()
+        other.close()
+
+    def test_batch(self):
+        batch = self.slave.batch()
+        for i in range(600):
+            batch.mkdir("dir%d" % i)
+        for i in range(600):
+            batch.stat("dir%d" % i)
+        batch.rename("missing", "elsewhere")
+        batch.stat("dir0/missing")
+        self.assertEqual(len(batch), 1202)
+
+        results = batch.run()
+        self.assertEqual(len(results), 1202)
+        self.assertEqual(results[:600], [None] * 600)
+        self.assertEqual(results[600:1200], ['d'] * 600)
+        self.assert_(isinstance(results[1200], NotFoundError))
+        self.assertEqual(results[1201], '')
+
+        # the batch can be reused
+        self.assertEqual(len(batch), 0)
+        batch.set_cwd("dir1")
+        self.assertEqual(batch.run(), [os.path.join(self.basedir, "dir1")])
+
+    def test_stats(self):
+        self.slave.stats = OpStats()
+        self.slave.wire.stats = WireStats()
+        self.slave.getenv()
+        self.slave.stat(self.basedir)
+        self.slave.stat(self.basedir)
+
+        ops = self.slave.stats.snapshot()
+        self.assertEqual(ops['getenv']['count'], 1)
+        self.assertEqual(ops['stat']['count'], 2)
+
+        wire = self.slave.wire.stats.snapshot()
+        self.assertEqual(wire['boxes_sent'], 3)
+        self.assertEqual(wire['boxes_received'], 3)
+        self.failUnless(wire['bytes_received'] > wire['bytes_sent'],
+                        "environment is larger than the requests")
+
     def test_fetch(self):
         # prep
         srcfile = os.path.join(self.basedir, "srcfile")
@@ -223,6 +506,283 @@ class Ops(unittest.TestCase):
         os.unlink(srcfile)
         os.unlink(localfile)
 
+    def test_fetch_raw(self):
+        # over a socket, the slave's kernel copies the file data
+        master_sock, slave_sock = socket.socketpair()
+        self.tearDownSlave()
+        self.setUpSlave((SocketXport(slave_sock), SocketXport(master_sock)))
+
+        srcfile = os.path.join(self.basedir, "srcfile")
+        data = os.urandom(3000000)
+        f = open(srcfile, "wb")
+        f.write(data)
+        f.close()
+
+        for i in range(2):
+            localfile = os.path.join(self.basedir, "localfile%d" % i)
+            self.slave.fetch(srcfile, localfile)
+            self.assertEqual(self.slave.rawfetch, True)
+            self.assertEqual(open(localfile, "rb").read(), data)
+
+        # empty files, and files without a known length, use data boxes
+        emptyfile = os.path.join(self.basedir, "emptyfile")
+        open(emptyfile, "wb").close()
+        self.slave.fetch(emptyfile, os.path.join(self.basedir, "empty2"))
+        self.assertEqual(open(os.path.join(self.basedir, "empty2")).read(), "")
+        if os.path.exists("/proc/self/status"):
+            statusfile = os.path.join(self.basedir, "status")
+            self.slave.fetch("/proc/self/status", statusfile)
+            self.assert_(os.stat(statusfile).st_size > 0)
+        self.assertEqual(self.slave.rawfetch, True)
+
+    def test_fetch_raw_compressed(self):
+        # with compression, raw data is not used
+        self.slave.set_wire_options(compress=True)
+        srcfile = os.path.join(self.basedir, "srcfile")
+        localfile = os.path.join(self.basedir, "localfile")
+        f = open(srcfile, "wb")
+        f.write("abc" * 100000)
+        f.close()
+        self.slave.fetch(srcfile, localfile)
+        self.assertEqual(self.slave.rawfetch, None)
+        self.assertEqual(open(localfile, "rb").read(), "abc" * 100000)
+
+    def test_sync(self):
+        srcfile = os.path.join(self.basedir, "srcfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        old = os.urandom(500000)
+        new = old[:100000] + "changed" + old[100000:400000] + os.urandom(1000)
+
+        # with no existing file, everything is sent
+        f = open(srcfile, "wb")
+        f.write(old)
+        f.close()
+        result = self.slave.sync(srcfile, destfile)
+        self.assertEqual(result, {'literal': 500000, 'matched': 0})
+        self.assertEqual(open(destfile, "rb").read(), old)
+        os.chmod(destfile, 0751)
+
+        # with an old version, only the differences are sent
+        f = open(srcfile, "wb")
+        f.write(new)
+        f.close()
+        result = self.slave.sync(srcfile, destfile)
+        self.assertEqual(open(destfile, "rb").read(), new)
+        self.assert_(result['literal'] < 20000)
+        self.assertEqual(result['literal'] + result['matched'], len(new))
+        self.assertEqual(os.stat(destfile).st_mode & 0777, 0751)
+        # the temporary file is gone
+        self.assertEqual(sorted(os.listdir(self.basedir)),
+                         ["destfile", "srcfile"])
+
+        self.assertRaises(OpenFailedError,
+            lambda: self.slave.sync(srcfile, self.basedir))
+        self.assertRaises(OpenFailedError,
+            lambda: self.slave.sync(srcfile, "/does/not/exist"))
+        # the connection is still usable
+        self.assertEqual(self.slave.stat(destfile), 'f')
+
+    def test_sparse(self):
+        srcfile = os.path.join(self.basedir, "srcfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        f = open(srcfile, "wb")
+        f.write("a" * 5000)
+        f.seek(10000000)
+        f.write("b" * 5000)
+        f.truncate(20000000)
+        f.close()
+        if not has_holes(open(srcfile)):
+            self.skipTest("the filesystem does not support holes")
+        data = open(srcfile, "rb").read()
+
+        def allocated(filename):
+            return os.stat(filename).st_blocks * 512
+
+        self.slave.send(srcfile, destfile)
+        self.assertEqual(self.slave.sparse, True)
+        self.assertEqual(open(destfile, "rb").read(), data)
+        self.assert_(allocated(destfile) < 1000000)
+
+        self.slave.fetch(destfile, fetchfile)
+        self.assertEqual(open(fetchfile, "rb").read(), data)
+        self.assert_(allocated(fetchfile) < 1000000)
+
+        # a raw fetch leaves sparse files to version 5
+        master_sock, slave_sock = socket.socketpair()
+        self.tearDownSlave()
+        self.setUpSlave((SocketXport(slave_sock), SocketXport(master_sock)))
+        rawfile = os.path.join(self.basedir, "rawfile")
+        self.slave.fetch(destfile, rawfile)
+        self.assertEqual(self.slave.sparse, True)
+        self.assertEqual(open(rawfile, "rb").read(), data)
+        self.assert_(allocated(rawfile) < 1000000)
+
+        # a file which is all hole
+        f = open(srcfile, "wb")
+        f.truncate(1000000)
+        f.close()
+        holefile = os.path.join(self.basedir, "holefile")
+        self.slave.send(srcfile, holefile)
+        self.assertEqual(open(holefile, "rb").read(), "\0" * 1000000)
+
+    def test_hash(self):
+        path = os.path.join(self.basedir, "file")
+        f = open(path, "wb")
+        f.write("hello" * 100000)
+        f.close()
+        self.assertEqual(self.slave.hash(path),
+            hashlib.sha256("hello" * 100000).hexdigest())
+        self.assertEqual(self.slave.hash(path, 'md5'),
+            hashlib.md5("hello" * 100000).hexdigest())
+        self.assertRaises(NotFoundError,
+            lambda: self.slave.hash(os.path.join(self.basedir, "missing")))
+        self.assertRaises(ProtocolError,
+            lambda: self.slave.hash(path, 'nosuch'))
+
+    def test_skip_identical(self):
+        srcfile = os.path.join(self.basedir, "srcfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        f = open(srcfile, "wb")
+        f.write("abc" * 100000)
+        f.close()
+
+        self.assertEqual(self.slave.send(srcfile, destfile,
+                                         skip_identical=True), False)
+        self.assertEqual(self.slave.send(srcfile, destfile,
+                                         skip_identical=True), True)
+        self.assertEqual(self.slave.fetch(destfile, fetchfile,
+                                          skip_identical=True), False)
+        self.assertEqual(self.slave.fetch(destfile, fetchfile,
+                                          skip_identical=True), True)
+
+        # different contents, of the same size and of a different size
+        for data in "abd" * 100000, "abc":
+            f = open(srcfile, "wb")
+            f.write(data)
+            f.close()
+            self.assertRaises(FileExistsError, lambda:
+                self.slave.send(srcfile, destfile, skip_identical=True))
+            self.assertRaises(FileExistsError, lambda:
+                self.slave.fetch(srcfile, fetchfile, skip_identical=True))
+
+    def test_skip_identical_fallback(self):
+        # a slave without the hash operation
+        hash_versions = SlaveServer.op_methods.pop('hash')
+        try:
+            srcfile = os.path.join(self.basedir, "srcfile")
+            destfile = os.path.join(self.basedir, "destfile")
+            fetchfile = os.path.join(self.basedir, "fetchfile")
+            f = open(srcfile, "wb")
+            f.write("abc" * 1000)
+            f.close()
+
+            self.assertEqual(self.slave.send(srcfile, destfile,
+                                             skip_identical=True), False)
+            self.assertEqual(open(destfile, "rb").read(), "abc" * 1000)
+            # the files cannot be compared, so this is an ordinary send
+            self.assertRaises(FileExistsError, lambda:
+                self.slave.send(srcfile, destfile, skip_identical=True))
+            self.assertEqual(self.slave.fetch(destfile, fetchfile,
+                                              skip_identical=True), False)
+            self.assertRaises(FileExistsError, lambda:
+                self.slave.fetch(destfile, fetchfile, skip_identical=True))
+        finally:
+            SlaveServer.op_methods['hash'] = hash_versions
+
+    def test_resume(self):
+        srcfile = os.path.join(self.basedir, "srcfile")
+        destfile = os.path.join(self.basedir, "destfile")
+        fetchfile = os.path.join(self.basedir, "fetchfile")
+        data = os.urandom(300000)
+        f = open(srcfile, "wb")
+        f.write(data)
+        f.close()
+        digest = file_digest(srcfile)
+
+        def write_partial(dest, data):
+            f = open(partial_name(dest, digest), "wb")
+            f.write(data)
+            f.close()
+
+        # an interrupted transfer left the first part behind
+        write_partial(destfile, data[:100000])
+        self.slave.send(srcfile, destfile, resume=True)
+        self.assertEqual(open(destfile, "rb").read(), data)
+        self.failIf(os.path.exists(partial_name(destfile, digest)))
+        self.assertRaises(FileExistsError, lambda:
+            self.slave.send(srcfile, destfile, resume=True))
+
+        write_partial(fetchfile, data[:100000])
+        self.slave.fetch(destfile, fetchfile, resume=True)
+        self.assertEqual(open(fetchfile, "rb").read(), data)
+        self.failIf(os.path.exists(partial_name(fetchfile, digest)))
+
+        # a partial file with the wrong data is kept, so the digest does not
+        # match; it is removed, and the next attempt starts over
+        os.unlink(destfile)
+        os.unlink(fetchfile)
+        write_partial(destfile, "x" * 1000)
+        self.assertRaises(FailedError, lambda:
+            self.slave.send(srcfile, destfile, resume=True))
+        self.failIf(os.path.exists(partial_name(destfile, digest)))
+        self.slave.send(srcfile, destfile, resume=True)
+        self.assertEqual(open(destfile, "rb").read(), data)
+
+        write_partial(fetchfile, "x" * 1000)
+        self.assertRaises(FailedError, lambda:
+            self.slave.fetch(destfile, fetchfile, resume=True))
+        self.failIf(os.path.exists(partial_name(fetchfile, digest)))
+        self.slave.fetch(destfile, fetchfile, resume=True)
+        self.assertEqual(open(fetchfile, "rb").read(), data)
+
+        # the connection is still in step after an error
+        self.assertRaises(NotFoundError, lambda:
+            self.slave.fetch(srcfile + "-no", fetchfile + "2", resume=True))
+        self.assertEqual(self.slave.stat(destfile), 'f')
+
+    def test_trees(self):
+        src = os.path.join(self.basedir, "src")
+        os.makedirs(os.path.join(src, "sub"))
+        for i in range(200):
+            f = open(os.path.join(src, "sub", "file%d" % i), "wb")
+            f.write("contents of %d" % i)
+            f.close()
+        os.symlink("sub/file1", os.path.join(src, "link"))
+
+        dest = os.path.join(self.basedir, "dest")
+        self.slave.send_tree(src, dest)
+        self.assertEqual(sorted(os.listdir(os.path.join(dest, "sub"))),
+                         sorted(os.listdir(os.path.join(src, "sub"))))
+        self.assertEqual(open(os.path.join(dest, "sub", "file7")).read(),
+                         "contents of 7")
+        self.assertEqual(os.readlink(os.path.join(dest, "link")), "sub/file1")
+
+        # again, replacing the files
+        self.slave.send_tree(src, dest)
+
+        back = os.path.join(self.basedir, "back")
+        self.slave.fetch_tree(dest, back)
+        self.assertEqual(open(os.path.join(back, "sub", "file199")).read(),
+                         "contents of 199")
+
+        self.assertRaises(NotFoundError,
+            lambda: self.slave.fetch_tree(os.path.join(self.basedir, "no"),
+                                          back))
+        self.assertRaises(FileExistsError, lambda: self.slave.send_tree(src,
+            os.path.join(dest, "sub", "file1")))
+        self.assertRaises(OSError, lambda: self.slave.send_tree(
+            os.path.join(self.basedir, "no"), dest))
+
+        # an unreadable file on the slave
+        os.chmod(os.path.join(dest, "sub", "file3"), 0)
+        if not os.access(os.path.join(dest, "sub", "file3"), os.R_OK):
+            self.assertRaises(FailedError, lambda: self.slave.fetch_tree(
+                dest, os.path.join(self.basedir, "back2")))
+        # the connection is still usable
+        self.assertEqual(self.slave.stat(dest), 'd')
+
     def test_remove(self):
         exists = os.path.join(self.basedir, "exists")
         missing = os.path.join(self.basedir, "missing")
@@ -0,0 +1,78 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import tempfile
+import hashlib
+import shutil
+import os
+
+from remsh.partial import PartialFile, partial_name
+
+
+class TestPartial(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.basedir, "dest")
+        self.data = "abcdefgh" * 10000
+        self.digest = hashlib.sha256(self.data).hexdigest()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def test_partial_name(self):
+        self.assertEqual(partial_name(self.dest, self.digest),
+            os.path.join(self.basedir,
+                         ".remsh-partial-%s-dest" % self.digest[:16]))
+        for digest in "abc", "../" + self.digest[3:], self.digest[:63] + "g":
+            self.assertRaises(ValueError, lambda: partial_name("x", digest))
+
+    def test_resume(self):
+        f = PartialFile(self.dest, len(self.data), self.digest)
+        self.assertEqual(f.offset, 0)
+        f.write(self.data[:30000])
+        f.close()
+        self.failIf(os.path.exists(self.dest))
+
+        f = PartialFile(self.dest, len(self.data), self.digest)
+        self.assertEqual(f.offset, 30000)
+        f.write(self.data[30000:])
+        f.finish()
+        self.assertEqual(open(self.dest, "rb").read(), self.data)
+        self.failIf(os.path.exists(partial_name(self.dest, self.digest)))
+
+    def test_too_long(self):
+        f = open(partial_name(self.dest, self.digest), "wb")
+        f.write(self.data + "extra")
+        f.close()
+
+        f = PartialFile(self.dest, len(self.data), self.digest)
+        self.assertEqual(f.offset, len(self.data))
+        f.finish()
+        self.assertEqual(open(self.dest, "rb").read(), self.data)
+
+    def test_mismatch(self):
+        f = PartialFile(self.dest, len(self.data), self.digest)
+        f.write("x" * len(self.data))
+        self.assertRaises(ValueError, f.finish)
+        self.failIf(os.path.exists(self.dest))
+        self.failIf(os.path.exists(partial_name(self.dest, self.digest)))
+
+    def test_symlink(self):
+        # a link planted at the partial file's name is not followed
+        elsewhere = os.path.join(self.basedir, "elsewhere")
+        f = open(elsewhere, "wb")
+        f.write("untouched")
+        f.close()
+        os.symlink(elsewhere, partial_name(self.dest, self.digest))
+
+        self.assertRaises(OSError, lambda:
+            PartialFile(self.dest, len(self.data), self.digest))
+        self.assertEqual(open(elsewhere).read(), "untouched")
+
+    def test_not_regular(self):
+        os.mkfifo(partial_name(self.dest, self.digest))
+        self.assertRaises(OSError, lambda:
+            PartialFile(self.dest, len(self.data), self.digest))
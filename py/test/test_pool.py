@@ -0,0 +1,123 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import tempfile
+import socket
+import shutil
+import time
+import os
+
+from remsh.xport.sock import SocketXport
+from remsh.wire import Wire
+from remsh.slave.server import SlaveServer
+from remsh.master.remote import NotFoundError
+from remsh.master.pool import SlavePool, PoolTimeoutError
+
+
+class TestSlavePool(unittest.TestCase):
+
+    max_per_slave = 1
+
+    def setUp(self):
+        # the slave servers change this process's cwd
+        self.origdir = os.getcwd()
+        self.basedir = tempfile.mkdtemp()
+        self.pool = SlavePool(max_per_slave=self.max_per_slave)
+        self.port = self.pool.listen(0, host='127.0.0.1')
+        self.socks = []
+        self.threads = []
+
+    def tearDown(self):
+        self.pool.close()
+        for thd in self.threads:
+            thd.join()
+        os.chdir(self.origdir)
+        shutil.rmtree(self.basedir)
+
+    def start_slave(self):
+        sock = socket.create_connection(('127.0.0.1', self.port))
+        server = SlaveServer(Wire(SocketXport(sock)))
+        thd = threading.Thread(target=server.serve)
+        thd.setDaemon(1)
+        thd.start()
+        self.socks.append(sock)
+        self.threads.append(thd)
+        return sock
+
+    def test_run_on_many(self):
+        for i in range(5):
+            self.start_slave()
+        self.pool.wait_for_slaves(5, timeout=10)
+        names = self.pool.names()
+        self.assertEqual(len(names), 5)
+        for name in names:
+            result = self.pool.run(lambda slave: slave.stat(self.basedir),
+                                   name=name)
+            self.assertEqual(result, 'd')
+
+    def test_wire_options(self):
+        # a 'channels' option is overridden, rather than passed twice
+        self.pool.wire_options = {'large_values': True, 'channels': False}
+        self.start_slave()
+        self.pool.wait_for_slaves(1, timeout=10)
+        self.assertEqual(self.pool.wire_options,
+                         {'large_values': True, 'channels': False})
+
+    def test_reuse_and_limit(self):
+        self.start_slave()
+        self.pool.wait_for_slaves(1, timeout=10)
+        handles = [self.pool.checkout() for i in range(self.max_per_slave)]
+        self.assertRaises(PoolTimeoutError,
+                          lambda: self.pool.checkout(timeout=0.05))
+        self.pool.checkin(handles[-1])
+        self.failUnless(self.pool.checkout(timeout=1) is handles[-1])
+        for handle in handles:
+            self.pool.checkin(handle)
+
+    def test_operation_error(self):
+        # an error reported by the slave leaves the connection usable
+        self.start_slave()
+        self.pool.wait_for_slaves(1, timeout=10)
+        dest = os.path.join(self.basedir, "dest")
+        self.assertRaises(NotFoundError, lambda:
+            self.pool.run(lambda slave: slave.fetch("nosuch", dest)))
+        self.assertEqual(len(self.pool.names()), 1)
+        self.assertEqual(self.pool.run(lambda slave: slave.set_cwd('')),
+                         os.getcwd())
+
+    def test_dead_slave(self):
+        sock = self.start_slave()
+        self.pool.wait_for_slaves(1, timeout=10)
+        sock.shutdown(socket.SHUT_RDWR)
+        self.threads[0].join()
+
+        self.pool.check_interval = 0
+        self.pool.check()
+        self.assertEqual(self.pool.names(), [])
+        self.assertRaises(PoolTimeoutError,
+                          lambda: self.pool.checkout(timeout=0.05))
+
+
+class TestSlavePoolChannels(TestSlavePool):
+
+    max_per_slave = 3
+
+    def test_concurrent(self):
+        self.start_slave()
+        self.pool.wait_for_slaves(1, timeout=10)
+        results = []
+
+        def job():
+            results.append(self.pool.run(lambda slave: slave.execute(
+                args=['sh', '-c', 'sleep 0.2'])))
+        start = time.time()
+        thds = [threading.Thread(target=job) for i in range(3)]
+        for thd in thds:
+            thd.start()
+        for thd in thds:
+            thd.join()
+        self.assertEqual(results, [0, 0, 0])
+        self.failUnless(time.time() - start < 0.5)
@@ -0,0 +1,107 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import socket
+import time
+
+from remsh.xport.sock import SocketXport
+from remsh.wire import Wire
+from remsh.slave.server import SlaveServer
+from remsh.master.remote import RemoteSlave
+from remsh.master.pool import SlavePool
+from remsh.master.probe import measure, LinkEstimate, Prober, \
+                               MIN_CHUNK_SIZE
+
+
+class TestMeasure(unittest.TestCase):
+
+    def test_measure(self):
+        master_sock, slave_sock = socket.socketpair()
+        server = SlaveServer(Wire(SocketXport(slave_sock)))
+        thd = threading.Thread(target=server.serve)
+        thd.setDaemon(1)
+        thd.start()
+        slave = RemoteSlave(Wire(SocketXport(master_sock)))
+        try:
+            sample = measure(slave, size=10000)
+            self.assert_(sample['rtt'] >= 0)
+            self.assert_(sample['send_rate'] > 0)
+            self.assert_(sample['fetch_rate'] > 0)
+        finally:
+            slave.close()
+            thd.join()
+
+
+class TestLinkEstimate(unittest.TestCase):
+
+    def test_estimates(self):
+        est = LinkEstimate(alpha=0.5)
+        est.add({'rtt': 0.1, 'send_rate': 1000000.0, 'fetch_rate': 2000000.0})
+        self.assertEqual(est.rtt, 0.1)
+        est.add({'rtt': 0.2, 'send_rate': 2000000.0, 'fetch_rate': 2000000.0})
+        self.assertAlmostEqual(est.rtt, 0.15)
+        self.assertAlmostEqual(est.send_rate, 1500000.0)
+        self.assertEqual(est.samples, 2)
+
+        self.assertAlmostEqual(est.transfer_time(3000000), 2.15)
+        self.assertAlmostEqual(est.transfer_time(3000000, fetch=True), 1.65)
+        # 300000 bytes in flight per round trip
+        self.assertAlmostEqual(est.fetch_rate * est.rtt, 300000)
+        self.assertEqual(est.chunk_size(fetch=True), 524288)
+
+        est.add({'rtt': 0.0, 'send_rate': 1.0, 'fetch_rate': 1.0})
+        self.assertEqual(est.chunk_size(), MIN_CHUNK_SIZE)
+
+
+class TestProber(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = SlavePool()
+        self.threads = []
+
+    def tearDown(self):
+        self.pool.close()
+        for thd in self.threads:
+            thd.join()
+
+    def add_slave(self, name):
+        master_sock, slave_sock = socket.socketpair()
+        server = SlaveServer(Wire(SocketXport(slave_sock)))
+        thd = threading.Thread(target=server.serve)
+        thd.setDaemon(1)
+        thd.start()
+        self.threads.append(thd)
+        self.failUnless(self.pool.add(SocketXport(master_sock), name))
+
+    def test_probe_all(self):
+        self.add_slave('a')
+        self.add_slave('b')
+        prober = Prober(self.pool, size=10000, count=1)
+        self.assertEqual(prober.fastest(1000), None)
+
+        # a busy slave is skipped
+        handle = self.pool.checkout('b')
+        prober.probe_all()
+        self.pool.checkin(handle)
+        self.assertEqual(prober.estimate('a').samples, 1)
+        self.assertEqual(prober.estimate('b'), None)
+        self.assertEqual(prober.fastest(1000), 'a')
+
+        prober.probe_all()
+        self.assertEqual(sorted(prober.snapshot().keys()), ['a', 'b'])
+        self.failUnless(prober.fastest(1000, fetch=True) in ('a', 'b'))
+        self.assertEqual(prober.fastest(1000, names=['b', 'c']), 'b')
+
+    def test_start_stop(self):
+        self.add_slave('a')
+        prober = Prober(self.pool, interval=60.0, size=1000, count=1)
+        prober.start()
+        # the first probe is made right away
+        deadline = time.time() + 10
+        while not prober.estimate('a') and time.time() < deadline:
+            time.sleep(0.01)
+        prober.stop()
+        self.assertEqual(prober.estimate('a').samples, 1)
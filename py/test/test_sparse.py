@@ -0,0 +1,81 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import tempfile
+import shutil
+import os
+from cStringIO import StringIO
+
+from remsh import sparse
+
+
+class TestSparse(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.basedir, "sparse")
+        # data, a hole, data, and a hole at the end
+        f = open(self.filename, "wb")
+        f.write("a" * 5000)
+        f.seek(4 * 1024 * 1024)
+        f.write("b" * 5000)
+        f.truncate(8 * 1024 * 1024)
+        f.close()
+        self.file = open(self.filename, "rb")
+        if not sparse.has_holes(self.file):
+            self.file.close()
+            shutil.rmtree(self.basedir)
+            self.skipTest("the filesystem does not support holes")
+
+    def tearDown(self):
+        self.file.close()
+        shutil.rmtree(self.basedir)
+
+    def test_has_holes(self):
+        dense = os.path.join(self.basedir, "dense")
+        f = open(dense, "wb")
+        f.write("x" * 100000)
+        f.close()
+        self.failIf(sparse.has_holes(open(dense)))
+
+    def test_data_extents(self):
+        extents = list(sparse.data_extents(self.file.fileno(),
+                                           8 * 1024 * 1024))
+        # the filesystem may round extents out to whole blocks
+        self.assertEqual(len(extents), 2)
+        self.assertEqual(extents[0][0], 0)
+        self.assert_(extents[0][1] >= 5000)
+        self.assert_(extents[1][0] <= 4 * 1024 * 1024)
+        self.assert_(sum(extents[1]) >= 4 * 1024 * 1024 + 5000)
+        self.assert_(sum(extents[1]) < 8 * 1024 * 1024)
+
+    def test_boxes(self):
+        boxes = list(sparse.boxes(self.file, 1024))
+        self.assertEqual(boxes[0], {'data': 'a' * 1024})
+        self.assertEqual(boxes[-1], {'offset': 8 * 1024 * 1024})
+        self.assertEqual(len([b for b in boxes if 'offset' in b]), 2)
+        self.assert_(sum([len(b.get('data', '')) for b in boxes]) < 100000)
+
+    def test_copy(self):
+        copyname = os.path.join(self.basedir, "copy")
+        dest = open(copyname, "wb")
+        sparse.copy(self.file, dest, 65536)
+        dest.close()
+
+        self.assertEqual(open(copyname, "rb").read(),
+                         open(self.filename, "rb").read())
+        self.assert_(sparse.has_holes(open(copyname)))
+
+    def test_write_box(self):
+        f = StringIO()
+        self.assertEqual(sparse.write_box(f, {'data': 'abc'}), True)
+        self.assertEqual(sparse.write_box(f, {'offset': '1'}), True)
+        self.assertEqual(sparse.write_box(f, {'data': 'x'}), True)
+        self.assertEqual(f.getvalue(), 'axc')
+        self.assertEqual(sparse.write_box(f, {'other': '1'}), False)
+        self.assertRaises(ValueError,
+                          lambda: sparse.write_box(f, {'offset': '-1'}))
+        self.assertRaises(ValueError,
+                          lambda: sparse.write_box(f, {'offset': 'x'}))
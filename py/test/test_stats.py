@@ -0,0 +1,76 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import json
+import StringIO
+
+from remsh.wire import AsyncWire
+from remsh.stats import Histogram, WireStats, OpStats, StatsDumper
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets(self):
+        hist = Histogram()
+        for value in [0, 1, 2, 3, 4, 1000]:
+            hist.add(value)
+        self.failUnlessEqual(hist.snapshot(),
+            [(1, 1), (2, 1), (4, 2), (8, 1), (1024, 1)])
+
+
+class TestWireStats(unittest.TestCase):
+
+    def test_counters(self):
+        sender, receiver = AsyncWire(), AsyncWire()
+        sender.stats = WireStats()
+        receiver.stats = WireStats()
+
+        sender.send_box({'data': 'x' * 100})
+        sender.send_box({'meth': 'getenv', 'version': 1})
+        data = sender.take_output()
+        # deliver the bytes in two pieces, splitting the first box
+        boxes = receiver.data_received(data[:50])
+        boxes += receiver.data_received(data[50:])
+        self.failUnlessEqual(len(boxes), 2)
+
+        sent = sender.stats.snapshot()
+        received = receiver.stats.snapshot()
+        self.failUnlessEqual(sent['boxes_sent'], 2)
+        self.failUnlessEqual(sent['bytes_sent'], len(data))
+        self.failUnlessEqual(sent['writes'], 1)
+        self.failUnlessEqual(received['boxes_received'], 2)
+        self.failUnlessEqual(received['bytes_received'], len(data))
+        self.failUnlessEqual(received['reads'], 2)
+        self.failUnlessEqual(received['received_sizes'],
+                             sent['sent_sizes'])
+        self.failUnlessEqual(sent['sent_sizes'], [(32, 1), (128, 1)])
+
+
+class TestOpStats(unittest.TestCase):
+
+    def test_record(self):
+        stats = OpStats()
+        stats.record('stat', 0.001)
+        stats.record('stat', 0.003)
+        snap = stats.snapshot()
+        self.failUnlessEqual(snap.keys(), ['stat'])
+        self.failUnlessEqual(snap['stat']['count'], 2)
+        self.assertAlmostEqual(snap['stat']['mean_time'], 0.002)
+        self.assertAlmostEqual(snap['stat']['max_time'], 0.003)
+
+
+class TestStatsDumper(unittest.TestCase):
+
+    def test_dump(self):
+        output = StringIO.StringIO()
+        stats = OpStats()
+        stats.record('getenv', 0.5)
+        dumper = StatsDumper({'ops': stats}, interval=0.01, output=output)
+        dumper.start()
+        dumper.stop()
+        lines = output.getvalue().splitlines()
+        self.failUnless(lines)
+        record = json.loads(lines[-1])
+        self.failUnlessEqual(record['ops']['getenv']['count'], 1)
@@ -0,0 +1,154 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import tempfile
+import tarfile
+import shutil
+import os
+from cStringIO import StringIO
+
+from remsh import tree
+
+
+class TestTree(unittest.TestCase):
+
+    def setUp(self):
+        self.basedir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.basedir)
+
+    def path(self, *names):
+        return os.path.join(self.basedir, *names)
+
+    def write(self, name, data):
+        f = open(self.path(name), "wb")
+        f.write(data)
+        f.close()
+
+    def test_round_trip(self):
+        os.makedirs(self.path("src", "sub", "ro"))
+        self.write("src/a", "aaa")
+        self.write("src/sub/b", "b" * 100000)
+        self.write("src/sub/ro/c", "c")
+        os.chmod(self.path("src", "a"), 0751)
+        os.symlink("sub/b", self.path("src", "link"))
+        os.chmod(self.path("src", "sub", "ro"), 0555)
+
+        archive = StringIO()
+        tree.pack(archive, self.path("src"))
+
+        # an existing file is replaced, even if it is a link
+        os.makedirs(self.path("dest"))
+        self.write("elsewhere", "untouched")
+        os.symlink(self.path("elsewhere"), self.path("dest", "a"))
+
+        archive.seek(0)
+        tree.unpack(archive, self.path("dest"))
+        self.assertEqual(open(self.path("dest", "a")).read(), "aaa")
+        self.assertEqual(os.stat(self.path("dest", "a")).st_mode & 0777, 0751)
+        self.assertEqual(open(self.path("elsewhere")).read(), "untouched")
+        self.assertEqual(open(self.path("dest", "sub", "b")).read(),
+                         "b" * 100000)
+        self.assertEqual(os.readlink(self.path("dest", "link")), "sub/b")
+        self.assertEqual(open(self.path("dest", "sub", "ro", "c")).read(), "c")
+        self.assertEqual(
+            os.stat(self.path("dest", "sub", "ro")).st_mode & 0777, 0555)
+        os.chmod(self.path("src", "sub", "ro"), 0755)
+        os.chmod(self.path("dest", "sub", "ro"), 0755)
+
+    def unpack_members(self, members):
+        archive = StringIO()
+        tar = tarfile.open(fileobj=archive, mode="w")
+        for info in members:
+            tar.addfile(info, StringIO("x" * info.size))
+        tar.close()
+        archive.seek(0)
+        os.makedirs(self.path("dest"))
+        tree.unpack(archive, self.path("dest"))
+
+    def test_outside(self):
+        def member(name, type=tarfile.REGTYPE, linkname=''):
+            info = tarfile.TarInfo(name)
+            info.type = type
+            info.linkname = linkname
+            return info
+
+        for members in [
+            [member("../evil")],
+            [member("/tmp/evil")],
+            [member("hard", tarfile.LNKTYPE, "../../etc/passwd")],
+            [member("up", tarfile.SYMTYPE, ".."), member("up/evil")],
+            [member("fifo", tarfile.FIFOTYPE)],
+        ]:
+            self.assertRaises(ValueError, lambda: self.unpack_members(members))
+            shutil.rmtree(self.path("dest"))
+        self.failIf(os.path.exists(os.path.join(self.basedir, "..", "evil")))
+
+    def test_hard_link_through_symlink(self):
+        os.makedirs(self.path("outside"))
+        self.write("outside/secret", "SECRET")
+
+        a = tarfile.TarInfo("a")
+        a.type = tarfile.SYMTYPE
+        a.linkname = self.path("outside")
+        b = tarfile.TarInfo("b")
+        b.type = tarfile.LNKTYPE
+        b.linkname = "a/secret"
+        self.assertRaises(ValueError, lambda: self.unpack_members([a, b]))
+        self.failIf(os.path.lexists(self.path("dest", "b")))
+        self.assertEqual(os.stat(self.path("outside", "secret")).st_nlink, 1)
+
+    def test_directory_over_symlink(self):
+        os.makedirs(self.path("outside"))
+        os.chmod(self.path("outside"), 0700)
+        os.makedirs(self.path("dest"))
+        os.symlink(self.path("outside"), self.path("dest", "d"))
+
+        d = tarfile.TarInfo("d")
+        d.type = tarfile.DIRTYPE
+        d.mode = 0777
+        archive = StringIO()
+        tar = tarfile.open(fileobj=archive, mode="w")
+        tar.addfile(d)
+        tar.close()
+        archive.seek(0)
+        tree.unpack(archive, self.path("dest"))
+
+        self.assertEqual(os.stat(self.path("outside")).st_mode & 0777, 0700)
+        self.failIf(os.path.islink(self.path("dest", "d")))
+        self.assertEqual(os.stat(self.path("dest", "d")).st_mode & 0777, 0777)
+
+    def test_box_streams(self):
+        boxes = []
+
+        class FakeWire:
+            def chunk_size(self):
+                return 1000
+
+            def send_box(self, box):
+                boxes.append(box)
+
+            def read_box(self):
+                return boxes.pop(0)
+
+        wire = FakeWire()
+        writer = tree.BoxWriter(wire)
+        writer.write("a" * 2500)
+        writer.write("b" * 10)
+        writer.flush()
+        wire.send_box({})
+        self.assertEqual([len(box['data']) for box in boxes[:-1]],
+                         [1000, 1000, 510])
+
+        checked = []
+        reader = tree.BoxReader(wire, checked.append)
+        self.assertEqual(reader.read(1500), "a" * 1000)
+        # like a socket, a read may return less than was asked for
+        self.assertEqual(reader.read(600), "a" * 600)
+        self.assertEqual(reader.read(600), "a" * 400)
+        self.assertEqual(reader.read(600), "a" * 500 + "b" * 10)
+        self.assertEqual(reader.read(10), "")
+        self.assertEqual(len(checked), 4)
@@ -6,9 +6,10 @@ import unittest
 import threading
 import os
 import time
+import tempfile
 
 from remsh.xport.local import LocalXport
-from remsh.wire import Wire
+from remsh.wire import Wire, AsyncWire, BoxDecoder, Error
 
 
 class TestWireReading(unittest.TestCase):
@@ -48,6 +49,38 @@ class TestWireReading(unittest.TestCase):
 
     ## tests
 
+    def test_raw_bytes(self):
+        # raw bytes between boxes, split across reads in various ways
+        wire = self.read_with_wire([
+            "\x00\x01a\x00\x01b\x00\x00rawby",
+            "tes\x00\x01c\x00",
+            "\x01d\x00\x00",
+        ])
+        self.assertEqual(wire.read_box(), {'a': 'b'})
+        f = tempfile.TemporaryFile()
+        wire.read_raw(8, f)
+        f.seek(0)
+        self.assertEqual(f.read(), "rawbytes")
+        self.assertEqual(wire.read_box(), {'c': 'd'})
+        self.assertEqual(wire.read_box(), None)
+
+    def test_raw_bytes_eof(self):
+        wire = self.read_with_wire(["\x00\x01a\x00\x01b\x00\x00raw"])
+        self.assertEqual(wire.read_box(), {'a': 'b'})
+        self.assertRaises(EOFError,
+            lambda: wire.read_raw(8, tempfile.TemporaryFile()))
+
+    def test_raw_bytes_write_error(self):
+        wire = self.read_with_wire([
+            "\x00\x01a\x00\x01b\x00\x00",
+            "rawbytes\x00\x01c\x00\x01d\x00\x00",
+        ])
+        self.assertEqual(wire.read_box(), {'a': 'b'})
+        f = open(os.devnull, "rb")
+        self.assertRaises(IOError, lambda: wire.read_raw(8, f))
+        # the bytes were read anyway
+        self.assertEqual(wire.read_box(), {'c': 'd'})
+
     def test_short_box(self):
         data = [
             """\x00\x05hello\x00\x05world\x00\x00""",
@@ -114,26 +147,30 @@ class TestWireWriting(unittest.TestCase):
 
     """
 
-    def write_to_wire(self, boxes):
+    def write_to_wire(self, boxes, corked=False):
         result_xport, thread_xport = LocalXport.create()
 
         def thd():
             wire = Wire(thread_xport)
+            if corked:
+                wire.cork()
             for box in boxes:
                 wire.send_box(box)
+            if corked:
+                wire.uncork()
             wire.close()
         thread = threading.Thread(target=thd)
         thread.setDaemon(1)
         thread.start()
 
-        buf = ''
+        self.writes = []
         while 1:
             d = result_xport.read()
             if not d:
                 break
-            buf += d
+            self.writes.append(d)
         thread.join()
-        return buf
+        return ''.join(self.writes)
 
     ## tests
 
@@ -149,6 +186,52 @@ class TestWireWriting(unittest.TestCase):
         ]), """\x00\x05hello\x00\x05world\x00\x00"""
             + """\x00\x04hola\x00\x08compadre\x00\x00""")
 
+    def test_corked_boxes(self):
+        self.failUnlessEqual(self.write_to_wire([
+            {'hello': 'world'},
+            {'hola': 'compadre'},
+        ], corked=True), """\x00\x05hello\x00\x05world\x00\x00"""
+            + """\x00\x04hola\x00\x08compadre\x00\x00""")
+        self.failUnlessEqual(len(self.writes), 1,
+            "corked boxes are written all at once")
+
+    def test_large_value(self):
+        wire = Wire(None)
+        self.assertRaises(Error,
+            lambda: wire._box_to_bytes({'data': 'z' * 65536}))
+        wire.set_large_values(True)
+        self.failUnlessEqual(wire._box_to_bytes({'data': 'z' * 65536}),
+            "\x80\x04data\x00\x01\x00\x00" + 'z' * 65536 + "\x00\x00")
+        self.failUnlessEqual(wire._box_to_bytes({'data': 'z'}),
+            "\x00\x04data\x00\x01z\x00\x00")
+
+    def test_compression(self):
+        sender, receiver = Wire(None), Wire(None)
+        sender.set_compression(True)
+        receiver.set_compression(True)
+
+        boxes = [
+            {'data': 'compressible line\n' * 100, 'stream': 'stdout'},
+            {'data': 'compressible line\n' * 100},
+            {'result': '0'},
+        ]
+        bytes = ''.join([sender._box_to_bytes(box) for box in boxes])
+        self.failUnless(len(bytes) < 300, "data is compressed")
+        # the short value is below the threshold and sent as-is
+        self.failUnless('\x00\x06stream\x00\x06stdout' in bytes)
+
+        receiver.decoder.feed(bytes)
+        for box in boxes:
+            self.failUnlessEqual(receiver.decoder.next_box(), box)
+
+    def test_schema_boxes(self):
+        # registered box shapes always render in the schema's key order
+        self.failUnlessEqual(self.write_to_wire([
+            {'data': 'hi', 'stream': 'stdout'},
+            {'result': 0},
+        ]), """\x00\x06stream\x00\x06stdout\x00\x04data\x00\x02hi\x00\x00"""
+            + """\x00\x06result\x00\x010\x00\x00""")
+
     def test_multiple_keys(self):
         # multiple keys can render differently depending on the dict ordering
         self.failUnless(self.write_to_wire([
@@ -161,5 +244,117 @@ class TestWireWriting(unittest.TestCase):
         ))
 
 
+class TestBoxDecoder(unittest.TestCase):
+    """
+
+    test the incremental box parser directly
+
+    """
+
+    def test_byte_at_a_time(self):
+        data = ("""\x00\x06orange\x00\x05fruit"""
+              + """\x00\x06carrot\x00\x09vegetable\x00\x00"""
+              + """\x00\x00""")
+        decoder = BoxDecoder()
+        boxes = []
+        for c in data:
+            decoder.feed(c)
+            box = decoder.next_box()
+            if box is not None:
+                boxes.append(box)
+        self.failUnlessEqual(boxes,
+            [{'orange': 'fruit', 'carrot': 'vegetable'}, {}])
+        self.failIf(decoder.pending())
+
+    def test_large_value_in_chunks(self):
+        value = "x" * 65535
+        data = "\x00\x04data\xff\xff" + value + "\x00\x00\x00\x01y"
+        decoder = BoxDecoder()
+        for i in range(0, len(data), 32768):
+            decoder.feed(data[i:i + 32768])
+            box = decoder.next_box()
+            if box is not None:
+                break
+        self.failUnlessEqual(box, {'data': value})
+        self.failUnless(decoder.pending())
+        self.failUnlessEqual(decoder.remaining(), "\x00\x01y")
+
+    def test_large_value(self):
+        value = "y" * 100000
+        data = "\x80\x04data\x00\x01\x86\xa0" + value + "\x00\x00"
+        decoder = BoxDecoder()
+        decoder.large_values = True
+        decoder.feed(data)
+        self.failUnlessEqual(decoder.next_box(), {'data': value})
+
+    def test_schema_box_in_pieces(self):
+        data = "\x00\x06stream\x00\x06stderr\x00\x04data\x00\x03err\x00\x00"
+        decoder = BoxDecoder()
+        boxes = []
+        for i in range(0, len(data), 5):
+            decoder.feed(data[i:i + 5])
+            box = decoder.next_box()
+            if box is not None:
+                boxes.append(box)
+        self.failUnlessEqual(boxes, [{'stream': 'stderr', 'data': 'err'}])
+
+    def test_schema_keys_out_of_order(self):
+        decoder = BoxDecoder()
+        decoder.feed("\x00\x04data\x00\x02ok\x00\x06stream\x00\x06stdout"
+                     + "\x00\x00")
+        self.failUnlessEqual(decoder.next_box(),
+                             {'data': 'ok', 'stream': 'stdout'})
+
+    def test_schema_extra_key(self):
+        decoder = BoxDecoder()
+        decoder.feed("\x00\x06result\x00\x010\x00\x01x\x00\x01y\x00\x00")
+        self.failUnlessEqual(decoder.next_box(), {'result': '0', 'x': 'y'})
+
+    def test_large_value_not_enabled(self):
+        decoder = BoxDecoder()
+        decoder.feed("\x80\x04data\x00\x01\x86\xa0")
+        self.assertRaises(Error, decoder.next_box)
+
+    def test_invalid_key_length(self):
+        decoder = BoxDecoder()
+        decoder.feed("\x01\x00")
+        self.assertRaises(Error, decoder.next_box)
+
+    def test_duplicate_key(self):
+        decoder = BoxDecoder()
+        decoder.feed("\x00\x01k\x00\x01v\x00\x01k\x00\x01w\x00\x00")
+        self.assertRaises(Error, decoder.next_box)
+
+
+
+class TestAsyncWire(unittest.TestCase):
+
+    def test_compressed_boxes(self):
+        sender, receiver = AsyncWire(), AsyncWire()
+        for wire in sender, receiver:
+            wire.set_large_values(True)
+            wire.set_compression(True)
+        # an AsyncWire never reads or writes for itself
+        self.failIf(hasattr(receiver, 'read_box'))
+
+        boxes = [
+            {'data': 'compressible line\n' * 10000, 'stream': 'stdout'},
+            {'result': '0'},
+        ]
+        for box in boxes:
+            sender.send_box(box)
+        self.failUnless(0 < sender.pending_output() < 10000)
+        data = sender.take_output()
+        self.failUnlessEqual(sender.pending_output(), 0)
+
+        received = receiver.data_received(data[:100])
+        received += receiver.data_received(data[100:])
+        self.failUnlessEqual(received, boxes)
+        receiver.eof_received()
+
+        receiver.data_received(data[:5])
+        self.assertRaises(EOFError, receiver.eof_received)
+
+
 if __name__ == '__main__':
     unittest.main()
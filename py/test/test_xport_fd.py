@@ -0,0 +1,59 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import tempfile
+import os
+
+from remsh.xport.fd import FDXport
+from remsh.xport.sendfile import sendfile, SendfileUnsupported
+
+
+class TestFDXport(unittest.TestCase):
+
+    def test_nonblocking(self):
+        r, w = os.pipe()
+        top, bottom = FDXport(w), FDXport(r)
+        self.failUnless(top.can_poll)
+        self.assertEqual(bottom.fileno(), r)
+        self.assertEqual(bottom.read_nonblocking(), None)
+
+        # far more than a pipe holds
+        data = 'x' * 4000000
+        top.write_nonblocking(data)
+        self.failUnless(top.wants_write())
+
+        received = []
+        while top.wants_write():
+            chunk = bottom.read_nonblocking()
+            if chunk:
+                received.append(chunk)
+            top.flush_nonblocking()
+        top.close()
+        while 1:
+            chunk = bottom.read_nonblocking()
+            if chunk == '':
+                break
+            if chunk:
+                received.append(chunk)
+        self.assertEqual(len(''.join(received)), len(data))
+        bottom.close()
+
+    def test_sendfile_fallback(self):
+        src = tempfile.TemporaryFile()
+        src.write("abcdefgh" * 1000)
+        src.flush()
+        dest = tempfile.NamedTemporaryFile()
+        # the kernel will not sendfile to a file opened for appending
+        fd = os.open(dest.name, os.O_WRONLY | os.O_APPEND)
+        self.assertRaises(SendfileUnsupported,
+                          lambda: sendfile(fd, src.fileno(), 0, 8000))
+
+        xport = FDXport(fd)
+        self.assertEqual(xport.sendfile(src, 4, 6000), 6000)
+        xport.close()
+        self.assertEqual(open(dest.name).read(),
+                         ("abcdefgh" * 1000)[4:6004])
+        src.close()
+        dest.close()
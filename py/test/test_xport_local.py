@@ -4,6 +4,7 @@
 
 import unittest
 import threading
+import time
 
 from remsh.xport.local import LocalXport
 
@@ -11,8 +12,11 @@ from remsh.xport.local import LocalXport
 class TestLocalXport(unittest.TestCase):
     def top_thread(self, top):
         top.write("chicken?")
-        self.assertEqual(top.read(), "turkey")
-        self.assertEqual(top.read(), "ham?")
+        # the two writes from the other side may be coalesced
+        data = ''
+        while len(data) < len("turkeyham?"):
+            data += top.read()
+        self.assertEqual(data, "turkeyham?")
         top.write("yep")
         top.close()
 
@@ -35,3 +39,44 @@ class TestLocalXport(unittest.TestCase):
 
         top_th.join()
         bottom_th.join()
+
+    def test_coalesced_writes(self):
+        top, bottom = LocalXport.create()
+        top.write("one")
+        top.write("two")
+        top.write("three")
+        top.close()
+        self.assertEqual(bottom.read(), "onetwothree")
+        self.assertEqual(bottom.read(), "")
+
+    def test_capacity(self):
+        top, bottom = LocalXport.create(capacity=10)
+        data = "0123456789" * 10
+
+        # the writer blocks until the reader catches up
+        def write():
+            for i in range(0, len(data), 10):
+                top.write(data[i:i + 10])
+        writer = threading.Thread(target=write)
+        writer.start()
+        time.sleep(0.05)
+        self.failUnless(writer.isAlive(), "writer blocked")
+
+        received = ''
+        while len(received) < len(data):
+            chunk = bottom.read()
+            self.failUnless(len(chunk) <= 10)
+            received += chunk
+        writer.join()
+        self.assertEqual(received, data)
+
+    def test_close_wakes_writer(self):
+        top, bottom = LocalXport.create(capacity=10)
+        def write():
+            top.write("x" * 10)
+            top.write("x" * 10)
+        writer = threading.Thread(target=write)
+        writer.start()
+        bottom.close()
+        writer.join()
+        self.assertEqual(top.read(), "")
@@ -0,0 +1,85 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import platform
+import os
+
+from remsh.xport.base import Error
+from remsh.xport.shm import ShmXport, ORDERED_MACHINES
+from remsh.wire import Wire
+
+
+class TestShmXport(unittest.TestCase):
+
+    def setUp(self):
+        if platform.machine() not in ORDERED_MACHINES:
+            self.skipTest("shared-memory transports need x86")
+
+    def test_small(self):
+        top, bottom = ShmXport.create()
+        top.write("chicken?")
+        self.assertEqual(bottom.read(), "chicken?")
+        bottom.write("turkey")
+        bottom.write("ham?")
+        self.assertEqual(top.read(), "turkeyham?")
+        top.close()
+        self.assertEqual(bottom.read(), "")
+        self.assertEqual(bottom.read(), "") # EOF is "sticky"
+
+    def test_wraparound(self):
+        # much more data than the ring holds, so the writer must wait
+        top, bottom = ShmXport.create(ring_size=1000)
+        data = os.urandom(100000)
+
+        def thd():
+            for i in range(0, len(data), 777):
+                top.write(data[i:i + 777])
+            top.close()
+        writer = threading.Thread(target=thd)
+        writer.start()
+
+        received = []
+        while 1:
+            chunk = bottom.read()
+            if not chunk:
+                break
+            self.failUnless(len(chunk) <= 1000)
+            received.append(chunk)
+        writer.join()
+        self.assertEqual(''.join(received), data)
+
+    def test_across_fork(self):
+        top, bottom = ShmXport.create(ring_size=4096)
+        pid = os.fork()
+        if pid == 0:
+            # child: echo boxes back until EOF
+            try:
+                top.release()
+                wire = Wire(bottom)
+                while 1:
+                    box = wire.read_box()
+                    if box is None:
+                        break
+                    wire.send_box(box)
+            finally:
+                os._exit(0)
+
+        bottom.release()
+        wire = Wire(top)
+        for i in range(10):
+            box = {'data': 'x' * (i * 1000)}
+            wire.send_box(box)
+            self.assertEqual(wire.read_box(), box)
+        wire.close()
+        os.waitpid(pid, 0)
+
+    def test_unordered_machine(self):
+        machine = platform.machine
+        platform.machine = lambda: 'aarch64'
+        try:
+            self.assertRaises(Error, ShmXport.create)
+        finally:
+            platform.machine = machine
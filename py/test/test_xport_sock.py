@@ -0,0 +1,99 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import socket
+import time
+
+from remsh.xport.sock import SocketXport
+
+
+def tcp_pair():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(1)
+    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client.connect(listener.getsockname())
+    server, addr = listener.accept()
+    listener.close()
+    return client, server
+
+
+class TestSocketXport(unittest.TestCase):
+
+    def test_transfer(self):
+        a, b = socket.socketpair()
+        top, bottom = SocketXport(a), SocketXport(b)
+        data = "abcdefgh" * 100000
+
+        def thd():
+            top.write(data)
+            top.close()
+        writer = threading.Thread(target=thd)
+        writer.start()
+
+        received = []
+        while 1:
+            chunk = bottom.read()
+            if not chunk:
+                break
+            received.append(chunk)
+        writer.join()
+        bottom.close()
+        self.assertEqual(''.join(received), data)
+
+    def test_tcp_options(self):
+        client, server = tcp_pair()
+        xport = SocketXport(client, keepalive=True, sndbuf=65536)
+        try:
+            self.failUnless(client.getsockopt(socket.IPPROTO_TCP,
+                                              socket.TCP_NODELAY))
+            self.failUnless(client.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_KEEPALIVE))
+            self.failUnless(client.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_SNDBUF) >= 65536)
+            xport.set_options(nodelay=False)
+            self.failIf(client.getsockopt(socket.IPPROTO_TCP,
+                                          socket.TCP_NODELAY))
+        finally:
+            xport.close()
+            server.close()
+
+    def test_close_wakes_reader(self):
+        client, server = tcp_pair()
+        xport = SocketXport(client)
+        result = []
+        reader = threading.Thread(target=lambda: result.append(xport.read()))
+        reader.start()
+        time.sleep(0.05)
+        xport.close()
+        reader.join()
+        server.close()
+        self.assertEqual(result, [''])
+
+    def test_nonblocking(self):
+        a, b = socket.socketpair()
+        top, bottom = SocketXport(a), SocketXport(b)
+        self.assertEqual(bottom.read_nonblocking(), None)
+
+        # far more than the socket buffers hold
+        data = 'x' * 4000000
+        top.write_nonblocking(data)
+        self.failUnless(top.wants_write())
+
+        received = []
+        while top.wants_write():
+            chunk = bottom.read_nonblocking()
+            if chunk:
+                received.append(chunk)
+            top.flush_nonblocking()
+        top.close()
+        while 1:
+            chunk = bottom.read()
+            if not chunk:
+                break
+            received.append(chunk)
+        self.assertEqual(len(''.join(received)), len(data))
+        bottom.close()
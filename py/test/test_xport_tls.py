@@ -0,0 +1,111 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import threading
+import socket
+import os
+
+from remsh.xport.base import Error
+from remsh.xport.tls import TLSXport, server_context, client_context
+from remsh.master.eventloop import EventLoop
+
+# a self-signed certificate for 'localhost', with its key
+CERTFILE = os.path.join(os.path.dirname(__file__), 'tls-localhost.pem')
+
+
+class Server(object):
+
+    def __init__(self, context):
+        self.context = context
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(5)
+        self.address = ('localhost', self.listener.getsockname()[1])
+
+    def accept(self):
+        """
+        Accept one connection in a thread, and echo until EOF.
+        """
+        def thd():
+            sock, addr = self.listener.accept()
+            try:
+                xport = TLSXport(sock, self.context, server_side=True)
+            except Error:
+                return
+            while 1:
+                data = xport.read()
+                if not data:
+                    break
+                xport.write(data)
+            xport.close()
+        thread = threading.Thread(target=thd)
+        thread.setDaemon(1)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.listener.close()
+
+
+class TestTLSXport(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(server_context(CERTFILE))
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_echo(self):
+        thread = self.server.accept()
+        xport = TLSXport.connect(self.server.address,
+                                 client_context(cafile=CERTFILE))
+        self.assertEqual(xport.peer_certificate()['subject'],
+                         ((('commonName', 'localhost'),),))
+
+        # large enough to take many TLS records
+        data = os.urandom(200000)
+        writer = threading.Thread(target=lambda: xport.write(data))
+        writer.start()
+        received = []
+        while sum(map(len, received)) < len(data):
+            received.append(xport.read())
+        writer.join()
+        self.assertEqual(''.join(received), data)
+
+        xport.close()
+        thread.join()
+
+    def test_untrusted(self):
+        # the default authorities do not include the self-signed certificate
+        thread = self.server.accept()
+        self.assertRaises(Error, lambda:
+            TLSXport.connect(self.server.address, client_context()))
+        thread.join()
+
+    def test_resumption(self):
+        context = client_context(cafile=CERTFILE)
+        session = None
+        for reused in False, True:
+            thread = self.server.accept()
+            xport = TLSXport.connect(self.server.address, context,
+                                     session=session)
+            # reading lets the client receive a TLS 1.3 session ticket
+            xport.write("hello")
+            self.assertEqual(xport.read(), "hello")
+            self.assertEqual(xport.session_reused, reused)
+            session = xport.session
+            self.failIf(session is None)
+            xport.close()
+            thread.join()
+
+    def test_nonblocking_unsupported(self):
+        thread = self.server.accept()
+        xport = TLSXport.connect(self.server.address,
+                                 client_context(cafile=CERTFILE))
+        self.failIf(xport.can_poll)
+        self.assertRaises(Error, xport.fileno)
+        self.assertRaises(ValueError, lambda: EventLoop().add_slave(xport))
+        xport.close()
+        thread.join()
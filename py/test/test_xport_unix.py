@@ -0,0 +1,57 @@
+# This file is part of remsh
+# Copyright 2009, 2010 Dustin J. Mitchell
+# See COPYING for license information
+
+import unittest
+import os
+import threading
+
+from remsh.xport.base import Error
+from remsh.xport.unix import UnixXport
+
+
+class TestUnixXport(unittest.TestCase):
+
+    def setUp(self):
+        self.top, self.bottom = UnixXport.pair()
+        if not self.top.can_pass_fds:
+            self.top.close()
+            self.bottom.close()
+            raise unittest.SkipTest("no descriptor passing on this platform")
+
+    def tearDown(self):
+        self.top.close()
+        self.bottom.close()
+
+    def test_pass_fd(self):
+        r, w = os.pipe()
+        try:
+            self.top.write("before")
+            self.top.write_fds("with", [r])
+        finally:
+            os.close(r)
+
+        data = ''
+        while len(data) < len("beforewith"):
+            data += self.bottom.read()
+        self.assertEqual(data, "beforewith")
+
+        # the received descriptor refers to the same pipe
+        fd = self.bottom.take_fd()
+        try:
+            os.write(w, "through the pipe")
+            self.assertEqual(os.read(fd, 100), "through the pipe")
+        finally:
+            os.close(fd)
+            os.close(w)
+        self.assertRaises(Error, self.bottom.take_fd)
+
+    def test_plain_data(self):
+        writer = threading.Thread(target=lambda: self.top.write("x" * 500000))
+        writer.start()
+        data = ''
+        while len(data) < 500000:
+            data += self.bottom.read()
+        writer.join()
+        self.assertEqual(data, "x" * 500000)
+        self.assertRaises(Error, self.bottom.take_fd)